@@ -3,15 +3,31 @@ API REST para Ferretería - Sistema Completo
 Sistema de gestión de productos, categorías y clientes
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from datetime import datetime
+from sqlalchemy import BigInteger, TypeDecorator, and_, bindparam, case, delete, event, func, insert, inspect, literal, literal_column, or_, select, table, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, validates
+from sqlalchemy.schema import CreateTable
+from datetime import datetime, timedelta, timezone
 import os
+import re
+import random
+import socket
+import threading
+import time
+from array import array
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
 import requests
 import json
 import uuid
-from decimal import Decimal
+import base64
+import heapq
+import math
+from decimal import Decimal, ROUND_HALF_UP
 
 # Configuración de la aplicación
 app = Flask(__name__)
@@ -19,12 +35,123 @@ CORS(app)
 
 # Configuración de base de datos
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(basedir, "ferreteria.db")}'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'FERRETERIA_DATABASE_URI',
+    f'sqlite:///{os.path.join(basedir, "ferreteria.db")}'
+)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # Inicializar base de datos
 db = SQLAlchemy(app)
 
+# Aritmética de punto fijo para dinero
+class Dinero:
+    """Montos y tasas como enteros escalados (unidades menores)
+    
+    Los montos se guardan en centavos y las tasas con 9 decimales, así las
+    sumas son exactas y el redondeo (mitad hacia arriba) ocurre en un solo
+    lugar. Hacia la API se siguen entregando números decimales.
+    """
+    
+    ESCALA_MONTO = 100
+    ESCALA_TASA = 10 ** 9
+    
+    @staticmethod
+    def escalar(valor, escala):
+        """Pasar un número a entero escalado, redondeando mitad hacia arriba"""
+        if isinstance(valor, int):
+            return valor * escala
+        escalado = Decimal(str(valor)) * escala
+        return int(escalado.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    
+    @staticmethod
+    def error_monto(monto):
+        """Mensaje de error de un monto recibido del cliente, o None si es válido
+        
+        JSON acepta NaN e Infinity, que no tienen representación en centavos.
+        """
+        if not isinstance(monto, (int, float)) or isinstance(monto, bool) or not math.isfinite(monto):
+            return 'El monto debe ser un número finito'
+        if monto <= 0:
+            return 'El monto debe ser mayor a 0'
+        return None
+    
+    @staticmethod
+    def dividir(numerador, divisor):
+        """División entera redondeando mitad hacia arriba (simétrica para negativos)"""
+        cociente, resto = divmod(abs(numerador), divisor)
+        if 2 * resto >= divisor:
+            cociente += 1
+        return -cociente if numerador < 0 else cociente
+    
+    @staticmethod
+    def a_centavos(monto):
+        return Dinero.escalar(monto, Dinero.ESCALA_MONTO)
+    
+    @staticmethod
+    def desde_centavos(centavos):
+        return centavos / Dinero.ESCALA_MONTO
+    
+    @staticmethod
+    def a_tasa(tasa):
+        return Dinero.escalar(tasa, Dinero.ESCALA_TASA)
+    
+    @staticmethod
+    def desde_tasa(tasa):
+        return tasa / Dinero.ESCALA_TASA
+    
+    @staticmethod
+    def redondear(monto):
+        """Redondear un monto a centavos"""
+        return Dinero.desde_centavos(Dinero.a_centavos(monto))
+    
+    @staticmethod
+    def fraccion(numerador, denominador):
+        """Fracción de enteros reducida"""
+        divisor = math.gcd(numerador, denominador)
+        return numerador // divisor, denominador // divisor
+    
+    @staticmethod
+    def convertir(centavos, fraccion):
+        """Multiplicar un monto en centavos por una fracción exacta con un solo redondeo"""
+        numerador, denominador = fraccion
+        return Dinero.dividir(centavos * numerador, denominador)
+    
+    @staticmethod
+    def convertir_montos(montos, fraccion):
+        """Convertir una lista de montos con la misma fracción (resuelta una sola vez)"""
+        return [
+            Dinero.desde_centavos(Dinero.convertir(Dinero.a_centavos(monto), fraccion))
+            for monto in montos
+        ]
+    
+    @staticmethod
+    def sumar(montos):
+        """Sumar montos sin acumular error de coma flotante"""
+        return Dinero.desde_centavos(sum(Dinero.a_centavos(monto) for monto in montos))
+
+class MontoFijo(TypeDecorator):
+    """Columna de monto: entero en centavos en la BD, número decimal en Python"""
+    impl = BigInteger
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        return None if value is None else Dinero.a_centavos(value)
+    
+    def process_result_value(self, value, dialect):
+        return None if value is None else Dinero.desde_centavos(value)
+
+class TasaFija(TypeDecorator):
+    """Columna de tasa: entero con 9 decimales implícitos en la BD"""
+    impl = BigInteger
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        return None if value is None else Dinero.a_tasa(value)
+    
+    def process_result_value(self, value, dialect):
+        return None if value is None else Dinero.desde_tasa(value)
+
 # Modelos de datos
 class Categoria(db.Model):
     """Modelo para categorías de productos"""
@@ -45,10 +172,20 @@ class Producto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(100), nullable=False)
     descripcion = db.Column(db.Text)
-    precio = db.Column(db.Float, nullable=False)
-    stock = db.Column(db.Integer, nullable=False, default=0)
+    precio = db.Column(MontoFijo, nullable=False)
+    # active_history: conocer el stock anterior al asignarlo, para el libro de movimientos
+    stock = db.column_property(db.Column(db.Integer, nullable=False, default=0), active_history=True)
     categoria_id = db.Column(db.Integer, db.ForeignKey('categoria.id'))
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    texto_busqueda = db.Column(db.Text)  # nombre y descripción normalizados (índice de trigramas)
+    
+    # Columnas de uso interno que no se exponen en la API
+    COLUMNAS_INTERNAS = ('texto_busqueda',)
+    
+    @validates('precio')
+    def _validar_precio(self, key, precio):
+        # Dejar en memoria el mismo valor que queda guardado en centavos
+        return None if precio is None else Dinero.redondear(precio)
     
     def to_dict(self):
         return {
@@ -147,12 +284,33 @@ class ItemPedidoSucursal(db.Model):
             'cantidad_aprobada': self.cantidad_aprobada
         }
 
+class InventarioSucursal(db.Model):
+    """Stock de un producto en una sucursal"""
+    sucursal_id = db.Column(db.Integer, db.ForeignKey('sucursal.id'), primary_key=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), primary_key=True)
+    stock = db.Column(db.Integer, nullable=False, default=0)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Disponibilidad por producto: "sucursales con stock >= N" se resuelve
+        # dentro del índice, sin leer la tabla
+        db.Index('ix_inventario_sucursal_producto_stock', 'producto_id', 'stock', 'sucursal_id'),
+    )
+    
+    def to_dict(self):
+        return {
+            'sucursal_id': self.sucursal_id,
+            'producto_id': self.producto_id,
+            'stock': self.stock,
+            'fecha_actualizacion': self.fecha_actualizacion.isoformat() if self.fecha_actualizacion else None
+        }
+
 class TransaccionPago(db.Model):
     """Modelo para transacciones de pago WebPay"""
     id = db.Column(db.Integer, primary_key=True)
     token_transaccion = db.Column(db.String(200), unique=True, nullable=False)
-    monto = db.Column(db.Float, nullable=False)
-    estado = db.Column(db.String(50), default='iniciada')  # iniciada, aprobada, rechazada, anulada
+    monto = db.Column(MontoFijo, nullable=False)
+    estado = db.Column(db.String(50), default='iniciada')  # iniciada, aprobada, rechazada, anulada, expirada
     fecha_transaccion = db.Column(db.DateTime, default=datetime.utcnow)
     fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
     cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'))
@@ -161,6 +319,10 @@ class TransaccionPago(db.Model):
     # Relación
     cliente = db.relationship('Cliente')
     
+    @validates('monto')
+    def _validar_monto(self, key, monto):
+        return None if monto is None else Dinero.redondear(monto)
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -173,15 +335,40 @@ class TransaccionPago(db.Model):
             'detalle': self.detalle
         }
 
+class ReservaStock(db.Model):
+    """Unidades apartadas para una transacción WebPay en curso, hasta ``expira_en``"""
+    id = db.Column(db.Integer, primary_key=True)
+    transaccion_id = db.Column(db.Integer, db.ForeignKey('transaccion_pago.id', ondelete='CASCADE'), nullable=False)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id', ondelete='CASCADE'), nullable=False)
+    cantidad = db.Column(db.Integer, nullable=False)
+    expira_en = db.Column(db.DateTime, nullable=False)
+    
+    __table_args__ = (
+        # Cubre la suma de reservas vigentes por producto sin leer la tabla
+        db.Index('ix_reserva_stock_producto_expira', 'producto_id', 'expira_en', 'cantidad'),
+        db.Index('ix_reserva_stock_transaccion', 'transaccion_id'),
+    )
+    
+    def to_dict(self):
+        return {
+            'producto_id': self.producto_id,
+            'cantidad': self.cantidad,
+            'expira_en': self.expira_en.isoformat() if self.expira_en else None
+        }
+
 class ConversionMoneda(db.Model):
     """Modelo para conversiones de moneda"""
     id = db.Column(db.Integer, primary_key=True)
     moneda_origen = db.Column(db.String(3), nullable=False)  # CLP, USD, EUR
     moneda_destino = db.Column(db.String(3), nullable=False)
-    tasa_cambio = db.Column(db.Float, nullable=False)
+    tasa_cambio = db.Column(TasaFija, nullable=False)
     fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
     activa = db.Column(db.Boolean, default=True)
     
+    __table_args__ = (
+        db.Index('ux_conversion_moneda_par', 'moneda_origen', 'moneda_destino', 'activa', unique=True),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -192,10 +379,348 @@ class ConversionMoneda(db.Model):
             'activa': self.activa
         }
 
+class HistorialCotizacion(db.Model):
+    """Historial append-only de cotizaciones base (1 unidad = valor en moneda pivote)"""
+    id = db.Column(db.Integer, primary_key=True)
+    moneda = db.Column(db.String(3), nullable=False)
+    valor = db.Column(TasaFija, nullable=False)
+    fecha = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_historial_cotizacion_moneda_fecha', 'moneda', 'fecha'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'moneda': self.moneda,
+            'valor': self.valor,
+            'fecha': self.fecha.isoformat() if self.fecha else None
+        }
+
+class Cotizacion(db.Model):
+    """Cotización con tasa bloqueada, vigente hasta ``expira_en`` (ver CotizacionService)"""
+    token = db.Column(db.String(32), primary_key=True)
+    monto_original = db.Column(MontoFijo, nullable=False)
+    moneda_origen = db.Column(db.String(3), nullable=False)
+    monto_convertido = db.Column(MontoFijo, nullable=False)
+    moneda_destino = db.Column(db.String(3), nullable=False)
+    tasa_cambio = db.Column(TasaFija, nullable=False)
+    expira_en = db.Column(db.DateTime, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_cotizacion_expira_en', 'expira_en'),
+    )
+    
+    def to_dict(self):
+        return {
+            'token': self.token,
+            'monto_original': self.monto_original,
+            'moneda_origen': self.moneda_origen,
+            'monto_convertido': self.monto_convertido,
+            'moneda_destino': self.moneda_destino,
+            'tasa_cambio': self.tasa_cambio,
+            'expira_en': self.expira_en.isoformat()
+        }
+
+class PrecioMoneda(db.Model):
+    """Precios de productos ya convertidos a cada moneda (tabla derivada)
+    
+    Se recalcula en bloque al cambiar las tasas o el precio de un producto;
+    el catálogo la lee por moneda sin hacer conversiones.
+    """
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id', ondelete='CASCADE'), primary_key=True)
+    moneda = db.Column(db.String(3), primary_key=True)
+    precio_convertido = db.Column(MontoFijo, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_precio_moneda_moneda_producto', 'moneda', 'producto_id'),
+    )
+
+class MovimientoStock(db.Model):
+    """Libro append-only de movimientos de stock (cantidad con signo)"""
+    id = db.Column(db.Integer, primary_key=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), nullable=False)
+    tipo = db.Column(db.String(20), nullable=False)  # inicial, venta, transferencia, ajuste
+    cantidad = db.Column(db.Integer, nullable=False)
+    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido_sucursal.id'))
+    transaccion_id = db.Column(db.Integer, db.ForeignKey('transaccion_pago.id'))
+    detalle = db.Column(db.Text)
+    fecha = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_movimiento_stock_producto_id', 'producto_id', 'id'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'producto_id': self.producto_id,
+            'tipo': self.tipo,
+            'cantidad': self.cantidad,
+            'pedido_id': self.pedido_id,
+            'transaccion_id': self.transaccion_id,
+            'detalle': self.detalle,
+            'fecha': self.fecha.isoformat() if self.fecha else None
+        }
+
+class SnapshotStock(db.Model):
+    """Stock acumulado de un producto hasta un movimiento (compactación del libro)"""
+    id = db.Column(db.Integer, primary_key=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), nullable=False)
+    stock = db.Column(db.Integer, nullable=False)
+    hasta_movimiento_id = db.Column(db.Integer, nullable=False)
+    fecha = db.Column(db.DateTime, nullable=False)  # fecha del último movimiento incluido
+    
+    __table_args__ = (
+        db.Index('ix_snapshot_stock_producto_fecha', 'producto_id', 'fecha'),
+    )
+
+class BloqueoTarea(db.Model):
+    """Arriendo (lease) en BD para que una sola instancia ejecute una tarea periódica"""
+    nombre = db.Column(db.String(100), primary_key=True)
+    titular = db.Column(db.String(200))
+    vence_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class VersionCache(db.Model):
+    """Contador por caché en memoria; cada transacción que cambia sus datos lo incrementa"""
+    nombre = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+def parsear_fecha(valor):
+    """Interpretar una fecha ISO 8601 del cliente"""
+    try:
+        return datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError("Fecha inválida, use formato ISO 8601")
+
+def normalizar_texto(texto):
+    """Pasar un texto a minúsculas, sin tildes y con espacios simples"""
+    descompuesto = unicodedata.normalize('NFKD', texto or '')
+    sin_tildes = ''.join(c for c in descompuesto if not unicodedata.combining(c))
+    return ' '.join(sin_tildes.lower().split())
+
+# Índice de búsqueda de texto completo (SQLite FTS5)
+# Tabla virtual de contenido externo sobre producto(nombre, descripcion);
+# los triggers la mantienen sincronizada con cada INSERT/UPDATE/DELETE.
+FTS_PRODUCTO_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS producto_fts USING fts5(
+        nombre, descripcion,
+        content='producto', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS producto_fts_ai AFTER INSERT ON producto BEGIN
+        INSERT INTO producto_fts(rowid, nombre, descripcion)
+        VALUES (new.id, new.nombre, new.descripcion);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS producto_fts_ad AFTER DELETE ON producto BEGIN
+        INSERT INTO producto_fts(producto_fts, rowid, nombre, descripcion)
+        VALUES ('delete', old.id, old.nombre, old.descripcion);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS producto_fts_au AFTER UPDATE OF nombre, descripcion ON producto BEGIN
+        INSERT INTO producto_fts(producto_fts, rowid, nombre, descripcion)
+        VALUES ('delete', old.id, old.nombre, old.descripcion);
+        INSERT INTO producto_fts(rowid, nombre, descripcion)
+        VALUES (new.id, new.nombre, new.descripcion);
+    END
+    """
+]
+
+# Índice de trigramas sobre el texto normalizado (sin tildes, en minúsculas)
+# para búsquedas por subcadena y tolerantes a errores de tipeo.
+TRIGRAMA_PRODUCTO_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS producto_trigrama USING fts5(
+        texto_busqueda,
+        content='producto', content_rowid='id',
+        tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS producto_trigrama_ai AFTER INSERT ON producto BEGIN
+        INSERT INTO producto_trigrama(rowid, texto_busqueda) VALUES (new.id, new.texto_busqueda);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS producto_trigrama_ad AFTER DELETE ON producto BEGIN
+        INSERT INTO producto_trigrama(producto_trigrama, rowid, texto_busqueda)
+        VALUES ('delete', old.id, old.texto_busqueda);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS producto_trigrama_au AFTER UPDATE OF texto_busqueda ON producto BEGIN
+        INSERT INTO producto_trigrama(producto_trigrama, rowid, texto_busqueda)
+        VALUES ('delete', old.id, old.texto_busqueda);
+        INSERT INTO producto_trigrama(rowid, texto_busqueda) VALUES (new.id, new.texto_busqueda);
+    END
+    """
+]
+
+INDICES_BUSQUEDA = {
+    'producto_fts': FTS_PRODUCTO_DDL,
+    'producto_trigrama': TRIGRAMA_PRODUCTO_DDL
+}
+
+producto_fts = table('producto_fts')
+
+def crear_indice_busqueda(connection):
+    """Crear (si no existen) y poblar los índices FTS5 de productos"""
+    for tabla, ddl in INDICES_BUSQUEDA.items():
+        existia = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :tabla"
+        ), {'tabla': tabla}).first()
+        
+        for sentencia in ddl:
+            connection.execute(text(sentencia))
+        
+        if not existia:
+            # Indexar filas que existían antes de crear la tabla virtual
+            connection.execute(text(f"INSERT INTO {tabla}({tabla}) VALUES ('rebuild')"))
+
+def migrar_texto_busqueda(connection):
+    """Agregar y poblar producto.texto_busqueda en bases creadas sin la columna"""
+    columnas = [fila[1] for fila in connection.execute(text("PRAGMA table_info(producto)"))]
+    if 'texto_busqueda' in columnas:
+        return
+    
+    connection.execute(text("ALTER TABLE producto ADD COLUMN texto_busqueda TEXT"))
+    filas = connection.execute(text("SELECT id, nombre, descripcion FROM producto")).all()
+    if filas:
+        connection.execute(
+            text("UPDATE producto SET texto_busqueda = :texto WHERE id = :id"),
+            [{'id': fila.id, 'texto': texto_busqueda_producto(fila.nombre, fila.descripcion)} for fila in filas]
+        )
+
+def migrar_indice_conversion(connection):
+    """Crear el índice único de pares de conversión en bases que no lo tienen
+    
+    Antes elimina duplicados de un mismo par, conservando el registro más reciente.
+    """
+    connection.execute(text("""
+        DELETE FROM conversion_moneda WHERE id NOT IN (
+            SELECT MAX(id) FROM conversion_moneda
+            GROUP BY moneda_origen, moneda_destino, activa
+        )
+    """))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_conversion_moneda_par "
+        "ON conversion_moneda (moneda_origen, moneda_destino, activa)"
+    ))
+
+# Versión del esquema guardada en PRAGMA user_version (SQLite). La versión 1
+# guarda montos en centavos y tasas con 9 decimales como enteros; la 2 además
+# declara esas columnas INTEGER, porque con la afinidad REAL de las columnas
+# FLOAT originales SQLite vuelve a guardar los enteros como REAL.
+VERSION_ESQUEMA = 2
+
+COLUMNAS_PUNTO_FIJO = [
+    ('producto', 'precio', Dinero.ESCALA_MONTO),
+    ('transaccion_pago', 'monto', Dinero.ESCALA_MONTO),
+    ('conversion_moneda', 'tasa_cambio', Dinero.ESCALA_TASA),
+    ('historial_cotizacion', 'valor', Dinero.ESCALA_TASA)
+]
+
+def reconstruir_tabla(connection, tabla, conversiones):
+    """Reconstruir una tabla SQLite con el esquema actual del modelo
+    
+    SQLite no permite cambiar el tipo (la afinidad) de una columna: se crea
+    la tabla nueva, se copian las filas aplicando ``conversiones``
+    ({columna: expresión SQL}), se borra la anterior y se renombra la nueva.
+    Los índices del modelo se vuelven a crear; los triggers de búsqueda los
+    recrea crear_indice_busqueda.
+    """
+    modelo = db.metadata.tables[tabla]
+    temporal = f'_nueva_{tabla}'
+    
+    ddl = str(CreateTable(modelo).compile(dialect=connection.dialect))
+    connection.execute(text(ddl.replace(f'CREATE TABLE {tabla} ', f'CREATE TABLE {temporal} ', 1)))
+    
+    existentes = {fila[1] for fila in connection.execute(text(f"PRAGMA table_info({tabla})"))}
+    columnas = [columna.name for columna in modelo.columns if columna.name in existentes]
+    connection.execute(text(
+        f"INSERT INTO {temporal} ({', '.join(columnas)}) "
+        f"SELECT {', '.join(conversiones.get(columna, columna) for columna in columnas)} FROM {tabla}"
+    ))
+    
+    connection.execute(text(f"DROP TABLE {tabla}"))
+    connection.execute(text(f"ALTER TABLE {temporal} RENAME TO {tabla}"))
+    for indice in modelo.indexes:
+        indice.create(connection)
+
+def migrar_punto_fijo(connection):
+    """Pasar montos y tasas guardados como REAL a enteros escalados en columnas INTEGER"""
+    version = connection.execute(text("PRAGMA user_version")).scalar()
+    if version >= VERSION_ESQUEMA:
+        return
+    
+    conversiones = {}
+    for tabla, columna, escala in COLUMNAS_PUNTO_FIJO:
+        # Versión 0: valores decimales; versión 1: ya escalados, quizás como REAL
+        escalado = f"{columna} * {escala}" if version < 1 else columna
+        conversiones.setdefault(tabla, {})[columna] = f"CAST(ROUND({escalado}) AS INTEGER)"
+    
+    for tabla, columnas in conversiones.items():
+        tipos = {fila[1]: fila[2].upper() for fila in connection.execute(text(f"PRAGMA table_info({tabla})"))}
+        if all('INT' in tipos.get(columna, 'INT') for columna in columnas):
+            asignaciones = ', '.join(f"{columna} = {expresion}" for columna, expresion in columnas.items())
+            connection.execute(text(f"UPDATE {tabla} SET {asignaciones}"))
+        else:
+            reconstruir_tabla(connection, tabla, columnas)
+    
+    connection.execute(text(f"PRAGMA user_version = {VERSION_ESQUEMA}"))
+
+def migrar_esquema(connection):
+    """Llevar una base SQLite existente al esquema actual (idempotente)"""
+    migrar_texto_busqueda(connection)
+    migrar_indice_conversion(connection)
+    migrar_punto_fijo(connection)
+    crear_indice_busqueda(connection)
+
+def texto_busqueda_producto(nombre, descripcion):
+    """Texto normalizado que alimenta el índice de trigramas"""
+    return normalizar_texto(f"{nombre or ''} {descripcion or ''}")
+
+@event.listens_for(Producto, 'before_insert')
+@event.listens_for(Producto, 'before_update')
+def _actualizar_texto_busqueda(mapper, connection, target):
+    target.texto_busqueda = texto_busqueda_producto(target.nombre, target.descripcion)
+
+@event.listens_for(Producto.__table__, 'after_create')
+def _crear_indice_busqueda(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        crear_indice_busqueda(connection)
+        # Una tabla nueva ya nace con el esquema actual (no hay nada que migrar)
+        connection.execute(text(f"PRAGMA user_version = {VERSION_ESQUEMA}"))
+
+@event.listens_for(Producto.__table__, 'before_drop')
+def _eliminar_indice_busqueda(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for tabla in INDICES_BUSQUEDA:
+            connection.execute(text(f"DROP TABLE IF EXISTS {tabla}"))
+
 # Servicios de negocio
 class ProductoService:
     """Servicio para gestión de productos"""
     
+    LIMITE_PAGINA_DEFECTO = 50
+    LIMITE_PAGINA_MAXIMO = 500
+    
+    # Sincronización masiva de stock: items por transacción
+    TAMANO_LOTE_STOCK = 1000
+    TAMANO_LOTE_STOCK_MAXIMO = 10000
+    
+    # Búsqueda aproximada: fracción mínima de trigramas compartidos y
+    # cantidad de candidatos que se piden al índice antes de puntuar
+    UMBRAL_SIMILITUD = 0.5
+    CANDIDATOS_SIMILITUD = 200
+    
     @staticmethod
     def crear_producto(data):
         """Crear un nuevo producto"""
@@ -223,18 +748,182 @@ class ProductoService:
         
         return producto
     
+    @staticmethod
+    def construir_consulta_fts(buscar):
+        """Convertir el texto de búsqueda en una consulta FTS5 por prefijos
+        
+        Cada término se cita (para neutralizar la sintaxis de FTS5) y se marca
+        como prefijo, así "tala ele" encuentra "Taladro Eléctrico".
+        """
+        terminos = re.findall(r'\w+', buscar)
+        return ' '.join(f'"{termino}"*' for termino in terminos)
+    
+    @staticmethod
+    def ids_busqueda(buscar):
+        """Obtener los IDs de productos que coinciden con la búsqueda, por relevancia"""
+        query = ProductoService.filtrar_busqueda(
+            Producto.query.with_entities(Producto.id), buscar, ordenar_por_relevancia=True
+        )
+        return [fila.id for fila in query]
+    
+    @staticmethod
+    def trigramas(texto):
+        """Trigramas de cada palabra, con relleno de bordes como pg_trgm"""
+        resultado = set()
+        for palabra in texto.split():
+            relleno = f'  {palabra} '
+            resultado.update(relleno[i:i + 3] for i in range(len(relleno) - 2))
+        return resultado
+    
+    @staticmethod
+    def ids_similares(buscar):
+        """Obtener IDs de productos parecidos al texto, del más al menos similar
+        
+        El índice de trigramas entrega candidatos que comparten algún trigrama
+        con la búsqueda; luego se puntúa cada uno por la fracción de trigramas
+        de la búsqueda presentes en su texto normalizado.
+        """
+        normalizado = ' '.join(re.findall(r'\w+', normalizar_texto(buscar)))
+        internos = {
+            termino[i:i + 3]
+            for termino in normalizado.split()
+            for i in range(len(termino) - 2)
+        }
+        if not internos:
+            return []
+        
+        filas = db.session.execute(text("""
+            SELECT producto.id, producto.texto_busqueda
+            FROM producto_trigrama JOIN producto ON producto.id = producto_trigrama.rowid
+            WHERE producto_trigrama MATCH :consulta
+            ORDER BY bm25(producto_trigrama)
+            LIMIT :candidatos
+        """), {
+            'consulta': ' OR '.join(f'"{trigrama}"' for trigrama in sorted(internos)),
+            'candidatos': ProductoService.CANDIDATOS_SIMILITUD
+        })
+        
+        buscados = ProductoService.trigramas(normalizado)
+        puntajes = []
+        for fila in filas:
+            compartidos = len(buscados & ProductoService.trigramas(fila.texto_busqueda or ''))
+            puntaje = compartidos / len(buscados)
+            if puntaje >= ProductoService.UMBRAL_SIMILITUD:
+                puntajes.append((-puntaje, fila.id))
+        
+        return [producto_id for _, producto_id in sorted(puntajes)]
+    
+    @staticmethod
+    def filtrar_busqueda(query, buscar, ordenar_por_relevancia=False):
+        """Aplicar el filtro de búsqueda por nombre/descripción a una consulta
+        
+        En SQLite usa el índice FTS5 por prefijos (opcionalmente ordenando por
+        bm25) y, si no hay coincidencias, el índice de trigramas para tolerar
+        subcadenas y errores de tipeo. En otros motores, o si el texto no tiene
+        términos indexables, usa LIKE.
+        """
+        consulta_fts = ProductoService.construir_consulta_fts(buscar)
+        
+        if db.engine.dialect.name != 'sqlite' or not consulta_fts:
+            return query.filter(
+                Producto.nombre.contains(buscar) | 
+                Producto.descripcion.contains(buscar)
+            )
+        
+        coincide = literal_column('producto_fts').op('MATCH')(consulta_fts)
+        hay_coincidencias = db.session.execute(
+            select(literal_column('rowid')).select_from(producto_fts).where(coincide).limit(1)
+        ).first()
+        
+        if not hay_coincidencias:
+            ids = ProductoService.ids_similares(buscar)
+            query = query.filter(Producto.id.in_(ids))
+            if ordenar_por_relevancia and ids:
+                query = query.order_by(case({producto_id: i for i, producto_id in enumerate(ids)}, value=Producto.id))
+            return query
+        
+        coincidencias = select(
+            literal_column('rowid').label('producto_id'),
+            func.bm25(literal_column('producto_fts')).label('rango')
+        ).select_from(producto_fts).where(coincide).subquery()
+        
+        query = query.join(coincidencias, Producto.id == coincidencias.c.producto_id)
+        
+        if ordenar_por_relevancia:
+            query = query.order_by(coincidencias.c.rango)
+        
+        return query
+    
+    @staticmethod
+    def consultar_productos(buscar=None):
+        """Construir la consulta de productos con búsqueda opcional (ordenada por relevancia)"""
+        query = Producto.query
+        
+        if buscar:
+            query = ProductoService.filtrar_busqueda(query, buscar, ordenar_por_relevancia=True)
+        
+        return query
+    
     @staticmethod
     def obtener_productos(buscar=None):
         """Obtener lista de productos con búsqueda opcional"""
+        return ProductoService.consultar_productos(buscar).all()
+    
+    @staticmethod
+    def codificar_cursor(producto_id):
+        """Codificar el último ID entregado como cursor opaco"""
+        return base64.urlsafe_b64encode(str(producto_id).encode()).decode().rstrip('=')
+    
+    @staticmethod
+    def decodificar_cursor(cursor):
+        """Decodificar un cursor opaco al ID del último producto entregado"""
+        try:
+            relleno = '=' * (-len(cursor) % 4)
+            producto_id = int(base64.urlsafe_b64decode(cursor + relleno).decode())
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Cursor inválido")
+        
+        if producto_id < 0:
+            raise ValueError("Cursor inválido")
+        
+        return producto_id
+    
+    @staticmethod
+    def obtener_pagina_productos(buscar=None, after_id=None, limit=None, columnas=None):
+        """Obtener una página de productos usando paginación por cursor (keyset)
+        
+        Filtra por ``id > after_id`` y ordena por la clave primaria, de modo que
+        cada página usa el índice y cuesta lo mismo sin importar su profundidad.
+        Con ``columnas`` devuelve filas simples en lugar de instancias del ORM.
+        """
+        if limit is None:
+            limit = ProductoService.LIMITE_PAGINA_DEFECTO
+        
+        if limit <= 0:
+            raise ValueError("El límite debe ser mayor a 0")
+        
+        limit = min(limit, ProductoService.LIMITE_PAGINA_MAXIMO)
+        
         query = Producto.query
         
         if buscar:
-            query = query.filter(
-                Producto.nombre.contains(buscar) | 
-                Producto.descripcion.contains(buscar)
-            )
+            query = ProductoService.filtrar_busqueda(query, buscar)
+        
+        if after_id is not None:
+            query = query.filter(Producto.id > after_id)
         
-        return query.all()
+        if columnas:
+            query = query.with_entities(*columnas)
+        
+        # Se pide un registro extra para saber si existe una página siguiente
+        productos = query.order_by(Producto.id).limit(limit + 1).all()
+        
+        next_cursor = None
+        if len(productos) > limit:
+            productos = productos[:limit]
+            next_cursor = ProductoService.codificar_cursor(productos[-1].id)
+        
+        return productos, next_cursor
     
     @staticmethod
     def obtener_producto_por_id(producto_id):
@@ -243,18 +932,265 @@ class ProductoService:
     
     @staticmethod
     def actualizar_stock(producto_id, cantidad):
-        """Actualizar stock de un producto"""
-        producto = Producto.query.get(producto_id)
-        if not producto:
+        """Actualizar stock de un producto
+        
+        El stock no puede quedar por debajo de lo reservado por pagos WebPay
+        en curso (subirlo siempre se acepta). El bloqueo de escritura se toma
+        antes de leer las reservas, así no cambian hasta el commit.
+        """
+        CatalogoService.incrementar_version(db.session)
+        estado = ReservaStockService.disponibles([producto_id]).get(producto_id)
+        if estado is None:
+            db.session.rollback()
             raise ValueError("Producto no encontrado")
         
         if cantidad < 0:
+            db.session.rollback()
             raise ValueError("La cantidad no puede ser negativa")
         
+        if cantidad < min(estado['stock'], estado['reservado']):
+            db.session.rollback()
+            raise ValueError(f"La cantidad no puede ser menor a lo reservado ({estado['reservado']})")
+        
+        producto = db.session.get(Producto, producto_id)
         producto.stock = cantidad
         db.session.commit()
         
         return producto
+    
+    @staticmethod
+    def ajustar_stock(producto_id, delta, tipo='ajuste', pedido_id=None, transaccion_id=None, detalle=None):
+        """Sumar ``delta`` al stock con un único UPDATE condicional
+        
+        La suma la hace la BD (stock = stock + delta) sólo si el resultado no
+        queda negativo, así dos ventas simultáneas no se pisan. Ninguna
+        salida (venta, ajuste o transferencia) puede tomar unidades
+        reservadas por pagos WebPay en curso.
+        Sólo si no se actualizó ninguna fila se consulta el producto para
+        informar el motivo. El movimiento queda en el libro de stock en la
+        misma transacción.
+        """
+        if not isinstance(delta, int) or isinstance(delta, bool):
+            raise ValueError("El delta debe ser un entero")
+        MovimientoStockService.validar_tipo(tipo)
+        
+        minimo = ReservaStockService.reservado(datetime.utcnow()) if delta < 0 else 0
+        sentencia = (
+            update(Producto)
+            .where(Producto.id == producto_id, Producto.stock + delta >= minimo)
+            .values(stock=Producto.stock + delta)
+            .returning(Producto.stock)
+        )
+        stock = db.session.execute(sentencia).scalar()
+        
+        if stock is None:
+            db.session.rollback()
+            estado = ReservaStockService.disponibles([producto_id]).get(producto_id)
+            if estado is None:
+                raise ValueError("Producto no encontrado")
+            raise ValueError(f"Stock insuficiente (disponible: {estado['disponible']})")
+        
+        MovimientoStockService.registrar(db.session.connection(), [{
+            'producto_id': producto_id,
+            'tipo': tipo,
+            'cantidad': delta,
+            'pedido_id': pedido_id,
+            'transaccion_id': transaccion_id,
+            'detalle': detalle
+        }])
+        db.session.commit()
+        
+        # El UPDATE no pasa por los eventos de sesión: avisar al catálogo
+        CatalogoService.aplicar_stock({producto_id: stock})
+        
+        return {'id': producto_id, 'stock': stock, 'delta': delta}
+    
+    @staticmethod
+    def validar_item_stock(item):
+        """Devolver el mensaje de error de un item de sincronización, o None"""
+        if not isinstance(item, dict) or 'producto_id' not in item:
+            return 'producto_id es requerido'
+        if ('cantidad' in item) == ('delta' in item):
+            return 'Se requiere cantidad o delta (sólo uno)'
+        
+        valor = item.get('cantidad', item.get('delta'))
+        if not isinstance(valor, int) or isinstance(valor, bool) or not isinstance(item['producto_id'], int):
+            return 'producto_id y cantidad/delta deben ser enteros'
+        if 'cantidad' in item and valor < 0:
+            return 'La cantidad no puede ser negativa'
+        return None
+    
+    @staticmethod
+    def sincronizar_stock(items, tamano_lote=None):
+        """Aplicar muchos ``{producto_id, cantidad|delta}`` en lotes, en una sola transacción
+        
+        Antes de leer se toma el bloqueo de escritura (la versión del
+        catálogo), así el stock leído no cambia hasta el commit. Por lote: un
+        SELECT del stock y lo reservado de los productos involucrados
+        (bloqueados en motores que soportan FOR UPDATE), el cálculo de cada
+        item en orden y un único UPDATE ejecutado con executemany. Ningún
+        item deja el stock por debajo de lo reservado por pagos WebPay en
+        curso. Un error inesperado revierte la sincronización completa.
+        Devuelve un resultado por item, en el orden de entrada.
+        """
+        tamano_lote = min(tamano_lote or ProductoService.TAMANO_LOTE_STOCK, ProductoService.TAMANO_LOTE_STOCK_MAXIMO)
+        resultados = [None] * len(items)
+        ahora = datetime.utcnow()
+        modificados = {}
+        
+        try:
+            CatalogoService.incrementar_version(db.session)
+            
+            for inicio in range(0, len(items), tamano_lote):
+                lote = range(inicio, min(inicio + tamano_lote, len(items)))
+                validos = []
+                for indice in lote:
+                    error = ProductoService.validar_item_stock(items[indice])
+                    if error:
+                        resultados[indice] = {'error': error}
+                    else:
+                        validos.append(indice)
+                
+                ids = {items[indice]['producto_id'] for indice in validos}
+                if not ids:
+                    continue
+                
+                filas = db.session.execute(
+                    select(Producto.id, Producto.stock, ReservaStockService.reservado(ahora))
+                    .where(Producto.id.in_(ids)).with_for_update()
+                ).all()
+                stocks = {producto_id: stock for producto_id, stock, _ in filas}
+                reservados = {producto_id: reservado for producto_id, _, reservado in filas}
+                
+                cambios_lote = {}
+                movimientos = []
+                for indice in validos:
+                    item = items[indice]
+                    producto_id = item['producto_id']
+                    if producto_id not in stocks:
+                        resultados[indice] = {'producto_id': producto_id, 'error': 'Producto no encontrado'}
+                        continue
+                    
+                    stock, reservado = stocks[producto_id], reservados[producto_id]
+                    nuevo = item['cantidad'] if 'cantidad' in item else stock + item['delta']
+                    # Nunca por debajo de cero ni de lo reservado (subir siempre se acepta)
+                    if nuevo < min(stock, reservado) or nuevo < 0:
+                        if 'cantidad' in item:
+                            error = f'La cantidad no puede ser menor a lo reservado ({reservado})'
+                        else:
+                            error = f'Stock insuficiente (disponible: {stock - reservado})'
+                        resultados[indice] = {'producto_id': producto_id, 'error': error}
+                        continue
+                    
+                    if nuevo != stock:
+                        movimientos.append({
+                            'producto_id': producto_id,
+                            'tipo': 'ajuste',
+                            'cantidad': nuevo - stock,
+                            'detalle': 'Sincronización de stock'
+                        })
+                    stocks[producto_id] = cambios_lote[producto_id] = nuevo
+                    resultados[indice] = {'producto_id': producto_id, 'stock': nuevo}
+                
+                if cambios_lote:
+                    # UPDATE masivo por clave primaria: una sentencia con executemany
+                    db.session.execute(
+                        update(Producto),
+                        [{'id': producto_id, 'stock': stock} for producto_id, stock in cambios_lote.items()]
+                    )
+                    MovimientoStockService.registrar(db.session.connection(), movimientos)
+                    modificados.update(cambios_lote)
+            
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        
+        CatalogoService.aplicar_stock(modificados)
+        return resultados
+
+class MovimientoStockService:
+    """Libro de movimientos de stock y consultas de stock a una fecha
+    
+    Cada cambio de stock agrega una fila con la cantidad con signo. La
+    compactación periódica guarda por producto el stock acumulado hasta su
+    último movimiento, así el stock a una fecha es el snapshot anterior más
+    la suma de los pocos movimientos posteriores (rango por índice).
+    """
+    
+    TIPOS = ('inicial', 'venta', 'transferencia', 'ajuste')
+    
+    @staticmethod
+    def validar_tipo(tipo):
+        if tipo not in MovimientoStockService.TIPOS:
+            raise ValueError(f"Tipo de movimiento no válido (use: {', '.join(MovimientoStockService.TIPOS)})")
+    
+    @staticmethod
+    def registrar(connection, movimientos):
+        """Insertar movimientos (lista de dicts) en una sentencia executemany"""
+        if movimientos:
+            comunes = {'pedido_id': None, 'transaccion_id': None, 'detalle': None, 'fecha': datetime.utcnow()}
+            connection.execute(
+                MovimientoStock.__table__.insert(),
+                [{**comunes, **movimiento} for movimiento in movimientos]
+            )
+    
+    @staticmethod
+    def compactar():
+        """Guardar un snapshot por cada producto con movimientos nuevos
+        
+        Un solo INSERT ... SELECT suma, por producto, los movimientos
+        posteriores a su último snapshot. Devuelve la cantidad de snapshots.
+        """
+        resultado = db.session.execute(text("""
+            INSERT INTO snapshot_stock (producto_id, stock, hasta_movimiento_id, fecha)
+            SELECT m.producto_id, COALESCE(s.stock, 0) + SUM(m.cantidad), MAX(m.id), MAX(m.fecha)
+            FROM movimiento_stock m
+            LEFT JOIN snapshot_stock s ON s.producto_id = m.producto_id AND s.hasta_movimiento_id = (
+                SELECT MAX(hasta_movimiento_id) FROM snapshot_stock WHERE producto_id = m.producto_id
+            )
+            WHERE m.id > COALESCE(s.hasta_movimiento_id, 0)
+            GROUP BY m.producto_id, s.stock
+        """))
+        db.session.commit()
+        return resultado.rowcount
+    
+    @staticmethod
+    def stock_a_la_fecha(producto_id, fecha):
+        """Stock de un producto en ``fecha``: snapshot anterior + movimientos posteriores
+        
+        Devuelve None si el producto no existe.
+        """
+        if fecha.tzinfo is not None:
+            fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+        
+        if db.session.execute(select(Producto.id).where(Producto.id == producto_id)).first() is None:
+            return None
+        
+        snapshot = db.session.execute(
+            select(SnapshotStock.stock, SnapshotStock.hasta_movimiento_id, SnapshotStock.fecha)
+            .where(SnapshotStock.producto_id == producto_id, SnapshotStock.fecha <= fecha)
+            .order_by(SnapshotStock.fecha.desc(), SnapshotStock.id.desc())
+            .limit(1)
+        ).first()
+        base, hasta = (snapshot.stock, snapshot.hasta_movimiento_id) if snapshot else (0, 0)
+        
+        suma, cantidad = db.session.execute(
+            select(func.coalesce(func.sum(MovimientoStock.cantidad), 0), func.count(MovimientoStock.id))
+            .where(
+                MovimientoStock.producto_id == producto_id,
+                MovimientoStock.id > hasta,
+                MovimientoStock.fecha <= fecha
+            )
+        ).one()
+        
+        return {
+            'producto_id': producto_id,
+            'fecha': fecha.isoformat(),
+            'stock': base + suma,
+            'fecha_snapshot': snapshot.fecha.isoformat() if snapshot else None,
+            'movimientos_aplicados': cantidad
+        }
 
 class PedidoSucursalService:
     """Servicio para gestión de pedidos entre sucursales"""
@@ -339,157 +1275,1826 @@ class PedidoSucursalService:
         db.session.commit()
         return pedido
 
-class WebPayService:
-    """Servicio para integración con WebPay (simulado)"""
+class InventarioService:
+    """Servicio para el inventario por sucursal"""
+    
+    MAXIMO_PRODUCTOS_DISPONIBILIDAD = 1000
     
     @staticmethod
-    def iniciar_transaccion(monto, cliente_id=None, detalle=""):
-        """Iniciar una transacción de pago"""
-        if not monto or monto <= 0:
-            raise ValueError("El monto debe ser mayor a 0")
-        
-        # Generar token único para la transacción
-        token = str(uuid.uuid4())
-        
-        # Crear registro de transacción
-        transaccion = TransaccionPago(
-            token_transaccion=token,
-            monto=monto,
-            cliente_id=cliente_id,
-            detalle=detalle
+    def actualizar_inventario(sucursal_id, items):
+        """Fijar el stock de varios productos en una sucursal con un solo upsert"""
+        if db.session.get(Sucursal, sucursal_id) is None:
+            raise ValueError("Sucursal no encontrada")
+        
+        if not isinstance(items, list) or not items:
+            raise ValueError("Se requiere una lista de items")
+        
+        stocks = {}
+        for item in items:
+            if not isinstance(item, dict) or not all(k in item for k in ['producto_id', 'stock']):
+                raise ValueError("Cada item requiere producto_id y stock")
+            if not isinstance(item['stock'], int) or isinstance(item['stock'], bool) or item['stock'] < 0:
+                raise ValueError("El stock debe ser un entero no negativo")
+            stocks[item['producto_id']] = item['stock']
+        
+        existentes = set(db.session.execute(select(Producto.id).where(Producto.id.in_(stocks))).scalars())
+        faltantes = [producto_id for producto_id in stocks if producto_id not in existentes]
+        if faltantes:
+            raise ValueError(f"Productos no encontrados: {', '.join(map(str, faltantes))}")
+        
+        fecha = datetime.utcnow()
+        dialecto = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+        sentencia = dialecto.insert(InventarioSucursal).values([
+            {'sucursal_id': sucursal_id, 'producto_id': producto_id, 'stock': stock, 'fecha_actualizacion': fecha}
+            for producto_id, stock in stocks.items()
+        ])
+        sentencia = sentencia.on_conflict_do_update(
+            index_elements=['sucursal_id', 'producto_id'],
+            set_={
+                'stock': sentencia.excluded.stock,
+                'fecha_actualizacion': sentencia.excluded.fecha_actualizacion
+            }
         )
-        
-        db.session.add(transaccion)
+        db.session.execute(sentencia)
         db.session.commit()
         
-        # Simular respuesta de WebPay
+        return [{'sucursal_id': sucursal_id, 'producto_id': producto_id, 'stock': stock} for producto_id, stock in stocks.items()]
+    
+    @staticmethod
+    def disponibilidad(cantidades, solo_activas=True):
+        """Sucursales con stock suficiente para cada producto, en una consulta
+        
+        ``cantidades`` es {producto_id: cantidad mínima}. Cada condición
+        (producto_id = X AND stock >= N) es un rango del índice
+        (producto_id, stock, sucursal_id).
+        """
+        if not cantidades:
+            raise ValueError("Se requiere al menos un producto")
+        if len(cantidades) > InventarioService.MAXIMO_PRODUCTOS_DISPONIBILIDAD:
+            raise ValueError(f"No se pueden consultar más de {InventarioService.MAXIMO_PRODUCTOS_DISPONIBILIDAD} productos")
+        
+        query = (
+            select(InventarioSucursal.producto_id, InventarioSucursal.sucursal_id, InventarioSucursal.stock, Sucursal.nombre)
+            .join(Sucursal, Sucursal.id == InventarioSucursal.sucursal_id)
+            .where(or_(*[
+                and_(InventarioSucursal.producto_id == producto_id, InventarioSucursal.stock >= cantidad)
+                for producto_id, cantidad in cantidades.items()
+            ]))
+            .order_by(InventarioSucursal.producto_id, InventarioSucursal.stock.desc())
+        )
+        if solo_activas:
+            query = query.where(Sucursal.activa == True)
+        
+        por_producto = {producto_id: [] for producto_id in cantidades}
+        for fila in db.session.execute(query):
+            por_producto[fila.producto_id].append({
+                'sucursal_id': fila.sucursal_id,
+                'sucursal': fila.nombre,
+                'stock': fila.stock
+            })
+        
+        return [
+            {'producto_id': producto_id, 'cantidad': cantidades[producto_id], 'sucursales': sucursales}
+            for producto_id, sucursales in por_producto.items()
+        ]
+
+class ReservaStockService:
+    """Reservas de stock con vencimiento para pagos WebPay en curso
+    
+    Al iniciar un pago se apartan las unidades compradas; el disponible para
+    vender es el stock menos las reservas vigentes. Los vencimientos de las
+    reservas creadas por el proceso se guardan en un heap, así liberar las
+    vencidas sólo mira la cabeza del heap en lugar de recorrer la tabla. Las
+    consultas filtran por ``expira_en``, por lo que una reserva vencida deja
+    de contar aunque todavía no se haya liberado.
+    """
+    
+    TTL_RESERVA_SEGUNDOS = 600
+    
+    _lock = threading.Lock()
+    _vencimientos = None  # heap de (expira_en, transaccion_id); None hasta cargarlo de la BD
+    
+    @staticmethod
+    def reservado(ahora, producto_id=Producto.id):
+        """Subconsulta con las unidades reservadas vigentes de un producto"""
+        return (
+            select(func.coalesce(func.sum(ReservaStock.cantidad), 0))
+            .where(ReservaStock.producto_id == producto_id, ReservaStock.expira_en > ahora)
+            .scalar_subquery()
+        )
+    
+    @staticmethod
+    def validar_items(items):
+        """Normalizar ``[{producto_id, cantidad}]`` a {producto_id: cantidad}"""
+        if not isinstance(items, list) or not items:
+            raise ValueError("Se requiere una lista de items")
+        
+        cantidades = {}
+        for item in items:
+            if not isinstance(item, dict) or 'producto_id' not in item or 'cantidad' not in item:
+                raise ValueError("Cada item requiere producto_id y cantidad")
+            producto_id, cantidad = item['producto_id'], item['cantidad']
+            if not all(isinstance(valor, int) and not isinstance(valor, bool) for valor in (producto_id, cantidad)):
+                raise ValueError("producto_id y cantidad deben ser enteros")
+            if cantidad <= 0:
+                raise ValueError("La cantidad debe ser mayor a 0")
+            cantidades[producto_id] = cantidades.get(producto_id, 0) + cantidad
+        return cantidades
+    
+    @staticmethod
+    def disponibles(productos_ids, ahora=None):
+        """{producto_id: {stock, reservado, disponible}} en una sola consulta"""
+        reservado = ReservaStockService.reservado(ahora or datetime.utcnow()).label('reservado')
+        filas = db.session.execute(
+            select(Producto.id, Producto.stock, reservado).where(Producto.id.in_(list(productos_ids)))
+        )
         return {
-            'token': token,
-            'url_pago': f'https://webpay-simulator.com/pay/{token}',
-            'monto': monto,
-            'estado': 'iniciada'
+            producto_id: {'stock': stock, 'reservado': reservado, 'disponible': stock - reservado}
+            for producto_id, stock, reservado in filas
+        }
+    
+    @staticmethod
+    def reservar(transaccion_id, items, ahora=None):
+        """Apartar las unidades de ``items`` para la transacción (sin commit)
+        
+        Cada reserva es un INSERT ... SELECT que sólo inserta si el stock menos
+        lo ya reservado alcanza, así dos pagos simultáneos no pueden apartar
+        las mismas unidades. Devuelve el vencimiento de las reservas.
+        """
+        cantidades = ReservaStockService.validar_items(items)
+        ahora = ahora or datetime.utcnow()
+        expira_en = ahora + timedelta(seconds=ReservaStockService.TTL_RESERVA_SEGUNDOS)
+        
+        for producto_id, cantidad in cantidades.items():
+            origen = select(
+                literal(transaccion_id), Producto.id, literal(cantidad), literal(expira_en, db.DateTime)
+            ).where(
+                Producto.id == producto_id,
+                Producto.stock - ReservaStockService.reservado(ahora) >= cantidad
+            )
+            resultado = db.session.execute(
+                insert(ReservaStock).from_select(['transaccion_id', 'producto_id', 'cantidad', 'expira_en'], origen)
+            )
+            if resultado.rowcount == 0:
+                db.session.rollback()
+                estado = ReservaStockService.disponibles([producto_id], ahora).get(producto_id)
+                if estado is None:
+                    raise ValueError(f"Producto {producto_id} no encontrado")
+                raise ValueError(f"Stock insuficiente para el producto {producto_id} (disponible: {estado['disponible']})")
+        
+        return expira_en
+    
+    @staticmethod
+    def programar(transaccion_id, expira_en):
+        """Registrar el vencimiento de una reserva ya confirmada en la BD"""
+        with ReservaStockService._lock:
+            if ReservaStockService._vencimientos is not None:
+                heapq.heappush(ReservaStockService._vencimientos, (expira_en, transaccion_id))
+    
+    @staticmethod
+    def _cargar():
+        """Armar el heap con las reservas guardadas (una vez por proceso, con el lock tomado)"""
+        filas = db.session.execute(
+            select(func.min(ReservaStock.expira_en), ReservaStock.transaccion_id).group_by(ReservaStock.transaccion_id)
+        ).all()
+        vencimientos = [tuple(fila) for fila in filas]
+        heapq.heapify(vencimientos)
+        ReservaStockService._vencimientos = vencimientos
+    
+    @staticmethod
+    def liberar(transaccion_ids, ahora):
+        """Marcar como expiradas las transacciones aún iniciadas y borrar sus reservas (sin commit)"""
+        db.session.execute(
+            update(TransaccionPago)
+            .where(TransaccionPago.id.in_(transaccion_ids), TransaccionPago.estado == 'iniciada')
+            .values(estado='expirada', fecha_actualizacion=ahora)
+        )
+        db.session.execute(delete(ReservaStock).where(ReservaStock.transaccion_id.in_(transaccion_ids)))
+    
+    @staticmethod
+    def liberar_vencidas(ahora=None):
+        """Liberar las reservas cuyo vencimiento ya pasó; devuelve cuántas transacciones expiraron
+        
+        Sólo saca del heap las entradas vencidas (O(k log n)); las de
+        transacciones ya confirmadas no encuentran nada que liberar.
+        """
+        ahora = ahora or datetime.utcnow()
+        with ReservaStockService._lock:
+            if ReservaStockService._vencimientos is None:
+                ReservaStockService._cargar()
+            vencimientos = ReservaStockService._vencimientos
+            transaccion_ids = []
+            while vencimientos and vencimientos[0][0] <= ahora:
+                transaccion_ids.append(heapq.heappop(vencimientos)[1])
+        
+        if not transaccion_ids:
+            return 0
+        
+        ReservaStockService.liberar(transaccion_ids, ahora)
+        db.session.commit()
+        return len(transaccion_ids)
+    
+    @staticmethod
+    def convertir(transaccion):
+        """Descontar del stock las unidades reservadas por una transacción aprobada (sin commit)
+        
+        Las demás salidas de stock no bajan de lo reservado, así que las
+        unidades siguen ahí. Devuelve {producto_id: stock} para avisar al
+        catálogo tras el commit.
+        """
+        reservas = db.session.execute(
+            select(ReservaStock.producto_id, ReservaStock.cantidad)
+            .where(ReservaStock.transaccion_id == transaccion.id)
+        ).all()
+        db.session.execute(delete(ReservaStock).where(ReservaStock.transaccion_id == transaccion.id))
+        
+        stocks = {}
+        for producto_id, cantidad in reservas:
+            stock = db.session.execute(
+                update(Producto)
+                .where(Producto.id == producto_id, Producto.stock >= cantidad)
+                .values(stock=Producto.stock - cantidad)
+                .returning(Producto.stock)
+            ).scalar()
+            if stock is None:
+                db.session.rollback()
+                raise ValueError(f"Stock insuficiente para el producto {producto_id}")
+            stocks[producto_id] = stock
+        
+        MovimientoStockService.registrar(db.session.connection(), [{
+            'producto_id': producto_id,
+            'tipo': 'venta',
+            'cantidad': -cantidad,
+            'transaccion_id': transaccion.id,
+            'detalle': f'Pago WebPay {transaccion.token_transaccion}'
+        } for producto_id, cantidad in reservas])
+        
+        return stocks
+    
+    @staticmethod
+    def invalidar():
+        with ReservaStockService._lock:
+            ReservaStockService._vencimientos = None
+
+class WebPayService:
+    """Servicio para integración con WebPay (simulado)"""
+    
+    # WebPay cobra en pesos chilenos
+    MONEDA_COBRO = 'CLP'
+    
+    @staticmethod
+    def iniciar_transaccion(monto=None, cliente_id=None, detalle="", cotizacion=None, items=None):
+        """Iniciar una transacción de pago
+        
+        Con ``cotizacion`` (token de CotizacionService) se cobra el monto
+        convertido a la tasa bloqueada, sin volver a convertir. El token se
+        consume en el mismo commit que la transacción y sus reservas: si
+        algo falla antes, sigue disponible para reintentar.
+        
+        Con ``items`` ([{producto_id, cantidad}]) las unidades quedan
+        reservadas hasta confirmar el pago o hasta que venza la reserva; la
+        transacción y sus reservas se guardan en un solo commit.
+        """
+        datos_cotizacion = None
+        if cotizacion:
+            datos_cotizacion = CotizacionService.obtener(cotizacion)
+            if datos_cotizacion['moneda_destino'] != WebPayService.MONEDA_COBRO:
+                raise ValueError(f"La cotización debe ser a {WebPayService.MONEDA_COBRO}")
+            if monto and Dinero.a_centavos(monto) != Dinero.a_centavos(datos_cotizacion['monto_convertido']):
+                raise ValueError("El monto no coincide con la cotización")
+            
+            monto = datos_cotizacion['monto_convertido']
+        
+        error = Dinero.error_monto(monto)
+        if error:
+            raise ValueError(error)
+        
+        if items is not None:
+            ReservaStockService.validar_items(items)
+            ReservaStockService.liberar_vencidas()
+        
+        # Generar token único para la transacción
+        token = str(uuid.uuid4())
+        
+        # Crear registro de transacción
+        transaccion = TransaccionPago(
+            token_transaccion=token,
+            monto=monto,
+            cliente_id=cliente_id,
+            detalle=detalle
+        )
+        
+        db.session.add(transaccion)
+        expira_en = None
+        if items is not None:
+            db.session.flush()
+            expira_en = ReservaStockService.reservar(transaccion.id, items)
+            transaccion_id = transaccion.id
+        if cotizacion:
+            CotizacionService.consumir(cotizacion)
+        db.session.commit()
+        
+        if expira_en is not None:
+            ReservaStockService.programar(transaccion_id, expira_en)
+        
+        # Simular respuesta de WebPay
+        resultado = {
+            'token': token,
+            'url_pago': f'https://webpay-simulator.com/pay/{token}',
+            'monto': monto,
+            'estado': 'iniciada'
+        }
+        
+        if datos_cotizacion:
+            resultado['cotizacion'] = datos_cotizacion
+        
+        if expira_en is not None:
+            resultado['reserva_expira_en'] = expira_en.isoformat()
+        
+        return resultado
+    
+    @staticmethod
+    def confirmar_transaccion(token, estado_pago="aprobada"):
+        """Confirmar el resultado de una transacción
+        
+        Si el pago se aprueba las unidades reservadas se descuentan del stock
+        como venta; si no, la reserva se libera. Una transacción cuya reserva
+        ya venció queda expirada y no puede confirmarse.
+        """
+        transaccion = TransaccionPago.query.filter_by(token_transaccion=token).first()
+        
+        if not transaccion:
+            raise ValueError("Transacción no encontrada")
+        
+        if transaccion.estado != 'iniciada':
+            raise ValueError("La transacción ya fue procesada")
+        
+        ahora = datetime.utcnow()
+        vencimiento = db.session.execute(
+            select(func.min(ReservaStock.expira_en)).where(ReservaStock.transaccion_id == transaccion.id)
+        ).scalar()
+        if vencimiento is not None and vencimiento <= ahora:
+            ReservaStockService.liberar([transaccion.id], ahora)
+            db.session.commit()
+            raise ValueError("La reserva de stock de la transacción expiró")
+        
+        stocks = {}
+        if vencimiento is not None:
+            if estado_pago == 'aprobada':
+                stocks = ReservaStockService.convertir(transaccion)
+            else:
+                db.session.execute(delete(ReservaStock).where(ReservaStock.transaccion_id == transaccion.id))
+        
+        # Actualizar estado
+        transaccion.estado = estado_pago
+        transaccion.fecha_actualizacion = ahora
+        
+        db.session.commit()
+        
+        if stocks:
+            # Los UPDATE no pasan por los eventos de sesión: avisar al catálogo
+            CatalogoService.aplicar_stock(stocks)
+        
+        return transaccion
+    
+    @staticmethod
+    def resumen_transacciones(estado=None, cliente_id=None):
+        """Cantidad y monto total de transacciones
+        
+        El total es un SUM entero sobre los centavos guardados, calculado en
+        la BD y sin error de redondeo.
+        """
+        query = db.session.query(func.count(TransaccionPago.id), func.sum(TransaccionPago.monto))
+        
+        if estado:
+            query = query.filter(TransaccionPago.estado == estado)
+        if cliente_id:
+            query = query.filter(TransaccionPago.cliente_id == cliente_id)
+        
+        cantidad, monto_total = query.one()
+        
+        return {
+            'cantidad': cantidad,
+            'monto_total': monto_total or 0
+        }
+
+class CambioDivisasService:
+    """Servicio para cambio de divisas"""
+    
+    # Cotizaciones base simuladas (en un caso real se obtendrían de una API
+    # externa): cuántos CLP vale 1 unidad de cada moneda. Las demás tasas se
+    # triangulan a través de la moneda pivote, así agregar una moneda es
+    # agregar una sola entrada.
+    MONEDA_PIVOTE = 'CLP'
+    COTIZACIONES_BASE = {
+        'USD': 900.0,   # 1 USD = 900 CLP
+        'EUR': 1050.0   # 1 EUR = 1050 CLP
+    }
+    
+    # Tabla de tasas en memoria: se carga una vez, se refresca cada
+    # TTL_TASAS_SEGUNDOS y se reemplaza completa al actualizar las tasas
+    TTL_TASAS_SEGUNDOS = 300
+    
+    _snapshot_tasas = None
+    _lock_tasas = threading.Lock()
+    
+    # Historial en memoria: {moneda: (array de timestamps, array de valores)}
+    # ordenado por fecha, para consultas "a la fecha" con búsqueda binaria.
+    # Una consulta posterior a la última verificación compara MAX(id) con la
+    # BD, porque otro proceso pudo haber agregado cotizaciones.
+    _historial = None
+    _historial_hasta_id = 0       # mayor id de historial_cotizacion incluido
+    _historial_verificado = None  # marca de tiempo de la última comparación con la BD
+    _lock_historial = threading.Lock()
+    
+    @staticmethod
+    def fraccion_cotizaciones(valor_origen, valor_destino):
+        """Tasa exacta valor_origen / valor_destino entre cotizaciones de TasaFija"""
+        return Dinero.fraccion(Dinero.a_tasa(valor_origen), Dinero.a_tasa(valor_destino))
+    
+    @staticmethod
+    def tasa_fraccion(fraccion):
+        """Tasa informada (con la precisión de TasaFija) de una fracción exacta"""
+        numerador, denominador = fraccion
+        return Dinero.desde_tasa(Dinero.dividir(numerador * Dinero.ESCALA_TASA, denominador))
+    
+    @staticmethod
+    def construir_matriz(cotizaciones):
+        """Construir la matriz de tasas de todos los pares a partir de las cotizaciones
+        
+        ``cotizaciones`` es {moneda: valor en moneda pivote}. La tasa de i a j
+        es valor[i] / valor[j]: ``fracciones`` la guarda exacta, para convertir
+        montos con un solo redondeo, y ``matriz`` con la precisión de
+        TasaFija, que es la tasa que se guarda e informa. La diagonal es 1.
+        """
+        monedas = (CambioDivisasService.MONEDA_PIVOTE,) + tuple(sorted(cotizaciones))
+        valores = [1] + [cotizaciones[moneda] for moneda in monedas[1:]]
+        fracciones = [
+            [CambioDivisasService.fraccion_cotizaciones(valor_origen, valor_destino) for valor_destino in valores]
+            for valor_origen in valores
+        ]
+        matriz = [[CambioDivisasService.tasa_fraccion(fraccion) for fraccion in fila] for fila in fracciones]
+        return monedas, {moneda: indice for indice, moneda in enumerate(monedas)}, matriz, fracciones
+    
+    @staticmethod
+    def cargar_tasas():
+        """Leer las tasas activas de la BD y publicarlas como nuevo snapshot
+        
+        Las filas X -> pivote son cotizaciones base (las que faltan se toman de
+        COTIZACIONES_BASE); cualquier otro par guardado se respeta tal cual.
+        """
+        return CambioDivisasService.publicar_tasas(*CambioDivisasService.leer_tasas())
+    
+    @staticmethod
+    def leer_tasas():
+        """Leer de la BD (cotizaciones, directas) sin publicarlas"""
+        pivote = CambioDivisasService.MONEDA_PIVOTE
+        cotizaciones = dict(CambioDivisasService.COTIZACIONES_BASE)
+        directas = {}
+        
+        filas = db.session.execute(
+            select(ConversionMoneda.moneda_origen, ConversionMoneda.moneda_destino, ConversionMoneda.tasa_cambio)
+            .where(ConversionMoneda.activa == True)
+        )
+        for fila in filas:
+            if fila.moneda_destino == pivote and fila.moneda_origen != pivote:
+                cotizaciones[fila.moneda_origen] = fila.tasa_cambio
+            else:
+                directas[(fila.moneda_origen, fila.moneda_destino)] = fila.tasa_cambio
+        
+        return cotizaciones, directas
+    
+    @staticmethod
+    def construir_tasas(cotizaciones, directas=None):
+        """Matriz triangulada con los pares guardados explícitamente aplicados encima
+        
+        Un par guardado igual a la tasa triangulada es sólo la copia que
+        escribe actualizar_tasas_cambio y conserva la fracción exacta; uno
+        distinto se respeta tal cual.
+        """
+        monedas, indices, matriz, fracciones = CambioDivisasService.construir_matriz(cotizaciones)
+        
+        for (moneda_origen, moneda_destino), tasa in (directas or {}).items():
+            if moneda_origen in indices and moneda_destino in indices and moneda_origen != moneda_destino:
+                i, j = indices[moneda_origen], indices[moneda_destino]
+                if Dinero.a_tasa(tasa) != Dinero.a_tasa(matriz[i][j]):
+                    matriz[i][j] = tasa
+                    fracciones[i][j] = Dinero.fraccion(Dinero.a_tasa(tasa), Dinero.ESCALA_TASA)
+        
+        return monedas, indices, matriz, fracciones
+    
+    @staticmethod
+    def fracciones_desde_pivote(monedas, fracciones):
+        """{moneda: fracción pivote -> moneda} para todas las monedas salvo el pivote"""
+        return {moneda: fracciones[0][j] for j, moneda in enumerate(monedas) if j > 0}
+    
+    @staticmethod
+    def publicar_tasas(cotizaciones, directas=None):
+        """Reemplazar de forma atómica el snapshot de tasas por uno nuevo"""
+        monedas, indices, matriz, fracciones = CambioDivisasService.construir_tasas(cotizaciones, directas)
+        
+        anterior = CambioDivisasService._snapshot_tasas
+        snapshot = {
+            'version': (anterior['version'] + 1) if anterior else 1,
+            'cotizaciones': dict(cotizaciones),
+            'monedas': monedas,
+            'indices': indices,
+            'matriz': matriz,
+            'fracciones': fracciones,
+            'cargado_en': time.monotonic()
+        }
+        CambioDivisasService._snapshot_tasas = snapshot
+        return snapshot
+    
+    @staticmethod
+    def invalidar_tasas():
+        """Marcar el snapshot como vencido (se recarga en la próxima consulta)"""
+        snapshot = CambioDivisasService._snapshot_tasas
+        if snapshot:
+            CambioDivisasService._snapshot_tasas = dict(snapshot, cargado_en=None)
+    
+    @staticmethod
+    def obtener_snapshot_tasas():
+        """Obtener el snapshot vigente, recargándolo si venció el TTL"""
+        snapshot = CambioDivisasService._snapshot_tasas
+        if snapshot and snapshot['cargado_en'] is not None and \
+                time.monotonic() - snapshot['cargado_en'] < CambioDivisasService.TTL_TASAS_SEGUNDOS:
+            return snapshot
+        
+        with CambioDivisasService._lock_tasas:
+            # Otro hilo pudo haberlo recargado mientras esperábamos
+            actual = CambioDivisasService._snapshot_tasas
+            if actual is not snapshot:
+                return actual
+            return CambioDivisasService.cargar_tasas()
+    
+    @staticmethod
+    def obtener_tasa_cambio(moneda_origen, moneda_destino):
+        """Obtener tasa de cambio entre dos monedas (desde la tabla en memoria)"""
+        return CambioDivisasService.obtener_conversion(moneda_origen, moneda_destino)[0]
+    
+    @staticmethod
+    def obtener_conversion(moneda_origen, moneda_destino, fecha=None):
+        """(tasa, fracción) del par, vigente o a la ``fecha``
+        
+        La tasa es la informada (precisión de TasaFija); los montos se
+        convierten con la fracción exacta, así un monto grande no arrastra el
+        redondeo de la tasa y la conversión vigente y la histórica coinciden.
+        """
+        if moneda_origen == moneda_destino:
+            return 1.0, (1, 1)
+        
+        if fecha is not None:
+            valor_origen, valor_destino = CambioDivisasService.cotizaciones_historicas(moneda_origen, moneda_destino, fecha)
+            fraccion = CambioDivisasService.fraccion_cotizaciones(valor_origen, valor_destino)
+            return CambioDivisasService.tasa_fraccion(fraccion), fraccion
+        
+        snapshot = CambioDivisasService.obtener_snapshot_tasas()
+        origen = snapshot['indices'].get(moneda_origen)
+        destino = snapshot['indices'].get(moneda_destino)
+        
+        if origen is None or destino is None:
+            raise ValueError(f"Conversión no disponible para {moneda_origen} a {moneda_destino}")
+        
+        return snapshot['matriz'][origen][destino], snapshot['fracciones'][origen][destino]
+    
+    @staticmethod
+    def marca_tiempo(fecha):
+        """Segundos desde la época para una fecha UTC (naive o con zona)"""
+        if fecha.tzinfo is not None:
+            fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+        return (fecha - datetime(1970, 1, 1)).total_seconds()
+    
+    @staticmethod
+    def cargar_historial():
+        """Cargar el historial de cotizaciones en arreglos compactos por moneda"""
+        verificado = CambioDivisasService.marca_tiempo(datetime.utcnow())
+        historial = {}
+        hasta_id = 0
+        filas = db.session.execute(
+            select(HistorialCotizacion.id, HistorialCotizacion.moneda, HistorialCotizacion.fecha, HistorialCotizacion.valor)
+            .order_by(HistorialCotizacion.moneda, HistorialCotizacion.fecha)
+        )
+        for fila in filas:
+            fechas, valores = historial.setdefault(fila.moneda, (array('d'), array('d')))
+            fechas.append(CambioDivisasService.marca_tiempo(fila.fecha))
+            valores.append(fila.valor)
+            hasta_id = max(hasta_id, fila.id)
+        
+        CambioDivisasService._historial = historial
+        CambioDivisasService._historial_hasta_id = hasta_id
+        CambioDivisasService._historial_verificado = verificado
+        return historial
+    
+    @staticmethod
+    def verificar_historial():
+        """Recargar el historial si la BD tiene cotizaciones que no están en memoria
+        
+        Compara MAX(id) (una lectura por índice) con el mayor id cargado.
+        """
+        verificado = CambioDivisasService.marca_tiempo(datetime.utcnow())
+        hasta_id = db.session.execute(select(func.max(HistorialCotizacion.id))).scalar() or 0
+        if hasta_id != CambioDivisasService._historial_hasta_id:
+            return CambioDivisasService.cargar_historial()
+        
+        CambioDivisasService._historial_verificado = verificado
+        return CambioDivisasService._historial
+    
+    @staticmethod
+    def invalidar_historial():
+        """Descartar el historial en memoria (se recarga en la próxima consulta)"""
+        with CambioDivisasService._lock_historial:
+            CambioDivisasService._historial = None
+    
+    @staticmethod
+    def registrar_historial(cotizaciones, fecha, ids):
+        """Agregar al historial en memoria las cotizaciones ya guardadas en BD
+        
+        ``ids`` son los ids de las filas guardadas. Si no siguen al mayor id
+        cargado, otro proceso agregó filas entre medio y el historial se
+        descarta para recargarlo completo.
+        """
+        with CambioDivisasService._lock_historial:
+            historial = CambioDivisasService._historial
+            if historial is None:
+                return
+            if min(ids) != CambioDivisasService._historial_hasta_id + 1:
+                CambioDivisasService._historial = None
+                return
+            
+            marca = CambioDivisasService.marca_tiempo(fecha)
+            for moneda, valor in cotizaciones.items():
+                fechas, valores = historial.setdefault(moneda, (array('d'), array('d')))
+                posicion = bisect_right(fechas, marca)
+                fechas.insert(posicion, marca)
+                valores.insert(posicion, valor)
+            CambioDivisasService._historial_hasta_id = max(ids)
+    
+    @staticmethod
+    def obtener_tasa_historica(moneda_origen, moneda_destino, fecha):
+        """Obtener la tasa vigente en ``fecha`` triangulando las cotizaciones de ese momento"""
+        return CambioDivisasService.obtener_conversion(moneda_origen, moneda_destino, fecha)[0]
+    
+    @staticmethod
+    def cotizaciones_historicas(moneda_origen, moneda_destino, fecha):
+        """Valores en moneda pivote de ambas monedas vigentes en ``fecha``"""
+        marca = CambioDivisasService.marca_tiempo(fecha)
+        
+        with CambioDivisasService._lock_historial:
+            historial = CambioDivisasService._historial
+            if historial is None:
+                historial = CambioDivisasService.cargar_historial()
+            elif marca >= CambioDivisasService._historial_verificado:
+                historial = CambioDivisasService.verificar_historial()
+            
+            valores_pivote = []
+            for moneda in (moneda_origen, moneda_destino):
+                if moneda == CambioDivisasService.MONEDA_PIVOTE:
+                    valores_pivote.append(1)
+                    continue
+                
+                fechas, valores = historial.get(moneda, ((), ()))
+                posicion = bisect_right(fechas, marca) - 1
+                if posicion < 0:
+                    raise ValueError(
+                        f"No hay tasa registrada para {moneda_origen} a {moneda_destino} en {fecha.isoformat()}"
+                    )
+                valores_pivote.append(valores[posicion])
+        
+        return valores_pivote
+    
+    @staticmethod
+    def convertir_monto(monto, moneda_origen, moneda_destino, fecha=None):
+        """Convertir un monto de una moneda a otra (a la tasa vigente en ``fecha`` si se indica)"""
+        error = Dinero.error_monto(monto)
+        if error:
+            raise ValueError(error)
+        
+        tasa, fraccion = CambioDivisasService.obtener_conversion(moneda_origen, moneda_destino, fecha)
+        monto_convertido = Dinero.convertir_montos([monto], fraccion)[0]
+        
+        resultado = {
+            'monto_original': monto,
+            'moneda_origen': moneda_origen,
+            'monto_convertido': monto_convertido,
+            'moneda_destino': moneda_destino,
+            'tasa_cambio': tasa,
+            'fecha_conversion': datetime.utcnow().isoformat()
+        }
+        
+        if fecha is not None:
+            resultado['fecha_tasa'] = fecha.isoformat()
+        
+        return resultado
+    
+    @staticmethod
+    def convertir_lote(conversiones, fecha=None):
+        """Convertir muchos montos en una pasada, conservando el orden de entrada
+        
+        Cada par de monedas distinto se resuelve una sola vez y su tasa se
+        aplica a todos los montos de ese par con el mismo redondeo que
+        convertir_monto. Con ``fecha`` usa las tasas vigentes en ese momento.
+        Los items inválidos llevan su propio 'error'.
+        """
+        resultados = [None] * len(conversiones)
+        por_par = {}
+        
+        for indice, item in enumerate(conversiones):
+            if not isinstance(item, dict) or not all(k in item for k in ['monto', 'moneda_origen', 'moneda_destino']):
+                resultados[indice] = {'error': 'Monto, moneda_origen y moneda_destino son requeridos'}
+                continue
+            
+            error = Dinero.error_monto(item['monto'])
+            if error:
+                resultados[indice] = {'error': error}
+                continue
+            
+            par = (str(item['moneda_origen']).upper(), str(item['moneda_destino']).upper())
+            por_par.setdefault(par, []).append(indice)
+        
+        for (moneda_origen, moneda_destino), indices in por_par.items():
+            try:
+                tasa, fraccion = CambioDivisasService.obtener_conversion(moneda_origen, moneda_destino, fecha)
+            except ValueError as e:
+                for indice in indices:
+                    resultados[indice] = {'error': str(e)}
+                continue
+            
+            montos = [conversiones[indice]['monto'] for indice in indices]
+            convertidos = Dinero.convertir_montos(montos, fraccion)
+            
+            for indice, monto, convertido in zip(indices, montos, convertidos):
+                resultados[indice] = {
+                    'monto_original': monto,
+                    'moneda_origen': moneda_origen,
+                    'monto_convertido': convertido,
+                    'moneda_destino': moneda_destino,
+                    'tasa_cambio': tasa
+                }
+        
+        return resultados
+    
+    @staticmethod
+    def actualizar_tasas_cambio():
+        """Actualizar tasas de cambio (simulado - en producción consultaría API externa)
+        
+        Hace fluctuar las cotizaciones base, triangula la matriz completa y
+        guarda todos los pares dirigidos.
+        """
+        # Simular fluctuación del ±5% de cada cotización base
+        cotizaciones = {
+            moneda: round(valor * (1 + random.uniform(-0.05, 0.05)), 6)
+            for moneda, valor in CambioDivisasService.COTIZACIONES_BASE.items()
+        }
+        monedas, _, matriz, fracciones = CambioDivisasService.construir_matriz(cotizaciones)
+        
+        fecha = datetime.utcnow()
+        filas = [
+            {
+                'moneda_origen': moneda_origen,
+                'moneda_destino': moneda_destino,
+                'tasa_cambio': matriz[i][j],
+                'fecha_actualizacion': fecha,
+                'activa': True
+            }
+            for i, moneda_origen in enumerate(monedas)
+            for j, moneda_destino in enumerate(monedas)
+            if i != j
+        ]
+        
+        # Un solo INSERT ... ON CONFLICT DO UPDATE para todo el conjunto de
+        # tasas, así el bloqueo de escritura dura una sentencia y no 2N
+        dialecto = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+        sentencia = dialecto.insert(ConversionMoneda).values(filas)
+        sentencia = sentencia.on_conflict_do_update(
+            index_elements=['moneda_origen', 'moneda_destino', 'activa'],
+            set_={
+                'tasa_cambio': sentencia.excluded.tasa_cambio,
+                'fecha_actualizacion': sentencia.excluded.fecha_actualizacion
+            }
+        )
+        db.session.execute(sentencia)
+        actualizadas = len(filas)
+        
+        # Registrar las cotizaciones en el historial (append-only)
+        registros = [HistorialCotizacion(moneda=moneda, valor=valor, fecha=fecha) for moneda, valor in cotizaciones.items()]
+        db.session.add_all(registros)
+        db.session.flush()
+        ids = [registro.id for registro in registros]
+        
+        # Recalcular los precios convertidos en la misma transacción
+        CatalogoService.recalcular_precios(
+            db.session.connection(), CambioDivisasService.fracciones_desde_pivote(monedas, fracciones)
+        )
+        
+        db.session.commit()
+        
+        # Publicar las nuevas tasas sin volver a leer la BD
+        CambioDivisasService.publicar_tasas(cotizaciones)
+        CambioDivisasService.registrar_historial(cotizaciones, fecha, ids)
+        
+        return f"Se actualizaron {actualizadas} tasas de cambio"
+
+class CotizacionService:
+    """Cotizaciones con tasa bloqueada para pagos en otra moneda
+    
+    Una cotización guarda la tasa y el monto convertido bajo un token de
+    corta vida, así WebPay cobra exactamente lo que se mostró al cliente.
+    Se guardan en la tabla cotizacion para que cualquier proceso pueda
+    usarlas; las vencidas se borran por el índice de expira_en al crear
+    una nueva.
+    """
+    
+    TTL_COTIZACION_SEGUNDOS = 120
+    
+    @staticmethod
+    def crear(monto, moneda_origen, moneda_destino):
+        """Convertir a la tasa vigente y reservar el resultado bajo un token"""
+        conversion = CambioDivisasService.convertir_monto(monto, moneda_origen, moneda_destino)
+        ahora = datetime.utcnow()
+        
+        cotizacion = Cotizacion(
+            token=uuid.uuid4().hex,
+            monto_original=conversion['monto_original'],
+            moneda_origen=conversion['moneda_origen'],
+            monto_convertido=conversion['monto_convertido'],
+            moneda_destino=conversion['moneda_destino'],
+            tasa_cambio=conversion['tasa_cambio'],
+            expira_en=ahora + timedelta(seconds=CotizacionService.TTL_COTIZACION_SEGUNDOS)
+        )
+        
+        db.session.execute(delete(Cotizacion).where(Cotizacion.expira_en <= ahora))
+        db.session.add(cotizacion)
+        db.session.commit()
+        
+        return cotizacion.to_dict()
+    
+    @staticmethod
+    def obtener(token):
+        """Buscar una cotización vigente"""
+        cotizacion = db.session.execute(
+            select(Cotizacion).where(Cotizacion.token == token, Cotizacion.expira_en > datetime.utcnow())
+        ).scalar()
+        
+        if cotizacion is None:
+            raise ValueError("Cotización no encontrada o expirada")
+        
+        return cotizacion.to_dict()
+    
+    @staticmethod
+    def consumir(token):
+        """Borrar la cotización dentro de la transacción en curso (sin commit)
+        
+        Si la transacción se revierte la cotización sigue vigente. Si otro
+        pago ya la consumió (o venció) se revierte todo y se lanza ValueError.
+        """
+        consumida = db.session.execute(
+            delete(Cotizacion)
+            .where(Cotizacion.token == token, Cotizacion.expira_en > datetime.utcnow())
+            .returning(Cotizacion.token)
+        ).scalar()
+        
+        if consumida is None:
+            db.session.rollback()
+            raise ValueError("Cotización no encontrada o expirada")
+
+class RefrescoTasasService:
+    """Refresco periódico de tasas de cambio fuera del ciclo de las peticiones
+    
+    Cada proceso corre un hilo que despierta cada ``intervalo`` segundos más
+    un jitter aleatorio. Sólo el proceso que obtiene el arriendo en BD
+    actualiza las tasas; los demás únicamente recargan el snapshot nuevo.
+    """
+    
+    NOMBRE_BLOQUEO = 'refresco_tasas'
+    
+    _hilo = None
+    _pid = None
+    _detener = threading.Event()
+    
+    @staticmethod
+    def identificador():
+        return f'{socket.gethostname()}:{os.getpid()}'
+    
+    @staticmethod
+    def adquirir_bloqueo(titular, duracion, nombre=None):
+        """Tomar el arriendo ``nombre`` si está libre o vencido; devuelve True si se obtuvo
+        
+        Cada tarea periódica usa su propio nombre, así un arriendo no
+        bloquea a las demás.
+        """
+        nombre = nombre or RefrescoTasasService.NOMBRE_BLOQUEO
+        ahora = datetime.utcnow()
+        
+        if db.session.get(BloqueoTarea, nombre) is None:
+            try:
+                db.session.add(BloqueoTarea(nombre=nombre, vence_en=ahora))
+                db.session.commit()
+            except IntegrityError:
+                # Otro proceso creó el registro al mismo tiempo
+                db.session.rollback()
+        
+        # UPDATE condicional: sólo un proceso puede ganar un arriendo vencido
+        resultado = db.session.execute(
+            update(BloqueoTarea)
+            .where(BloqueoTarea.nombre == nombre, BloqueoTarea.vence_en <= ahora)
+            .values(titular=titular, vence_en=ahora + timedelta(seconds=duracion))
+        )
+        db.session.commit()
+        return resultado.rowcount == 1
+    
+    @staticmethod
+    def ejecutar_ciclo(intervalo, titular=None):
+        """Ejecutar un ciclo de refresco: actualizar si se gana el arriendo, si no recargar"""
+        titular = titular or RefrescoTasasService.identificador()
+        
+        if RefrescoTasasService.adquirir_bloqueo(titular, intervalo):
+            CambioDivisasService.actualizar_tasas_cambio()
+            return 'actualizado'
+        
+        CambioDivisasService.cargar_tasas()
+        CambioDivisasService.invalidar_historial()
+        return 'recargado'
+    
+    @staticmethod
+    def iniciar(aplicacion, intervalo, jitter=None):
+        """Iniciar el hilo de refresco del proceso actual (una vez por proceso)
+        
+        Compara el pid: un hilo iniciado antes de un fork no sobrevive en el
+        proceso hijo.
+        """
+        hilo = RefrescoTasasService._hilo
+        if hilo is not None and hilo.is_alive() and RefrescoTasasService._pid == os.getpid():
+            return hilo
+        
+        jitter = intervalo * 0.1 if jitter is None else jitter
+        RefrescoTasasService._detener.clear()
+        
+        def ejecutar():
+            while not RefrescoTasasService._detener.wait(intervalo + random.uniform(0, jitter)):
+                with aplicacion.app_context():
+                    try:
+                        RefrescoTasasService.ejecutar_ciclo(intervalo)
+                    except Exception:
+                        db.session.rollback()
+                        aplicacion.logger.exception('Error al refrescar tasas de cambio')
+                    finally:
+                        db.session.remove()
+        
+        hilo = threading.Thread(target=ejecutar, name='refresco-tasas', daemon=True)
+        hilo.start()
+        RefrescoTasasService._hilo = hilo
+        RefrescoTasasService._pid = os.getpid()
+        return hilo
+    
+    @staticmethod
+    def detener():
+        """Detener el hilo de refresco"""
+        RefrescoTasasService._detener.set()
+        if RefrescoTasasService._hilo is not None:
+            RefrescoTasasService._hilo.join()
+            RefrescoTasasService._hilo = None
+
+class MantenimientoService:
+    """Tareas de mantenimiento periódicas, cada una con su propio intervalo
+    
+    Un hilo por proceso (iniciado en la primera petición del worker)
+    revisa cada ``PASO_SEGUNDOS`` qué tareas vencieron. Las tareas sobre
+    datos compartidos toman un arriendo con su nombre, así las ejecuta un
+    solo proceso por intervalo; liberar reservas es por proceso porque cada
+    uno lleva el heap de vencimientos de las reservas que creó.
+    """
+    
+    PASO_SEGUNDOS = 5
+    
+    # {nombre: (intervalo en segundos, usa arriendo, función)}
+    TAREAS = {
+        'liberar_reservas': (30, False, ReservaStockService.liberar_vencidas),
+        'compactar_libro_stock': (3600, True, MovimientoStockService.compactar)
+    }
+    
+    _hilo = None
+    _pid = None
+    _detener = threading.Event()
+    _proximas = {}  # {nombre: próxima ejecución en time.monotonic()}
+    
+    @staticmethod
+    def ejecutar_pendientes(titular=None):
+        """Ejecutar las tareas vencidas; devuelve {nombre: resultado} (None si otro proceso tenía el arriendo)"""
+        titular = titular or RefrescoTasasService.identificador()
+        ahora = time.monotonic()
+        resultados = {}
+        
+        for nombre, (intervalo, con_arriendo, funcion) in MantenimientoService.TAREAS.items():
+            if MantenimientoService._proximas.get(nombre, 0) > ahora:
+                continue
+            MantenimientoService._proximas[nombre] = ahora + intervalo * random.uniform(1, 1.1)
+            
+            try:
+                if con_arriendo and not RefrescoTasasService.adquirir_bloqueo(titular, intervalo, nombre):
+                    resultados[nombre] = None
+                    continue
+                resultados[nombre] = funcion()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception(f'Error en la tarea de mantenimiento {nombre}')
+        
+        return resultados
+    
+    @staticmethod
+    def iniciar(aplicacion):
+        """Iniciar el hilo de mantenimiento del proceso actual (una vez por proceso)
+        
+        Compara el pid: un hilo iniciado antes de un fork no sobrevive en el
+        proceso hijo.
+        """
+        hilo = MantenimientoService._hilo
+        if hilo is not None and hilo.is_alive() and MantenimientoService._pid == os.getpid():
+            return hilo
+        
+        MantenimientoService._detener.clear()
+        MantenimientoService._proximas = {}
+        
+        def ejecutar():
+            while not MantenimientoService._detener.wait(MantenimientoService.PASO_SEGUNDOS):
+                with aplicacion.app_context():
+                    try:
+                        MantenimientoService.ejecutar_pendientes()
+                    finally:
+                        db.session.remove()
+        
+        hilo = threading.Thread(target=ejecutar, name='mantenimiento', daemon=True)
+        hilo.start()
+        MantenimientoService._hilo = hilo
+        MantenimientoService._pid = os.getpid()
+        return hilo
+    
+    @staticmethod
+    def detener():
+        """Detener el hilo de mantenimiento"""
+        MantenimientoService._detener.set()
+        if MantenimientoService._hilo is not None:
+            MantenimientoService._hilo.join()
+            MantenimientoService._hilo = None
+
+class VersionCacheService:
+    """Versiones en BD de las cachés en memoria, compartidas entre procesos
+    
+    Cada proceso guarda la versión con la que su caché está al día; una
+    lectura por clave primaria basta para saber si otro proceso la cambió.
+    """
+    
+    @staticmethod
+    def incrementar(connection, nombre):
+        """Incrementar la versión ``nombre`` en la transacción de ``connection`` y devolverla"""
+        dialecto = postgresql if connection.dialect.name == 'postgresql' else sqlite
+        sentencia = dialecto.insert(VersionCache).values(nombre=nombre, version=1)
+        sentencia = sentencia.on_conflict_do_update(
+            index_elements=['nombre'],
+            set_={'version': VersionCache.version + 1}
+        ).returning(VersionCache.version)
+        return connection.execute(sentencia).scalar()
+    
+    @staticmethod
+    def leer(nombre):
+        """Versión vigente de ``nombre`` (0 si nunca se escribió)"""
+        return db.session.execute(
+            select(VersionCache.version).where(VersionCache.nombre == nombre)
+        ).scalar() or 0
+
+class CatalogoService:
+    """Catálogo materializado en memoria del proceso
+    
+    Se carga una vez y luego se actualiza de forma incremental con los
+    eventos de sesión de SQLAlchemy: cada commit que escribe Producto o
+    Categoria reemplaza sólo esas entradas. Los precios en otras monedas se
+    leen ya convertidos de la tabla precio_moneda (una lectura por moneda,
+    vigente mientras no cambie la versión de las tasas). Así /catalogo es
+    una lectura en memoria, sin aritmética por producto.
+    
+    Las escrituras de otros procesos se detectan con la versión 'catalogo'
+    de version_cache: si no coincide con la del proceso, el catálogo, el
+    autocompletado y las facetas se descartan y se recargan. La versión se
+    compara a lo más una vez cada INTERVALO_VERIFICACION_SEGUNDOS; los
+    commits propios la avanzan al instante, así que sólo las escrituras de
+    otros procesos pueden tardar ese plazo en verse.
+    """
+    
+    # Sentencias SQL de una carga en frío: la versión, categorías, productos,
+    # las tasas si la tabla en memoria no está cargada y los precios de la
+    # moneda pedida
+    PRESUPUESTO_SENTENCIAS = 5
+    NOMBRE_VERSION = 'catalogo'
+    INTERVALO_VERIFICACION_SEGUNDOS = 1.0
+    
+    _lock = threading.RLock()
+    _productos = None   # {producto_id: dict}
+    _categorias = None  # {categoria_id: dict}
+    _precios = {}       # {moneda: {producto_id: precio convertido}}
+    _version_precios = None
+    _version = None     # versión de version_cache con la que están al día las cachés
+    _verificado_en = None  # última comparación con version_cache, en time.monotonic()
+    
+    @classmethod
+    def cargar(cls):
+        """Cargar el catálogo completo desde la base de datos
+        
+        Usa una cantidad fija de sentencias sin importar cuántos productos
+        existan: categorías y productos se leen como columnas simples, sin
+        cargas perezosas por fila.
+        """
+        columnas_categoria = columnas_publicas(Categoria)
+        columnas_producto = columnas_publicas(Producto)
+        serializar_categoria = serializador_columnas(columnas_categoria)
+        serializar_producto = serializador_columnas(columnas_producto)
+        
+        with cls._lock:
+            cls._categorias = {
+                fila.id: serializar_categoria(fila)
+                for fila in db.session.execute(select(*columnas_categoria))
+            }
+            cls._productos = {
+                fila.id: serializar_producto(fila)
+                for fila in db.session.execute(select(*columnas_producto).order_by(Producto.id))
+            }
+    
+    @classmethod
+    def invalidar(cls):
+        """Descartar el catálogo materializado (se recarga en la próxima lectura)"""
+        with cls._lock:
+            cls._productos = None
+            cls._categorias = None
+            cls._precios = {}
+    
+    @classmethod
+    def invalidar_derivados(cls):
+        """Descartar el catálogo y las cachés construidas a partir de él"""
+        with cls._lock:
+            cls.invalidar()
+            AutocompletarService.invalidar()
+            FacetasService.invalidar()
+            cls._version = None
+            cls._verificado_en = None
+    
+    @classmethod
+    def verificar_version(cls):
+        """Descartar las cachés si otro proceso cambió el catálogo desde la última lectura
+        
+        Dentro de INTERVALO_VERIFICACION_SEGUNDOS desde la última comparación
+        no consulta la base de datos.
+        """
+        verificado = cls._verificado_en
+        if verificado is not None and time.monotonic() - verificado < cls.INTERVALO_VERIFICACION_SEGUNDOS:
+            return
+        
+        version = VersionCacheService.leer(cls.NOMBRE_VERSION)
+        with cls._lock:
+            if cls._version != version:
+                cls.invalidar_derivados()
+                cls._version = version
+            cls._verificado_en = time.monotonic()
+    
+    @classmethod
+    def incrementar_version(cls, session):
+        """Incrementar la versión del catálogo en la transacción de ``session``
+        
+        Basta una vez por transacción: los demás procesos sólo necesitan ver
+        que cambió. En SQLite la escritura además toma el bloqueo de
+        escritura de la base hasta el commit.
+        """
+        if 'version_catalogo' in session.info:
+            return
+        nueva = VersionCacheService.incrementar(session.connection(), cls.NOMBRE_VERSION)
+        session.info['version_catalogo'] = (nueva - 1, nueva)
+    
+    @classmethod
+    def avanzar_version(cls, anterior, nueva):
+        """Registrar un commit propio que llevó la versión de ``anterior`` a ``nueva``
+        
+        Si las cachés no estaban en ``anterior`` hubo escrituras de otro
+        proceso entre medio: se descartan en lugar de aplicar el cambio
+        incremental. Devuelve True si la caché sigue al día.
+        """
+        with cls._lock:
+            if cls._version == anterior:
+                cls._version = nueva
+                return True
+            cls.invalidar_derivados()
+            return False
+    
+    @classmethod
+    def obtener_snapshot(cls, verificar=True):
+        """Obtener (productos, categorias), cargando el catálogo si hace falta
+        
+        ``verificar=False`` omite la comparación con version_cache, para quien
+        ya la hizo en la misma petición.
+        """
+        if verificar:
+            cls.verificar_version()
+        with cls._lock:
+            if cls._productos is None:
+                cls.cargar()
+            return cls._productos, cls._categorias
+    
+    @classmethod
+    def aplicar_cambios(cls, cambios):
+        """Aplicar los cambios confirmados de un commit
+        
+        ``cambios`` es {(modelo, id): dict o None}; None indica un borrado.
+        Los diccionarios se copian antes de modificarse, de modo que una
+        lectura en curso sigue viendo un snapshot consistente.
+        """
+        with cls._lock:
+            if cls._productos is None:
+                return
+            
+            productos = cls._productos
+            categorias = cls._categorias
+            
+            for (modelo, registro_id), datos in cambios.items():
+                if modelo == 'ConversionMoneda':
+                    continue
+                
+                if modelo == 'Producto':
+                    # precio_moneda ya se recalculó en el flush; releerla
+                    cls._precios = {}
+                    if productos is cls._productos:
+                        productos = dict(productos)
+                    destino = productos
+                else:
+                    if categorias is cls._categorias:
+                        categorias = dict(categorias)
+                    destino = categorias
+                
+                if datos is None:
+                    destino.pop(registro_id, None)
+                else:
+                    destino[registro_id] = datos
+            
+            cls._productos = productos
+            cls._categorias = categorias
+    
+    @classmethod
+    def aplicar_stock(cls, stocks):
+        """Actualizar el stock de productos escritos con UPDATE directo (sin eventos ORM)
+        
+        ``stocks`` es {producto_id: stock}. Facetas y autocompletado no
+        dependen del stock, así que basta con el catálogo.
+        """
+        with cls._lock:
+            if cls._productos is None:
+                return
+            
+            productos = dict(cls._productos)
+            for producto_id, stock in stocks.items():
+                if producto_id in productos:
+                    productos[producto_id] = {**productos[producto_id], 'stock': stock}
+            cls._productos = productos
+    
+    @staticmethod
+    def obtener_tasa(moneda):
+        """Obtener la tasa CLP -> moneda desde la tabla de tasas en memoria"""
+        return CambioDivisasService.obtener_tasa_cambio('CLP', moneda)
+    
+    @staticmethod
+    def recalcular_precios(connection, fracciones, productos_ids=None):
+        """Recalcular precio_moneda con un solo INSERT ... SELECT ... ON CONFLICT
+        
+        ``fracciones`` es {moneda: (numerador, denominador) CLP -> moneda}. La
+        conversión se hace en la BD sobre los centavos enteros, con el mismo
+        redondeo que Dinero.convertir; los CAST a BIGINT garantizan división
+        entera aunque la columna tenga afinidad REAL y evitan desbordar int4
+        en PostgreSQL. Sin ``productos_ids`` se recalculan todos.
+        """
+        if not fracciones:
+            return
+        
+        parametros = {}
+        valores = []
+        for indice, (moneda, (numerador, denominador)) in enumerate(sorted(fracciones.items())):
+            parametros[f'moneda_{indice}'] = moneda
+            parametros[f'numerador_{indice}'] = numerador
+            parametros[f'denominador_{indice}'] = denominador
+            valores.append(f'(:moneda_{indice}, :numerador_{indice}, :denominador_{indice})')
+        
+        filtro = '1 = 1'
+        if productos_ids is not None:
+            if not productos_ids:
+                return
+            filtro = 'producto.id IN :productos_ids'
+            parametros['productos_ids'] = list(productos_ids)
+        
+        sentencia = text(f"""
+            INSERT INTO precio_moneda (producto_id, moneda, precio_convertido)
+            SELECT producto.id, tasas.column1,
+                   (CAST(producto.precio AS BIGINT) * CAST(tasas.column2 AS BIGINT)
+                    + CAST(tasas.column3 AS BIGINT) / 2) / CAST(tasas.column3 AS BIGINT)
+            FROM producto CROSS JOIN (VALUES {', '.join(valores)}) AS tasas
+            WHERE {filtro}
+            ON CONFLICT (producto_id, moneda) DO UPDATE SET precio_convertido = excluded.precio_convertido
+        """)
+        if productos_ids is not None:
+            sentencia = sentencia.bindparams(bindparam('productos_ids', expanding=True))
+        
+        connection.execute(sentencia, parametros)
+    
+    @classmethod
+    def obtener_precios(cls, moneda):
+        """Obtener {producto_id: precio} en ``moneda`` leyendo precio_moneda por índice"""
+        version = CambioDivisasService.obtener_snapshot_tasas()['version']
+        
+        with cls._lock:
+            if cls._version_precios != version:
+                cls._precios = {}
+                cls._version_precios = version
+            precios = cls._precios.get(moneda)
+            if precios is None:
+                precios = dict(db.session.execute(
+                    select(PrecioMoneda.producto_id, PrecioMoneda.precio_convertido)
+                    .where(PrecioMoneda.moneda == moneda)
+                ).all())
+                cls._precios = {**cls._precios, moneda: precios}
+            return precios
+    
+    @staticmethod
+    def precios_seleccion(seleccion, tasas):
+        """Precios de la selección en cada moneda de ``tasas``, desde precio_moneda
+        
+        Un producto que aún no tiene fila (por ejemplo, insertado fuera del
+        ORM) se convierte en el momento con la misma aritmética.
+        """
+        resultado = {}
+        for codigo in tasas:
+            if codigo == 'CLP':
+                resultado[codigo] = [p['precio'] for p in seleccion]
+                continue
+            
+            precios = CatalogoService.obtener_precios(codigo)
+            columna = [precios.get(p['id']) for p in seleccion]
+            faltantes = [indice for indice, precio in enumerate(columna) if precio is None]
+            if faltantes:
+                fraccion = CambioDivisasService.obtener_conversion('CLP', codigo)[1]
+                recalculados = Dinero.convertir_montos([seleccion[indice]['precio'] for indice in faltantes], fraccion)
+                for indice, precio in zip(faltantes, recalculados):
+                    columna[indice] = precio
+            resultado[codigo] = columna
+        
+        return resultado
+    
+    @staticmethod
+    def consultar(moneda='CLP', categoria_id=None, buscar=None, monedas=None, snapshot=None):
+        """Armar el catálogo filtrado a partir del snapshot en memoria
+        
+        ``monedas`` agrega a cada producto un mapa ``precios`` con el precio en
+        cada moneda pedida; una moneda sin tasa disponible lanza ValueError.
+        ``snapshot`` es un (productos, categorias) ya obtenido en la petición.
+        """
+        productos, categorias = snapshot or CatalogoService.obtener_snapshot()
+        
+        if buscar:
+            seleccion = [productos[pid] for pid in ProductoService.ids_busqueda(buscar) if pid in productos]
+        else:
+            seleccion = list(productos.values())
+        
+        if categoria_id:
+            try:
+                categoria_id = int(categoria_id)
+            except ValueError:
+                raise ValueError("categoria_id debe ser un entero")
+            seleccion = [p for p in seleccion if p['categoria_id'] == categoria_id]
+        
+        tasas = {}
+        for codigo in monedas or []:
+            tasas[codigo] = 1.0 if codigo == 'CLP' else CatalogoService.obtener_tasa(codigo)
+        
+        tasa = None
+        if moneda != 'CLP':
+            try:
+                tasa = tasas.get(moneda) or CatalogoService.obtener_tasa(moneda)
+                tasas[moneda] = tasa
+            except ValueError:
+                tasa = None
+        
+        convertidos = CatalogoService.precios_seleccion(seleccion, tasas)
+        
+        catalogo = []
+        for indice, producto in enumerate(seleccion):
+            item = dict(producto)
+            
+            if moneda != 'CLP':
+                item['precio_original'] = producto['precio']
+                if tasa is not None:
+                    item['precio'] = convertidos[moneda][indice]
+                    item['moneda'] = moneda
+                    item['tasa_cambio'] = tasa
+                else:
+                    item['moneda'] = 'CLP'
+                    item['error_conversion'] = f'No se pudo convertir a {moneda}'
+            else:
+                item['moneda'] = 'CLP'
+            
+            if monedas:
+                item['precios'] = {codigo: convertidos[codigo][indice] for codigo in monedas}
+            
+            # Agregar información de categoría
+            categoria = categorias.get(producto['categoria_id'])
+            if categoria:
+                item['categoria'] = categoria
+            
+            catalogo.append(item)
+        
+        return catalogo, list(categorias.values())
+
+class AutocompletarService:
+    """Índice de prefijos en memoria para sugerir productos por nombre
+    
+    Mantiene dos arreglos ordenados de claves normalizadas: el nombre
+    completo y cada palabra desde la segunda en adelante (para que "elec"
+    sugiera "Taladro Eléctrico"). Una consulta es un bisect más la lectura de
+    las k claves siguientes, sin tocar la base de datos.
+    """
+    
+    LIMITE_DEFECTO = 10
+    LIMITE_MAXIMO = 50
+    
+    _lock = threading.RLock()
+    _nombres = None    # [(clave, producto_id)] ordenado
+    _palabras = None   # [(clave, producto_id)] ordenado
+    _claves = {}       # {producto_id: [(arreglo, clave)]}
+    
+    @staticmethod
+    def claves_producto(nombre):
+        """Obtener las claves de índice de un nombre: completo y por palabra"""
+        palabras = normalizar_texto(nombre).split(' ')
+        completo = ' '.join(palabras)
+        return completo, [' '.join(palabras[i:]) for i in range(1, len(palabras))]
+    
+    @classmethod
+    def _agregar(cls, producto_id, nombre):
+        completo, sufijos = cls.claves_producto(nombre)
+        insort(cls._nombres, (completo, producto_id))
+        claves = [(cls._nombres, completo)]
+        for sufijo in sufijos:
+            insort(cls._palabras, (sufijo, producto_id))
+            claves.append((cls._palabras, sufijo))
+        cls._claves[producto_id] = claves
+    
+    @classmethod
+    def _quitar(cls, producto_id):
+        for arreglo, clave in cls._claves.pop(producto_id, []):
+            posicion = bisect_left(arreglo, (clave, producto_id))
+            if posicion < len(arreglo) and arreglo[posicion] == (clave, producto_id):
+                del arreglo[posicion]
+    
+    @classmethod
+    def cargar(cls):
+        """Construir el índice a partir del catálogo materializado"""
+        productos, _ = CatalogoService.obtener_snapshot()
+        with cls._lock:
+            cls._nombres = []
+            cls._palabras = []
+            cls._claves = {}
+            for producto in productos.values():
+                cls._agregar(producto['id'], producto['nombre'])
+    
+    @classmethod
+    def invalidar(cls):
+        """Descartar el índice (se reconstruye en la próxima consulta)"""
+        with cls._lock:
+            cls._nombres = None
+            cls._palabras = None
+            cls._claves = {}
+    
+    @classmethod
+    def aplicar_cambios(cls, cambios):
+        """Actualizar el índice con los productos creados, renombrados o borrados"""
+        with cls._lock:
+            if cls._nombres is None:
+                return
+            
+            for (modelo, producto_id), datos in cambios.items():
+                if modelo != 'Producto':
+                    continue
+                cls._quitar(producto_id)
+                if datos is not None:
+                    cls._agregar(producto_id, datos['nombre'])
+    
+    @classmethod
+    def sugerir(cls, texto, limite=None):
+        """Obtener hasta ``limite`` IDs de productos cuyo nombre empieza con el texto
+        
+        Primero los que coinciden desde el inicio del nombre y luego los que
+        coinciden al inicio de otra palabra.
+        """
+        limite = min(limite or cls.LIMITE_DEFECTO, cls.LIMITE_MAXIMO)
+        prefijo = normalizar_texto(texto)
+        if not prefijo:
+            return []
+        
+        CatalogoService.verificar_version()
+        with cls._lock:
+            if cls._nombres is None:
+                cls.cargar()
+            
+            resultado = []
+            for arreglo in (cls._nombres, cls._palabras):
+                posicion = bisect_left(arreglo, (prefijo,))
+                while posicion < len(arreglo) and len(resultado) < limite:
+                    clave, producto_id = arreglo[posicion]
+                    if not clave.startswith(prefijo):
+                        break
+                    if producto_id not in resultado:
+                        resultado.append(producto_id)
+                    posicion += 1
+            
+            return resultado
+
+class FacetasService:
+    """Conteos por categoría y rango de precio para búsquedas y catálogo
+    
+    Se calculan con una sola consulta agrupada sobre los resultados de la
+    búsqueda y se guardan por texto normalizado; cualquier escritura de
+    Producto vacía la caché.
+    """
+    
+    # Rangos de precio en CLP: (desde, hasta), hasta=None significa sin tope
+    RANGOS_PRECIO = [(0, 10000), (10000, 50000), (50000, 100000), (100000, None)]
+    MAXIMO_CACHE = 256
+    
+    _lock = threading.Lock()
+    _cache = {}  # {texto normalizado: facetas}
+    
+    @staticmethod
+    def etiqueta_rango(desde, hasta):
+        return f'{desde}+' if hasta is None else f'{desde}-{hasta}'
+    
+    @staticmethod
+    def calcular(buscar=None):
+        """Calcular las facetas de una búsqueda con una consulta agrupada"""
+        rangos = FacetasService.RANGOS_PRECIO
+        rango = case(
+            *[(Producto.precio < hasta, indice) for indice, (_, hasta) in enumerate(rangos) if hasta is not None],
+            else_=len(rangos) - 1
+        ).label('rango')
+        
+        query = Producto.query.with_entities(Producto.categoria_id, rango, func.count(Producto.id))
+        if buscar:
+            query = ProductoService.filtrar_busqueda(query, buscar)
+        
+        por_categoria = {}
+        por_rango = [0] * len(rangos)
+        for categoria_id, indice, total in query.group_by(Producto.categoria_id, rango):
+            por_categoria[categoria_id] = por_categoria.get(categoria_id, 0) + total
+            por_rango[indice] += total
+        
+        return {
+            'categorias': [
+                {'categoria_id': categoria_id, 'total': total}
+                for categoria_id, total in sorted(por_categoria.items(), key=lambda par: (par[0] is None, par[0] or 0))
+            ],
+            'rangos_precio': [
+                {
+                    'rango': FacetasService.etiqueta_rango(desde, hasta),
+                    'desde': desde,
+                    'hasta': hasta,
+                    'total': total
+                }
+                for (desde, hasta), total in zip(rangos, por_rango)
+            ]
         }
     
     @staticmethod
-    def confirmar_transaccion(token, estado_pago="aprobada"):
-        """Confirmar el resultado de una transacción"""
-        transaccion = TransaccionPago.query.filter_by(token_transaccion=token).first()
+    def obtener(buscar=None, verificar=True):
+        """Obtener las facetas de una búsqueda desde la caché o calculándolas
         
-        if not transaccion:
-            raise ValueError("Transacción no encontrada")
+        ``verificar=False`` omite la comparación con version_cache, para quien
+        ya la hizo en la misma petición.
+        """
+        clave = normalizar_texto(buscar)
         
-        if transaccion.estado != 'iniciada':
-            raise ValueError("La transacción ya fue procesada")
+        if verificar:
+            CatalogoService.verificar_version()
+        with FacetasService._lock:
+            facetas = FacetasService._cache.get(clave)
+        if facetas is not None:
+            return facetas
         
-        # Actualizar estado
-        transaccion.estado = estado_pago
-        transaccion.fecha_actualizacion = datetime.utcnow()
+        facetas = FacetasService.calcular(buscar)
         
-        db.session.commit()
+        with FacetasService._lock:
+            if len(FacetasService._cache) >= FacetasService.MAXIMO_CACHE:
+                FacetasService._cache.pop(next(iter(FacetasService._cache)))
+            FacetasService._cache[clave] = facetas
         
-        return transaccion
+        return facetas
+    
+    @staticmethod
+    def invalidar():
+        with FacetasService._lock:
+            FacetasService._cache.clear()
 
-class CambioDivisasService:
-    """Servicio para cambio de divisas"""
+@event.listens_for(Session, 'after_flush')
+def _registrar_movimientos_stock(session, flush_context):
+    """Llevar al libro de stock los cambios hechos a través del ORM"""
+    movimientos = []
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Producto):
+            continue
+        if obj in session.new:
+            if obj.stock:
+                movimientos.append({'producto_id': obj.id, 'tipo': 'inicial', 'cantidad': obj.stock})
+            continue
+        
+        historial = inspect(obj).attrs.stock.history
+        anterior = historial.deleted[0] if historial.deleted else None
+        if historial.added and anterior is not None and historial.added[0] != anterior:
+            movimientos.append({'producto_id': obj.id, 'tipo': 'ajuste', 'cantidad': historial.added[0] - anterior})
     
-    # Tasas de cambio simuladas (en un caso real se obtendría de una API externa)
-    TASAS_CAMBIO = {
-        'CLP_USD': 0.0011,  # 1 CLP = 0.0011 USD
-        'USD_CLP': 900.0,   # 1 USD = 900 CLP
-        'CLP_EUR': 0.00095, # 1 CLP = 0.00095 EUR
-        'EUR_CLP': 1050.0,  # 1 EUR = 1050 CLP
-        'USD_EUR': 0.85,    # 1 USD = 0.85 EUR
-        'EUR_USD': 1.18     # 1 EUR = 1.18 USD
-    }
+    MovimientoStockService.registrar(session.connection(), movimientos)
+
+MODELOS_CATALOGO = (Producto, Categoria, ConversionMoneda)
+
+@event.listens_for(Session, 'after_flush')
+def _registrar_cambios_catalogo(session, flush_context):
+    """Guardar el estado de las filas del catálogo escritas en este flush"""
+    cambios = session.info.setdefault('cambios_catalogo', {})
     
-    @staticmethod
-    def obtener_tasa_cambio(moneda_origen, moneda_destino):
-        """Obtener tasa de cambio entre dos monedas"""
-        if moneda_origen == moneda_destino:
-            return 1.0
-        
-        clave = f"{moneda_origen}_{moneda_destino}"
-        
-        # Buscar en base de datos primero
-        conversion = ConversionMoneda.query.filter_by(
-            moneda_origen=moneda_origen,
-            moneda_destino=moneda_destino,
-            activa=True
-        ).first()
-        
-        if conversion:
-            return conversion.tasa_cambio
-        
-        # Si no está en BD, usar tasas simuladas
-        if clave in CambioDivisasService.TASAS_CAMBIO:
-            tasa = CambioDivisasService.TASAS_CAMBIO[clave]
-            
-            # Guardar en BD para futuras consultas
-            nueva_conversion = ConversionMoneda(
-                moneda_origen=moneda_origen,
-                moneda_destino=moneda_destino,
-                tasa_cambio=tasa
-            )
-            db.session.add(nueva_conversion)
-            db.session.commit()
-            
-            return tasa
-        
-        raise ValueError(f"Conversión no disponible para {moneda_origen} a {moneda_destino}")
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, MODELOS_CATALOGO):
+            cambios[(type(obj).__name__, obj.id)] = obj.to_dict()
     
-    @staticmethod
-    def convertir_monto(monto, moneda_origen, moneda_destino):
-        """Convertir un monto de una moneda a otra"""
-        if not monto or monto <= 0:
-            raise ValueError("El monto debe ser mayor a 0")
-        
-        tasa = CambioDivisasService.obtener_tasa_cambio(moneda_origen, moneda_destino)
-        monto_convertido = round(monto * tasa, 2)
+    for obj in session.deleted:
+        if isinstance(obj, MODELOS_CATALOGO):
+            cambios[(type(obj).__name__, obj.id)] = None
+
+@event.listens_for(Session, 'after_flush')
+def _versionar_cambios_catalogo(session, flush_context):
+    if any(isinstance(obj, MODELOS_CATALOGO) for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        CatalogoService.incrementar_version(session)
+
+@event.listens_for(Session, 'do_orm_execute')
+def _versionar_escrituras_directas(orm_execute_state):
+    """Los UPDATE/DELETE directos sobre el catálogo (p. ej. stock) también cambian la versión"""
+    if orm_execute_state.is_select:
+        return
+    if any(mapper.class_ in (Producto, Categoria) for mapper in orm_execute_state.all_mappers):
+        CatalogoService.incrementar_version(orm_execute_state.session)
+
+@event.listens_for(Session, 'after_flush')
+def _recalcular_precios_moneda(session, flush_context):
+    """Mantener precio_moneda al día dentro de la misma transacción"""
+    connection = session.connection()
+    
+    if any(isinstance(obj, ConversionMoneda) for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        # Tasas escritas en esta transacción: recalcular todo con lo que hay en BD
+        monedas, _, _, fracciones = CambioDivisasService.construir_tasas(*CambioDivisasService.leer_tasas())
+        CatalogoService.recalcular_precios(connection, CambioDivisasService.fracciones_desde_pivote(monedas, fracciones))
+    else:
+        productos_ids = [
+            obj.id for obj in list(session.new) + list(session.dirty)
+            if isinstance(obj, Producto) and (obj in session.new or inspect(obj).attrs.precio.history.has_changes())
+        ]
+        if productos_ids:
+            snapshot = CambioDivisasService.obtener_snapshot_tasas()
+            fracciones = CambioDivisasService.fracciones_desde_pivote(snapshot['monedas'], snapshot['fracciones'])
+            CatalogoService.recalcular_precios(connection, fracciones, productos_ids)
+    
+    eliminados = [obj.id for obj in session.deleted if isinstance(obj, Producto)]
+    if eliminados:
+        connection.execute(delete(PrecioMoneda).where(PrecioMoneda.producto_id.in_(eliminados)))
+
+@event.listens_for(Session, 'after_commit')
+def _aplicar_cambios_catalogo(session):
+    versiones = session.info.pop('version_catalogo', None)
+    if versiones:
+        # Si otro proceso escribió entre medio, las cachés quedan descartadas
+        # y los cambios siguientes no tienen efecto
+        CatalogoService.avanzar_version(*versiones)
+    
+    cambios = session.info.pop('cambios_catalogo', None)
+    if cambios:
+        CatalogoService.aplicar_cambios(cambios)
+        AutocompletarService.aplicar_cambios(cambios)
+        if any(modelo == 'Producto' for modelo, _ in cambios):
+            FacetasService.invalidar()
+        if any(modelo == 'ConversionMoneda' for modelo, _ in cambios):
+            CambioDivisasService.invalidar_tasas()
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_cambios_catalogo(session):
+    session.info.pop('cambios_catalogo', None)
+    session.info.pop('version_catalogo', None)
+
+@event.listens_for(db.metadata, 'after_create')
+@event.listens_for(db.metadata, 'after_drop')
+def _reiniciar_catalogo(target, connection, **kw):
+    CatalogoService.invalidar_derivados()
+    CambioDivisasService.invalidar_tasas()
+    CambioDivisasService.invalidar_historial()
+    ReservaStockService.invalidar()
+
+# Respuestas en streaming para listados grandes
+TAMANO_LOTE_STREAMING = 500
+
+def formato_streaming():
+    """Determinar si el cliente pidió un listado en streaming
+    
+    Devuelve 'ndjson' (``?formato=ndjson`` o ``Accept: application/x-ndjson``),
+    'json' (``?stream=1``, arreglo JSON enviado por partes) o None.
+    """
+    formato = request.args.get('formato')
+    if formato == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+        return 'ndjson'
+    
+    if formato == 'stream' or request.args.get('stream') in ('1', 'true'):
+        return 'json'
+    
+    return None
+
+def respuesta_streaming(query, formato, serializar=lambda obj: obj.to_dict()):
+    """Enviar los resultados de una consulta fila a fila
+    
+    Usa un cursor del lado del servidor (``yield_per``), así la memoria se
+    mantiene constante y el primer byte sale antes de leer la última fila.
+    """
+    filas = query.yield_per(TAMANO_LOTE_STREAMING)
+    
+    if formato == 'ndjson':
+        def generar():
+            for fila in filas:
+                yield json.dumps(serializar(fila), ensure_ascii=False) + '\n'
         
+        return Response(stream_with_context(generar()), mimetype='application/x-ndjson')
+    
+    def generar():
+        yield '['
+        separador = ''
+        for fila in filas:
+            yield separador + json.dumps(serializar(fila), ensure_ascii=False)
+            separador = ','
+        yield ']'
+    
+    return Response(stream_with_context(generar()), mimetype='application/json')
+
+# Serialización rápida por columnas (sparse fieldsets)
+def columnas_publicas(modelo):
+    """Columnas del modelo que se exponen en la API (sin las internas)"""
+    internas = getattr(modelo, 'COLUMNAS_INTERNAS', ())
+    return [getattr(modelo, c.key) for c in modelo.__table__.columns if c.key not in internas]
+
+def columnas_solicitadas(modelo, fields):
+    """Traducir ``fields=nombre,precio`` a columnas del modelo
+    
+    La clave primaria (``id``) se incluye siempre. Devuelve None si no se
+    pidieron campos.
+    """
+    if not fields:
+        return None
+    
+    clave = [columna.key for columna in modelo.__table__.primary_key.columns]
+    nombres = clave + [nombre.strip() for nombre in fields.split(',') if nombre.strip()]
+    nombres = list(dict.fromkeys(nombres))
+    
+    disponibles = {columna.key for columna in columnas_publicas(modelo)}
+    desconocidos = [nombre for nombre in nombres if nombre not in disponibles]
+    if desconocidos:
+        raise ValueError(f"Campos no válidos: {', '.join(desconocidos)}")
+    
+    return [getattr(modelo, nombre) for nombre in nombres]
+
+def serializador_columnas(columnas):
+    """Crear una función que convierte filas de columnas en diccionarios"""
+    nombres = [columna.key for columna in columnas]
+    
+    def serializar(fila):
         return {
-            'monto_original': monto,
-            'moneda_origen': moneda_origen,
-            'monto_convertido': monto_convertido,
-            'moneda_destino': moneda_destino,
-            'tasa_cambio': tasa,
-            'fecha_conversion': datetime.utcnow().isoformat()
+            nombre: valor.isoformat() if isinstance(valor, datetime) else valor
+            for nombre, valor in zip(nombres, fila)
         }
     
-    @staticmethod
-    def actualizar_tasas_cambio():
-        """Actualizar tasas de cambio (simulado - en producción consultaría API externa)"""
-        import random
-        
-        actualizadas = 0
-        for clave, tasa_base in CambioDivisasService.TASAS_CAMBIO.items():
-            moneda_origen, moneda_destino = clave.split('_')
-            
-            # Simular fluctuación del ±5%
-            variacion = random.uniform(-0.05, 0.05)
-            nueva_tasa = round(tasa_base * (1 + variacion), 6)
-            
-            # Buscar conversión existente
-            conversion = ConversionMoneda.query.filter_by(
-                moneda_origen=moneda_origen,
-                moneda_destino=moneda_destino,
-                activa=True
-            ).first()
-            
-            if conversion:
-                conversion.tasa_cambio = nueva_tasa
-                conversion.fecha_actualizacion = datetime.utcnow()
-            else:
-                nueva_conversion = ConversionMoneda(
-                    moneda_origen=moneda_origen,
-                    moneda_destino=moneda_destino,
-                    tasa_cambio=nueva_tasa
-                )
-                db.session.add(nueva_conversion)
-            
-            actualizadas += 1
-        
-        db.session.commit()
-        return f"Se actualizaron {actualizadas} tasas de cambio"
+    return serializar
+
+def respuesta_listado(query, modelo):
+    """Responder un listado completo, en streaming o con campos seleccionados
+    
+    Con ``fields=`` se seleccionan sólo esas columnas como tuplas simples, sin
+    hidratar instancias del ORM ni pasar por ``to_dict()``.
+    """
+    try:
+        columnas = columnas_solicitadas(modelo, request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    serializar = lambda obj: obj.to_dict()
+    if columnas:
+        query = query.with_entities(*columnas)
+        serializar = serializador_columnas(columnas)
+    
+    formato = formato_streaming()
+    if formato:
+        return respuesta_streaming(query, formato, serializar)
+    
+    return jsonify([serializar(fila) for fila in query])
 
 # Endpoints de la API
 
@@ -509,8 +3114,67 @@ def gestionar_productos():
     if request.method == 'GET':
         # Obtener productos con búsqueda opcional
         buscar = request.args.get('buscar')
-        productos = ProductoService.obtener_productos(buscar)
-        return jsonify([producto.to_dict() for producto in productos])
+        cursor = request.args.get('cursor')
+        after_id = request.args.get('after_id')
+        limit = request.args.get('limit')
+        facetas = request.args.get('facetas') in ('1', 'true')
+        
+        if cursor is None and after_id is None and limit is None:
+            if not facetas:
+                return respuesta_listado(ProductoService.consultar_productos(buscar), Producto)
+            
+            # Con facetas la respuesta es un objeto, como en la paginación
+            if formato_streaming():
+                return jsonify({'error': 'facetas no está disponible para listados en streaming'}), 400
+            try:
+                columnas = columnas_solicitadas(Producto, request.args.get('fields'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+            query = ProductoService.consultar_productos(buscar)
+            serializar = lambda producto: producto.to_dict()
+            if columnas:
+                query = query.with_entities(*columnas)
+                serializar = serializador_columnas(columnas)
+            
+            return jsonify({
+                'productos': [serializar(producto) for producto in query],
+                'facetas': FacetasService.obtener(buscar)
+            })
+        
+        # Paginación por cursor
+        try:
+            after_id = int(after_id) if after_id is not None else None
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            return jsonify({'error': 'after_id y limit deben ser enteros'}), 400
+        
+        try:
+            if cursor is not None:
+                after_id = ProductoService.decodificar_cursor(cursor)
+            
+            columnas = columnas_solicitadas(Producto, request.args.get('fields'))
+            
+            productos, next_cursor = ProductoService.obtener_pagina_productos(
+                buscar=buscar,
+                after_id=after_id,
+                limit=limit,
+                columnas=columnas
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        serializar = serializador_columnas(columnas) if columnas else (lambda producto: producto.to_dict())
+        
+        respuesta = {
+            'productos': [serializar(producto) for producto in productos],
+            'next_cursor': next_cursor
+        }
+        
+        if facetas:
+            respuesta['facetas'] = FacetasService.obtener(buscar)
+        
+        return jsonify(respuesta)
     
     elif request.method == 'POST':
         # Crear nuevo producto
@@ -527,6 +3191,35 @@ def gestionar_productos():
         except Exception as e:
             return jsonify({'error': 'Error interno del servidor'}), 500
 
+@app.route('/productos/autocompletar', methods=['GET'])
+def autocompletar_productos():
+    """Sugerir productos por prefijo del nombre (índice en memoria)"""
+    texto = request.args.get('q', '')
+    
+    try:
+        limite = int(request.args.get('limite', AutocompletarService.LIMITE_DEFECTO))
+    except ValueError:
+        return jsonify({'error': 'limite debe ser un entero'}), 400
+    
+    if limite <= 0:
+        return jsonify({'error': 'El límite debe ser mayor a 0'}), 400
+    
+    # sugerir ya compara la versión del catálogo; el snapshot se lee sin repetirla
+    ids = AutocompletarService.sugerir(texto, limite)
+    productos, _ = CatalogoService.obtener_snapshot(verificar=False)
+    sugerencias = []
+    for producto_id in ids:
+        producto = productos.get(producto_id)
+        if producto:
+            sugerencias.append({
+                'id': producto['id'],
+                'nombre': producto['nombre'],
+                'precio': producto['precio'],
+                'stock': producto['stock']
+            })
+    
+    return jsonify(sugerencias)
+
 @app.route('/productos/<int:producto_id>', methods=['GET'])
 def obtener_producto(producto_id):
     """Obtener producto específico por ID"""
@@ -537,6 +3230,43 @@ def obtener_producto(producto_id):
     
     return jsonify(producto.to_dict())
 
+MAXIMO_ITEMS_STOCK_LOTE = 100000
+
+@app.route('/productos/<int:producto_id>/stock', methods=['GET'])
+def consultar_stock_producto(producto_id):
+    """Stock actual, o el que había en ``?fecha=`` (ISO 8601) según el libro de movimientos"""
+    fecha = request.args.get('fecha')
+    if not fecha:
+        estado = ReservaStockService.disponibles([producto_id]).get(producto_id)
+        if estado is None:
+            return jsonify({'error': 'Producto no encontrado'}), 404
+        return jsonify({'producto_id': producto_id, **estado})
+    
+    try:
+        stock = MovimientoStockService.stock_a_la_fecha(producto_id, parsear_fecha(fecha))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if stock is None:
+        return jsonify({'error': 'Producto no encontrado'}), 404
+    return jsonify(stock)
+
+@app.route('/productos/<int:producto_id>/movimientos', methods=['GET'])
+def listar_movimientos_producto(producto_id):
+    """Listar los movimientos de stock de un producto (más antiguos primero)"""
+    query = MovimientoStock.query.filter_by(producto_id=producto_id)
+    
+    tipo = request.args.get('tipo')
+    if tipo:
+        query = query.filter_by(tipo=tipo)
+    
+    return respuesta_listado(query.order_by(MovimientoStock.id), MovimientoStock)
+
+@app.route('/inventario/compactar', methods=['POST'])
+def compactar_movimientos_stock():
+    """Guardar snapshots del libro de stock (también se hace cada hora en el mantenimiento periódico)"""
+    return jsonify({'snapshots': MovimientoStockService.compactar()})
+
 @app.route('/productos/<int:producto_id>/stock', methods=['PUT'])
 def actualizar_stock_producto(producto_id):
     """Actualizar stock de un producto"""
@@ -555,6 +3285,61 @@ def actualizar_stock_producto(producto_id):
     except Exception as e:
         return jsonify({'error': 'Error interno del servidor'}), 500
 
+@app.route('/productos/<int:producto_id>/stock', methods=['PATCH'])
+def ajustar_stock_producto(producto_id):
+    """Sumar o restar unidades al stock de forma atómica ({"delta": -3})"""
+    try:
+        data = request.get_json()
+        if not data or 'delta' not in data:
+            return jsonify({'error': 'Delta requerido'}), 400
+        
+        resultado = ProductoService.ajustar_stock(
+            producto_id,
+            data['delta'],
+            tipo=data.get('tipo', 'ajuste'),
+            pedido_id=data.get('pedido_id'),
+            transaccion_id=data.get('transaccion_id'),
+            detalle=data.get('detalle')
+        )
+        
+        return jsonify(resultado)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/productos/stock/lote', methods=['POST'])
+def sincronizar_stock_productos():
+    """Actualizar el stock de muchos productos en una llamada (sincronización con ERP)"""
+    try:
+        data = request.get_json()
+        items = data.get('items') if isinstance(data, dict) else data
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Se requiere una lista de items'}), 400
+        
+        if len(items) > MAXIMO_ITEMS_STOCK_LOTE:
+            return jsonify({'error': f'El lote no puede superar {MAXIMO_ITEMS_STOCK_LOTE} items'}), 400
+        
+        if isinstance(data, dict) and 'tamano_lote' in data:
+            tamano_lote = data['tamano_lote']
+        else:
+            tamano_lote = request.args.get('tamano_lote', type=int)
+        if tamano_lote is not None and (not isinstance(tamano_lote, int) or isinstance(tamano_lote, bool) or tamano_lote <= 0):
+            return jsonify({'error': 'tamano_lote debe ser un entero positivo'}), 400
+        
+        resultados = ProductoService.sincronizar_stock(items, tamano_lote)
+        
+        return jsonify({
+            'resultados': resultados,
+            'total': len(resultados),
+            'errores': sum(1 for resultado in resultados if 'error' in resultado)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
 @app.route('/categorias', methods=['GET', 'POST'])
 def gestionar_categorias():
     """Gestionar categorías (GET: listar, POST: crear)"""
@@ -590,8 +3375,7 @@ def gestionar_clientes():
     
     if request.method == 'GET':
         # Obtener todos los clientes
-        clientes = Cliente.query.all()
-        return jsonify([cliente.to_dict() for cliente in clientes])
+        return respuesta_listado(Cliente.query, Cliente)
     
     elif request.method == 'POST':
         # Crear nuevo cliente
@@ -627,8 +3411,7 @@ def gestionar_sucursales():
     
     if request.method == 'GET':
         # Obtener todas las sucursales
-        sucursales = Sucursal.query.all()
-        return jsonify([sucursal.to_dict() for sucursal in sucursales])
+        return respuesta_listado(Sucursal.query, Sucursal)
     
     elif request.method == 'POST':
         # Crear nueva sucursal
@@ -652,6 +3435,59 @@ def gestionar_sucursales():
         except Exception as e:
             return jsonify({'error': 'Error interno del servidor'}), 500
 
+@app.route('/sucursales/<int:sucursal_id>/inventario', methods=['GET', 'PUT'])
+def gestionar_inventario_sucursal(sucursal_id):
+    """Inventario de una sucursal (GET: listar, PUT: fijar stock de varios productos)"""
+    
+    if request.method == 'GET':
+        query = InventarioSucursal.query.filter_by(sucursal_id=sucursal_id).order_by(InventarioSucursal.producto_id)
+        return respuesta_listado(query, InventarioSucursal)
+    
+    try:
+        data = request.get_json()
+        items = data.get('items') if isinstance(data, dict) else data
+        
+        inventario = InventarioService.actualizar_inventario(sucursal_id, items)
+        return jsonify(inventario)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/inventario/disponibilidad', methods=['GET'])
+def consultar_disponibilidad():
+    """Sucursales con al menos ``cantidad`` unidades de cada producto
+    
+    ``productos=1,2,3`` con ``cantidad=N`` (1 por defecto), o ``productos=1:5,2:3``
+    para indicar una cantidad por producto.
+    """
+    try:
+        cantidad_defecto = int(request.args.get('cantidad', 1))
+    except ValueError:
+        cantidad_defecto = None
+    if cantidad_defecto is None or cantidad_defecto <= 0:
+        return jsonify({'error': 'cantidad debe ser un entero positivo'}), 400
+    
+    try:
+        cantidades = {}
+        for parte in (request.args.get('productos') or '').split(','):
+            if not parte.strip():
+                continue
+            producto_id, _, cantidad = parte.partition(':')
+            cantidades[int(producto_id)] = int(cantidad) if cantidad else cantidad_defecto
+    except ValueError:
+        return jsonify({'error': 'productos debe ser una lista de IDs (opcionalmente id:cantidad)'}), 400
+    
+    if any(cantidad <= 0 for cantidad in cantidades.values()):
+        return jsonify({'error': 'cantidad debe ser un entero positivo'}), 400
+    
+    try:
+        solo_activas = request.args.get('todas', '').lower() not in ('1', 'true')
+        return jsonify(InventarioService.disponibilidad(cantidades, solo_activas))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 # Endpoints para Pedidos entre Sucursales
 @app.route('/pedidos-sucursal', methods=['GET', 'POST'])
 def gestionar_pedidos_sucursal():
@@ -672,6 +3508,10 @@ def gestionar_pedidos_sucursal():
         if estado:
             query = query.filter_by(estado=estado)
         
+        formato = formato_streaming()
+        if formato:
+            return respuesta_streaming(query, formato)
+        
         pedidos = query.all()
         return jsonify([pedido.to_dict() for pedido in pedidos])
     
@@ -712,13 +3552,15 @@ def iniciar_pago_webpay():
     """Iniciar transacción de pago con WebPay"""
     try:
         data = request.get_json()
-        if not data or not data.get('monto'):
+        if not data or not (data.get('monto') or data.get('cotizacion')):
             return jsonify({'error': 'Monto requerido'}), 400
         
         resultado = WebPayService.iniciar_transaccion(
-            monto=data['monto'],
+            monto=data.get('monto'),
             cliente_id=data.get('cliente_id'),
-            detalle=data.get('detalle', '')
+            detalle=data.get('detalle', ''),
+            cotizacion=data.get('cotizacion'),
+            items=data.get('items')
         )
         
         return jsonify(resultado), 201
@@ -761,10 +3603,21 @@ def listar_transacciones_webpay():
     if cliente_id:
         query = query.filter_by(cliente_id=cliente_id)
     
-    transacciones = query.order_by(TransaccionPago.fecha_transaccion.desc()).all()
-    return jsonify([transaccion.to_dict() for transaccion in transacciones])
+    query = query.order_by(TransaccionPago.fecha_transaccion.desc())
+    return respuesta_listado(query, TransaccionPago)
+
+@app.route('/webpay/transacciones/resumen', methods=['GET'])
+def resumen_transacciones_webpay():
+    """Cantidad y monto total de transacciones de WebPay"""
+    resumen = WebPayService.resumen_transacciones(
+        estado=request.args.get('estado'),
+        cliente_id=request.args.get('cliente_id')
+    )
+    return jsonify(resumen)
 
 # Endpoints para Cambio de Divisas
+MAXIMO_CONVERSIONES_LOTE = 10000
+
 @app.route('/divisas/convertir', methods=['POST'])
 def convertir_divisas():
     """Convertir monto entre divisas"""
@@ -773,10 +3626,13 @@ def convertir_divisas():
         if not data or not all(k in data for k in ['monto', 'moneda_origen', 'moneda_destino']):
             return jsonify({'error': 'Monto, moneda_origen y moneda_destino son requeridos'}), 400
         
+        fecha = data.get('fecha') or request.args.get('fecha')
+        
         resultado = CambioDivisasService.convertir_monto(
             monto=data['monto'],
             moneda_origen=data['moneda_origen'].upper(),
-            moneda_destino=data['moneda_destino'].upper()
+            moneda_destino=data['moneda_destino'].upper(),
+            fecha=parsear_fecha(fecha) if fecha else None
         )
         
         return jsonify(resultado)
@@ -786,6 +3642,111 @@ def convertir_divisas():
     except Exception as e:
         return jsonify({'error': 'Error interno del servidor'}), 500
 
+# Segundos que navegadores y proxies pueden reutilizar una conversión GET
+# sin revalidar; después revalidan con If-None-Match contra el ETag
+MAX_AGE_CONVERSION = 60
+
+@app.route('/convertir', methods=['GET'])
+def convertir_divisas_get():
+    """Convertir monto entre divisas por GET (cacheable, usado por index.html)
+    
+    El ETag es la tasa del par en punto fijo: cambia exactamente cuando una
+    nueva versión de las tasas cambia ese par, y es el mismo en todos los
+    procesos que tienen las mismas tasas. Con ``fecha=`` (ISO 8601) usa la
+    tasa vigente en ese momento; esa fecha va en el ETag y la respuesta no
+    se guarda en cachés compartidas, porque el historial aún puede recibir
+    tasas de ese momento.
+    """
+    monto = request.args.get('monto', type=float)
+    moneda_origen = (request.args.get('moneda_origen') or '').upper()
+    moneda_destino = (request.args.get('moneda_destino') or '').upper()
+    fecha = request.args.get('fecha')
+    
+    if monto is None or not moneda_origen or not moneda_destino:
+        return jsonify({'error': 'Monto, moneda_origen y moneda_destino son requeridos'}), 400
+    
+    try:
+        resultado = CambioDivisasService.convertir_monto(
+            monto, moneda_origen, moneda_destino,
+            fecha=parsear_fecha(fecha) if fecha else None
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # La fecha de la conversión cambiaría el cuerpo en cada petición
+    resultado.pop('fecha_conversion', None)
+    
+    respuesta = jsonify(resultado)
+    etag = f"{moneda_origen}-{moneda_destino}-{Dinero.a_tasa(resultado['tasa_cambio'])}"
+    if 'fecha_tasa' in resultado:
+        respuesta.set_etag(f"{etag}-{resultado['fecha_tasa']}")
+        respuesta.cache_control.no_cache = True
+    else:
+        respuesta.set_etag(etag)
+        respuesta.cache_control.public = True
+        respuesta.cache_control.max_age = MAX_AGE_CONVERSION
+    return respuesta.make_conditional(request)
+
+@app.route('/divisas/convertir-lote', methods=['POST'])
+def convertir_divisas_lote():
+    """Convertir un lote de montos entre divisas en una sola llamada"""
+    try:
+        data = request.get_json()
+        conversiones = data.get('conversiones') if isinstance(data, dict) else data
+        
+        if not isinstance(conversiones, list) or not conversiones:
+            return jsonify({'error': 'Se requiere una lista de conversiones'}), 400
+        
+        if len(conversiones) > MAXIMO_CONVERSIONES_LOTE:
+            return jsonify({'error': f'El lote no puede superar {MAXIMO_CONVERSIONES_LOTE} conversiones'}), 400
+        
+        fecha = (data.get('fecha') if isinstance(data, dict) else None) or request.args.get('fecha')
+        try:
+            fecha = parsear_fecha(fecha) if fecha else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        resultados = CambioDivisasService.convertir_lote(conversiones, fecha)
+        
+        return jsonify({
+            'resultados': resultados,
+            'total': len(resultados),
+            'errores': sum(1 for resultado in resultados if 'error' in resultado),
+            'fecha_conversion': datetime.utcnow().isoformat()
+        })
+        
+    except Exception as e:
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/divisas/cotizar', methods=['POST'])
+def cotizar_divisas():
+    """Crear una cotización con tasa bloqueada por unos minutos"""
+    try:
+        data = request.get_json()
+        if not data or not all(k in data for k in ['monto', 'moneda_origen', 'moneda_destino']):
+            return jsonify({'error': 'Monto, moneda_origen y moneda_destino son requeridos'}), 400
+        
+        cotizacion = CotizacionService.crear(
+            monto=data['monto'],
+            moneda_origen=data['moneda_origen'].upper(),
+            moneda_destino=data['moneda_destino'].upper()
+        )
+        
+        return jsonify(cotizacion), 201
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@app.route('/divisas/cotizaciones/<token>', methods=['GET'])
+def obtener_cotizacion(token):
+    """Consultar una cotización vigente"""
+    try:
+        return jsonify(CotizacionService.obtener(token))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
 @app.route('/divisas/tasas', methods=['GET'])
 def obtener_tasas_cambio():
     """Obtener todas las tasas de cambio disponibles"""
@@ -811,61 +3772,37 @@ def obtener_catalogo_completo():
         moneda = request.args.get('moneda', 'CLP').upper()
         categoria_id = request.args.get('categoria_id')
         buscar = request.args.get('buscar')
+        monedas = request.args.get('monedas')
         
-        # Obtener productos
-        query = Producto.query
-        
-        if categoria_id:
-            query = query.filter_by(categoria_id=categoria_id)
-        
-        if buscar:
-            query = query.filter(
-                Producto.nombre.contains(buscar) | 
-                Producto.descripcion.contains(buscar)
-            )
-        
-        productos = query.all()
-        
-        # Convertir precios si es necesario
-        catalogo = []
-        for producto in productos:
-            item = producto.to_dict()
-            
-            if moneda != 'CLP':
-                try:
-                    conversion = CambioDivisasService.convertir_monto(
-                        producto.precio, 'CLP', moneda
-                    )
-                    item['precio_original'] = producto.precio
-                    item['precio'] = conversion['monto_convertido']
-                    item['moneda'] = moneda
-                    item['tasa_cambio'] = conversion['tasa_cambio']
-                except:
-                    item['precio_original'] = producto.precio
-                    item['moneda'] = 'CLP'
-                    item['error_conversion'] = f'No se pudo convertir a {moneda}'
-            else:
-                item['moneda'] = 'CLP'
-            
-            # Agregar información de categoría
-            if producto.categoria_rel:
-                item['categoria'] = producto.categoria_rel.to_dict()
-            
-            catalogo.append(item)
+        if monedas:
+            monedas = list(dict.fromkeys(
+                codigo.strip().upper() for codigo in monedas.split(',') if codigo.strip()
+            ))
         
-        # Obtener categorías
-        categorias = Categoria.query.all()
+        # Leer el catálogo materializado en memoria, comparando la versión una
+        # sola vez para el catálogo y las facetas
+        snapshot = CatalogoService.obtener_snapshot()
+        try:
+            catalogo, categorias = CatalogoService.consultar(moneda, categoria_id, buscar, monedas, snapshot)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify({
+        respuesta = {
             'productos': catalogo,
-            'categorias': [cat.to_dict() for cat in categorias],
+            'categorias': categorias,
             'total_productos': len(catalogo),
             'moneda_consulta': moneda,
+            'facetas': FacetasService.obtener(buscar, verificar=False),
             'filtros_aplicados': {
                 'categoria_id': categoria_id,
                 'buscar': buscar
             }
-        })
+        }
+        
+        if monedas:
+            respuesta['monedas_consulta'] = monedas
+        
+        return jsonify(respuesta)
         
     except Exception as e:
         return jsonify({'error': 'Error interno del servidor'}), 500
@@ -885,6 +3822,11 @@ def init_db():
     with app.app_context():
         db.create_all()
         
+        # Migrar bases creadas con versiones anteriores del esquema
+        if db.engine.dialect.name == 'sqlite':
+            with db.engine.begin() as connection:
+                migrar_esquema(connection)
+        
         # Crear categorías de ejemplo si no existen
         if Categoria.query.count() == 0:
             categorias_ejemplo = [
@@ -941,23 +3883,61 @@ def init_db():
             db.session.commit()
             print("✅ Clientes de ejemplo creados")
         
+        # Abrir el libro de stock de productos que no tienen movimientos
+        db.session.execute(text("""
+            INSERT INTO movimiento_stock (producto_id, tipo, cantidad, detalle, fecha)
+            SELECT id, 'inicial', stock, 'Apertura del libro de stock', :fecha FROM producto
+            WHERE stock <> 0 AND NOT EXISTS (SELECT 1 FROM movimiento_stock m WHERE m.producto_id = producto.id)
+        """).bindparams(bindparam('fecha', type_=db.DateTime)), {'fecha': datetime.utcnow()})
+        db.session.commit()
+        
         # Inicializar tasas de cambio
         if ConversionMoneda.query.count() == 0:
             resultado = CambioDivisasService.actualizar_tasas_cambio()
             print(f"✅ {resultado}")
+        elif PrecioMoneda.query.count() == 0:
+            # Bases creadas antes de precio_moneda: materializar los precios
+            snapshot = CambioDivisasService.obtener_snapshot_tasas()
+            CatalogoService.recalcular_precios(
+                db.session.connection(),
+                CambioDivisasService.fracciones_desde_pivote(snapshot['monedas'], snapshot['fracciones'])
+            )
+            db.session.commit()
+
+@app.before_request
+def _iniciar_tareas_de_fondo():
+    """Arrancar los hilos de fondo en cada worker, después de un eventual fork
+    
+    El mantenimiento se desactiva con FERRETERIA_MANTENIMIENTO=0; el refresco
+    de tasas corre si FERRETERIA_REFRESCO_TASAS_SEGUNDOS está definido.
+    """
+    if app.config.get('TESTING'):
+        return
+    if os.environ.get('FERRETERIA_MANTENIMIENTO', '1') != '0':
+        MantenimientoService.iniciar(app)
+    if os.environ.get('FERRETERIA_REFRESCO_TASAS_SEGUNDOS'):
+        RefrescoTasasService.iniciar(app, float(os.environ['FERRETERIA_REFRESCO_TASAS_SEGUNDOS']))
 
 if __name__ == '__main__':
     init_db()
+    if not os.environ.get('FERRETERIA_REFRESCO_TASAS_SEGUNDOS'):
+        RefrescoTasasService.iniciar(app, 3600)
     print("🚀 Iniciando API de Ferretería...")
     print("📋 Endpoints disponibles:")
     print("   === BÁSICOS ===")
     print("   GET  /health - Health check")
     print("   GET  /catalogo - Catálogo completo con conversión de monedas")
     print("   === PRODUCTOS ===")
-    print("   GET  /productos - Listar productos")
+    print("   GET  /productos - Listar productos (?cursor=&limit= para paginar)")
     print("   POST /productos - Crear producto")
+    print("   GET  /productos/autocompletar?q= - Sugerencias por prefijo")
     print("   GET  /productos/<id> - Obtener producto")
     print("   PUT  /productos/<id>/stock - Actualizar stock")
+    print("   PATCH /productos/<id>/stock - Ajustar stock con un delta")
+    print("   POST /productos/stock/lote - Sincronizar stock de muchos productos")
+    print("   GET  /productos/<id>/stock?fecha= - Stock a una fecha")
+    print("   GET  /productos/<id>/movimientos - Movimientos de stock")
+    print("   POST /inventario/compactar - Compactar el libro de stock")
     print("   === CATEGORÍAS ===")
     print("   GET  /categorias - Listar categorías")
     print("   POST /categorias - Crear categoría")
@@ -967,6 +3947,9 @@ if __name__ == '__main__':
     print("   === SUCURSALES ===")
     print("   GET  /sucursales - Listar sucursales")
     print("   POST /sucursales - Crear sucursal")
+    print("   GET  /sucursales/<id>/inventario - Inventario de la sucursal")
+    print("   PUT  /sucursales/<id>/inventario - Fijar stock en la sucursal")
+    print("   GET  /inventario/disponibilidad?productos=&cantidad= - Sucursales con stock")
     print("   === PEDIDOS ENTRE SUCURSALES ===")
     print("   GET  /pedidos-sucursal - Listar pedidos")
     print("   POST /pedidos-sucursal - Crear pedido")
@@ -975,8 +3958,13 @@ if __name__ == '__main__':
     print("   POST /webpay/iniciar - Iniciar transacción")
     print("   POST /webpay/confirmar - Confirmar transacción")
     print("   GET  /webpay/transacciones - Listar transacciones")
+    print("   GET  /webpay/transacciones/resumen - Total de transacciones")
     print("   === CAMBIO DE DIVISAS ===")
     print("   POST /divisas/convertir - Convertir montos")
+    print("   GET  /convertir?monto=&moneda_origen=&moneda_destino= - Convertir (cacheable)")
+    print("   POST /divisas/convertir-lote - Convertir un lote de montos")
+    print("   POST /divisas/cotizar - Cotizar con tasa bloqueada")
+    print("   GET  /divisas/cotizaciones/<token> - Consultar cotización")
     print("   GET  /divisas/tasas - Obtener tasas de cambio")
     print("   POST /divisas/actualizar-tasas - Actualizar tasas")
     print("🌐 Servidor ejecutándose en: http://127.0.0.1:5000")
@@ -4,10 +4,14 @@ Configuración de pytest para las pruebas de la API Ferretería
 import pytest
 import sys
 import os
+from contextlib import contextmanager
 
 # Agregar el directorio raíz al path para importar app
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+# Las pruebas de app_ferreteria usan una base de datos en memoria
+os.environ.setdefault('FERRETERIA_DATABASE_URI', 'sqlite:///:memory:')
+
 from app import app, db, Producto, Categoria, Cliente
 
 @pytest.fixture
@@ -23,6 +27,43 @@ def client():
             yield client
             db.drop_all()
 
+@pytest.fixture(name='app')
+def ferreteria_app():
+    """Aplicación app_ferreteria con base de datos limpia por prueba"""
+    from app_ferreteria import app as ferreteria, db as ferreteria_db, CatalogoService
+    ferreteria.config['TESTING'] = True
+
+    with ferreteria.app_context():
+        ferreteria_db.create_all()
+    # Las cachés de otra prueba no deben sobrevivir al cambio de base
+    CatalogoService.invalidar_derivados()
+    yield ferreteria
+    with ferreteria.app_context():
+        ferreteria_db.session.remove()
+        ferreteria_db.drop_all()
+
+@pytest.fixture
+def contar_sentencias():
+    """Context manager que junta el SQL ejecutado por app_ferreteria dentro del bloque
+    
+    Uso: ``with contar_sentencias() as sentencias: ...`` dentro de un
+    contexto de aplicación; ``sentencias`` es la lista de sentencias SQL.
+    """
+    from sqlalchemy import event
+    from app_ferreteria import db as ferreteria_db
+    
+    @contextmanager
+    def contar():
+        sentencias = []
+        contador = lambda *args, **kwargs: sentencias.append(args[2])
+        event.listen(ferreteria_db.engine, 'before_cursor_execute', contador)
+        try:
+            yield sentencias
+        finally:
+            event.remove(ferreteria_db.engine, 'before_cursor_execute', contador)
+    
+    return contar
+
 @pytest.fixture
 def app_context():
     """Contexto de aplicación para pruebas"""
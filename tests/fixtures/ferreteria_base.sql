@@ -0,0 +1,76 @@
+-- Esquema y datos de una base creada con la versión original de app_ferreteria.py
+-- (precios, montos y tasas como FLOAT). Se usa para probar las migraciones.
+
+CREATE TABLE categoria (
+	id INTEGER NOT NULL, 
+	nombre VARCHAR(100) NOT NULL, 
+	descripcion TEXT, 
+	PRIMARY KEY (id)
+);
+
+CREATE TABLE cliente (
+	id INTEGER NOT NULL, 
+	nombre VARCHAR(100) NOT NULL, 
+	email VARCHAR(120) NOT NULL, 
+	telefono VARCHAR(20), 
+	direccion TEXT, 
+	fecha_registro DATETIME, 
+	PRIMARY KEY (id), 
+	UNIQUE (email)
+);
+
+CREATE TABLE conversion_moneda (
+	id INTEGER NOT NULL, 
+	moneda_origen VARCHAR(3) NOT NULL, 
+	moneda_destino VARCHAR(3) NOT NULL, 
+	tasa_cambio FLOAT NOT NULL, 
+	fecha_actualizacion DATETIME, 
+	activa BOOLEAN, 
+	PRIMARY KEY (id)
+);
+
+CREATE TABLE producto (
+	id INTEGER NOT NULL, 
+	nombre VARCHAR(100) NOT NULL, 
+	descripcion TEXT, 
+	precio FLOAT NOT NULL, 
+	stock INTEGER NOT NULL, 
+	categoria_id INTEGER, 
+	fecha_creacion DATETIME, 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(categoria_id) REFERENCES categoria (id)
+);
+
+CREATE TABLE transaccion_pago (
+	id INTEGER NOT NULL, 
+	token_transaccion VARCHAR(200) NOT NULL, 
+	monto FLOAT NOT NULL, 
+	estado VARCHAR(50), 
+	fecha_transaccion DATETIME, 
+	fecha_actualizacion DATETIME, 
+	cliente_id INTEGER, 
+	detalle TEXT, 
+	PRIMARY KEY (id), 
+	UNIQUE (token_transaccion), 
+	FOREIGN KEY(cliente_id) REFERENCES cliente (id)
+);
+
+INSERT INTO categoria (id, nombre, descripcion) VALUES
+	(1, 'Herramientas Manuales', 'Herramientas que no requieren electricidad');
+
+INSERT INTO producto (id, nombre, descripcion, precio, stock, categoria_id, fecha_creacion) VALUES
+	(1, 'Martillo', 'Martillo de acero 500g', 25.5, 15, 1, '2025-07-01 12:00:00.000000'),
+	(2, 'Destornillador Phillips', 'Destornillador Phillips #2', 12.75, 25, 1, '2025-07-01 12:00:00.000000');
+
+INSERT INTO cliente (id, nombre, email, telefono, direccion, fecha_registro) VALUES
+	(1, 'Juan Pérez', 'juan.perez@email.com', '9-8765-4321', 'Calle Falsa 123', '2025-07-01 12:00:00.000000');
+
+INSERT INTO transaccion_pago (id, token_transaccion, monto, estado, fecha_transaccion, fecha_actualizacion, cliente_id, detalle) VALUES
+	(1, 'token-base-1', 1234.56, 'aprobada', '2025-07-01 12:00:00.000000', '2025-07-01 12:00:00.000000', 1, 'Compra'),
+	(2, 'token-base-2', 0.1, 'aprobada', '2025-07-01 12:00:00.000000', '2025-07-01 12:00:00.000000', 1, 'Compra');
+
+INSERT INTO conversion_moneda (id, moneda_origen, moneda_destino, tasa_cambio, fecha_actualizacion, activa) VALUES
+	(1, 'CLP', 'USD', 0.001079, '2025-07-01 12:00:00.000000', 1),
+	(2, 'USD', 'CLP', 890.664313, '2025-07-01 12:00:00.000000', 1),
+	(3, 'CLP', 'EUR', 0.000959, '2025-07-01 12:00:00.000000', 1),
+	(4, 'EUR', 'CLP', 1052.342736, '2025-07-01 12:00:00.000000', 1);
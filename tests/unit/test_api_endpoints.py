@@ -4,6 +4,18 @@ Pruebas unitarias para los endpoints de la API Ferretería
 import pytest
 import json
 
+@pytest.fixture
+def client(app):
+    """Cliente de prueba de app_ferreteria, con base de datos limpia por prueba"""
+    return app.test_client()
+
+def crear_producto(client, nombre, precio=1000, stock=5):
+    """Crear un producto por la API y devolver su ID"""
+    response = client.post('/productos',
+                         data=json.dumps({'nombre': nombre, 'precio': precio, 'stock': stock}),
+                         content_type='application/json')
+    return json.loads(response.data)['id']
+
 class TestHealthEndpoint:
     """Pruebas para el endpoint de health check"""
     
@@ -268,6 +280,84 @@ class TestWebPayEndpoints:
         data = json.loads(response.data)
         assert isinstance(data, list)
 
+    def test_iniciar_transaccion_con_items(self, client):
+        """Probar que iniciar un pago con items reserva el stock"""
+        producto_id = crear_producto(client, 'Taladro', stock=3)
+        
+        response = client.post('/webpay/iniciar',
+                             data=json.dumps({'monto': 2000, 'items': [{'producto_id': producto_id, 'cantidad': 2}]}),
+                             content_type='application/json')
+        
+        assert response.status_code == 201
+        assert 'reserva_expira_en' in json.loads(response.data)
+        
+        stock = json.loads(client.get(f'/productos/{producto_id}/stock').data)
+        assert (stock['stock'], stock['reservado'], stock['disponible']) == (3, 2, 1)
+    
+    def test_iniciar_transaccion_items_invalidos(self, client):
+        """Probar errores de items: sin stock suficiente, producto inexistente y formato"""
+        producto_id = crear_producto(client, 'Taladro', stock=1)
+        
+        casos = [
+            ([{'producto_id': producto_id, 'cantidad': 2}], 'Stock insuficiente para el producto'),
+            ([{'producto_id': 9999, 'cantidad': 1}], 'Producto 9999 no encontrado'),
+            ([{'producto_id': producto_id, 'cantidad': 0}], 'La cantidad debe ser mayor a 0'),
+            ('todo', 'Se requiere una lista de items')
+        ]
+        for items, error in casos:
+            response = client.post('/webpay/iniciar',
+                                 data=json.dumps({'monto': 1000, 'items': items}),
+                                 content_type='application/json')
+            assert response.status_code == 400
+            assert error in json.loads(response.data)['error']
+        
+        assert json.loads(client.get('/webpay/transacciones').data) == []
+    
+    def test_iniciar_transaccion_monto_no_finito(self, client):
+        """Probar que NaN o Infinity como monto es un error 400"""
+        response = client.post('/webpay/iniciar',
+                             data='{"monto": Infinity}',
+                             content_type='application/json')
+        
+        assert response.status_code == 400
+        assert json.loads(response.data)['error'] == 'El monto debe ser un número finito'
+    
+    def test_ajustes_de_stock_no_toman_unidades_reservadas(self, client):
+        """Probar que PATCH, PUT y el lote de stock respetan una reserva en curso y el pago se confirma"""
+        producto_id = crear_producto(client, 'Taladro', stock=2)
+        pago = json.loads(client.post('/webpay/iniciar',
+                                    data=json.dumps({'monto': 2000, 'items': [{'producto_id': producto_id, 'cantidad': 2}]}),
+                                    content_type='application/json').data)
+        
+        response = client.patch(f'/productos/{producto_id}/stock', json={'delta': -2})
+        assert response.status_code == 400
+        assert json.loads(response.data)['error'] == 'Stock insuficiente (disponible: 0)'
+        
+        response = client.put(f'/productos/{producto_id}/stock', json={'cantidad': 1})
+        assert response.status_code == 400
+        assert json.loads(response.data)['error'] == 'La cantidad no puede ser menor a lo reservado (2)'
+        
+        response = client.post('/productos/stock/lote', json={'items': [{'producto_id': producto_id, 'delta': -1}]})
+        assert json.loads(response.data)['resultados'][0]['error'] == 'Stock insuficiente (disponible: 0)'
+        
+        response = client.post('/webpay/confirmar', json={'token': pago['token'], 'estado': 'aprobada'})
+        assert response.status_code == 200
+        
+        stock = json.loads(client.get(f'/productos/{producto_id}/stock').data)
+        assert (stock['stock'], stock['reservado'], stock['disponible']) == (0, 0, 0)
+        assert json.loads(client.put(f'/productos/{producto_id}/stock', json={'cantidad': 3}).data)['stock'] == 3
+    
+    def test_resumen_transacciones(self, client):
+        """Probar el resumen con suma exacta y filtro por estado"""
+        for monto in (0.1, 0.2):
+            client.post('/webpay/iniciar', data=json.dumps({'monto': monto}), content_type='application/json')
+        
+        response = client.get('/webpay/transacciones/resumen?estado=iniciada')
+        
+        assert response.status_code == 200
+        assert json.loads(response.data) == {'cantidad': 2, 'monto_total': 0.3}
+        assert json.loads(client.get('/webpay/transacciones/resumen?estado=aprobada').data)['cantidad'] == 0
+
 class TestDivisasEndpoints:
     """Pruebas para endpoints de cambio de divisas"""
     
@@ -277,4 +367,379 @@ class TestDivisasEndpoints:
             'monto': 1000,
             'moneda_origen': 'CLP',
             'moneda_destino': 'USD'
-   
\ No newline at end of file
+        }
+        
+        response = client.post('/divisas/convertir',
+                             data=json.dumps(conversion_data),
+                             content_type='application/json')
+        
+        assert response.status_code == 200
+        
+        data = json.loads(response.data)
+        assert data['monto_original'] == conversion_data['monto']
+        assert data['moneda_destino'] == 'USD'
+        assert 'monto_convertido' in data
+    
+    def test_convertir_divisas_errores(self, client):
+        """Probar conversión sin datos, con moneda desconocida y con fecha inválida"""
+        casos = [
+            ({'monto': 1000, 'moneda_origen': 'CLP'}, 'requeridos'),
+            ({'monto': 1000, 'moneda_origen': 'CLP', 'moneda_destino': 'XXX'}, 'Conversión no disponible'),
+            ({'monto': 1000, 'moneda_origen': 'CLP', 'moneda_destino': 'USD', 'fecha': 'ayer'}, 'Fecha inválida')
+        ]
+        for datos, error in casos:
+            response = client.post('/divisas/convertir', data=json.dumps(datos), content_type='application/json')
+            assert response.status_code == 400
+            assert error in json.loads(response.data)['error']
+    
+    def test_convertir_get_cacheable(self, client, app):
+        """Probar ETag y Cache-Control de GET /convertir y la revalidación con 304"""
+        from app_ferreteria import CambioDivisasService
+        url = '/convertir?monto=1000&moneda_origen=CLP&moneda_destino=USD'
+        
+        response = client.get(url)
+        etag = response.headers['ETag']
+        
+        assert response.status_code == 200
+        assert json.loads(response.data)['monto_convertido'] == 1.11
+        assert 'max-age' in response.headers['Cache-Control']
+        assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+        
+        with app.app_context():
+            CambioDivisasService.actualizar_tasas_cambio()
+        
+        assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+    
+    def test_convertir_get_a_una_fecha(self, client, app):
+        """Probar GET /convertir con fecha: tasa histórica, fecha en el ETag y sin caché compartida"""
+        from datetime import datetime, timedelta
+        from app_ferreteria import CambioDivisasService
+        with app.app_context():
+            CambioDivisasService.actualizar_tasas_cambio()
+        momento = datetime.utcnow()
+        url = '/convertir?monto=1000&moneda_origen=CLP&moneda_destino=USD&fecha='
+        
+        response = client.get(url + momento.isoformat() + 'Z')
+        
+        assert response.status_code == 200
+        assert json.loads(response.data)['fecha_tasa'].startswith(momento.isoformat())
+        assert response.headers['Cache-Control'] == 'no-cache'
+        etag = response.headers['ETag']
+        assert client.get(url + momento.isoformat() + 'Z', headers={'If-None-Match': etag}).status_code == 304
+        
+        otra = client.get(url + (momento + timedelta(seconds=1)).isoformat() + 'Z', headers={'If-None-Match': etag})
+        assert otra.status_code == 200 and otra.headers['ETag'] != etag
+        
+        assert client.get(url + 'ayer').status_code == 400
+    
+    def test_convertir_get_errores(self, client):
+        """Probar GET /convertir sin parámetros y con monto no finito"""
+        assert client.get('/convertir?monto=1000&moneda_origen=CLP').status_code == 400
+        
+        response = client.get('/convertir?monto=nan&moneda_origen=CLP&moneda_destino=USD')
+        assert response.status_code == 400
+        assert json.loads(response.data)['error'] == 'El monto debe ser un número finito'
+    
+    def test_convertir_lote(self, client):
+        """Probar un lote con errores por item, incluidos NaN e Infinity"""
+        response = client.post('/divisas/convertir-lote',
+                             data='{"conversiones": ['
+                                  '{"monto": 1000, "moneda_origen": "CLP", "moneda_destino": "USD"},'
+                                  '{"monto": NaN, "moneda_origen": "CLP", "moneda_destino": "USD"},'
+                                  '{"monto": Infinity, "moneda_origen": "CLP", "moneda_destino": "USD"},'
+                                  '{"monto": 10, "moneda_origen": "USD", "moneda_destino": "XXX"},'
+                                  '{"monto": 10}]}',
+                             content_type='application/json')
+        
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert (data['total'], data['errores']) == (5, 4)
+        assert data['resultados'][0]['monto_convertido'] == 1.11
+        assert data['resultados'][1] == data['resultados'][2] == {'error': 'El monto debe ser un número finito'}
+        assert 'Conversión no disponible' in data['resultados'][3]['error']
+        assert 'requeridos' in data['resultados'][4]['error']
+    
+    def test_convertir_lote_invalido(self, client):
+        """Probar un lote vacío y una fecha inválida"""
+        response = client.post('/divisas/convertir-lote', data=json.dumps({'conversiones': []}), content_type='application/json')
+        assert response.status_code == 400
+        
+        response = client.post('/divisas/convertir-lote',
+                             data=json.dumps({'conversiones': [{'monto': 1, 'moneda_origen': 'CLP', 'moneda_destino': 'USD'}],
+                                              'fecha': 'no-es-fecha'}),
+                             content_type='application/json')
+        assert response.status_code == 400
+        assert 'Fecha inválida' in json.loads(response.data)['error']
+    
+    def test_cotizar_y_pagar(self, client):
+        """Probar crear, consultar y consumir una cotización"""
+        response = client.post('/divisas/cotizar',
+                             data=json.dumps({'monto': 100, 'moneda_origen': 'usd', 'moneda_destino': 'clp'}),
+                             content_type='application/json')
+        assert response.status_code == 201
+        cotizacion = json.loads(response.data)
+        
+        consultada = client.get(f"/divisas/cotizaciones/{cotizacion['token']}")
+        assert consultada.status_code == 200
+        assert json.loads(consultada.data) == cotizacion
+        
+        pago = client.post('/webpay/iniciar', data=json.dumps({'cotizacion': cotizacion['token']}), content_type='application/json')
+        assert pago.status_code == 201
+        assert json.loads(pago.data)['monto'] == cotizacion['monto_convertido']
+        
+        assert client.get(f"/divisas/cotizaciones/{cotizacion['token']}").status_code == 404
+        repetido = client.post('/webpay/iniciar', data=json.dumps({'cotizacion': cotizacion['token']}), content_type='application/json')
+        assert repetido.status_code == 400
+    
+    def test_cotizar_errores(self, client):
+        """Probar cotizar sin datos y con un monto inválido"""
+        response = client.post('/divisas/cotizar', data=json.dumps({'monto': 100}), content_type='application/json')
+        assert response.status_code == 400
+        
+        response = client.post('/divisas/cotizar',
+                             data=json.dumps({'monto': -1, 'moneda_origen': 'USD', 'moneda_destino': 'CLP'}),
+                             content_type='application/json')
+        assert response.status_code == 400
+        assert json.loads(response.data)['error'] == 'El monto debe ser mayor a 0'
+
+class TestStockEndpoints:
+    """Pruebas para los endpoints de stock y del libro de movimientos"""
+    
+    def test_ajustar_stock(self, client):
+        """Probar PATCH de stock con delta y sus errores"""
+        producto_id = crear_producto(client, 'Martillo', stock=5)
+        
+        response = client.patch(f'/productos/{producto_id}/stock', json={'delta': -2, 'detalle': 'Venta mesón'})
+        assert response.status_code == 200
+        assert json.loads(response.data) == {'id': producto_id, 'stock': 3, 'delta': -2}
+        
+        casos = [
+            (producto_id, {'delta': -10}, 'Stock insuficiente (disponible: 3)'),
+            (producto_id, {}, 'Delta requerido'),
+            (producto_id, {'delta': 'x'}, 'El delta debe ser un entero'),
+            (producto_id, {'delta': 1, 'tipo': 'regalo'}, 'Tipo de movimiento no válido'),
+            (9999, {'delta': 1}, 'Producto no encontrado')
+        ]
+        for destino, datos, error in casos:
+            response = client.patch(f'/productos/{destino}/stock', json=datos)
+            assert response.status_code == 400
+            assert error in json.loads(response.data)['error']
+    
+    def test_actualizar_stock_errores(self, client):
+        """Probar PUT de stock sin cantidad, negativa y de un producto inexistente"""
+        producto_id = crear_producto(client, 'Martillo')
+        
+        assert client.put(f'/productos/{producto_id}/stock', json={}).status_code == 400
+        response = client.put(f'/productos/{producto_id}/stock', json={'cantidad': -1})
+        assert json.loads(response.data)['error'] == 'La cantidad no puede ser negativa'
+        response = client.put('/productos/9999/stock', json={'cantidad': 1})
+        assert json.loads(response.data)['error'] == 'Producto no encontrado'
+    
+    def test_sincronizar_stock_lote(self, client):
+        """Probar POST /productos/stock/lote con resultados por item y sus errores"""
+        producto_id = crear_producto(client, 'Martillo', stock=5)
+        
+        response = client.post('/productos/stock/lote', json={'items': [
+            {'producto_id': producto_id, 'cantidad': 10},
+            {'producto_id': producto_id, 'delta': -3},
+            {'producto_id': 9999, 'delta': 1},
+            {'producto_id': producto_id}
+        ]})
+        
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert (data['total'], data['errores']) == (4, 2)
+        assert [resultado.get('stock') for resultado in data['resultados']] == [10, 7, None, None]
+        
+        assert client.post('/productos/stock/lote', json={'items': []}).status_code == 400
+        response = client.post('/productos/stock/lote', json={'items': [{'producto_id': producto_id, 'delta': 1}], 'tamano_lote': 0})
+        assert response.status_code == 400
+    
+    def test_consultar_stock(self, client):
+        """Probar el stock actual con reservas, a una fecha y sus errores"""
+        producto_id = crear_producto(client, 'Martillo', stock=5)
+        client.patch(f'/productos/{producto_id}/stock', json={'delta': 2})
+        
+        assert json.loads(client.get(f'/productos/{producto_id}/stock').data) == {
+            'producto_id': producto_id, 'stock': 7, 'reservado': 0, 'disponible': 7
+        }
+        
+        a_la_fecha = json.loads(client.get(f'/productos/{producto_id}/stock?fecha=2999-01-01T00:00:00Z').data)
+        assert (a_la_fecha['stock'], a_la_fecha['movimientos_aplicados']) == (7, 2)
+        assert json.loads(client.get(f'/productos/{producto_id}/stock?fecha=2000-01-01').data)['stock'] == 0
+        
+        assert client.get('/productos/9999/stock').status_code == 404
+        response = client.get('/productos/9999/stock?fecha=2999-01-01')
+        assert response.status_code == 404
+        assert json.loads(response.data)['error'] == 'Producto no encontrado'
+        assert client.get(f'/productos/{producto_id}/stock?fecha=ayer').status_code == 400
+    
+    def test_movimientos_y_compactar(self, client):
+        """Probar el listado de movimientos con filtro y la compactación del libro"""
+        producto_id = crear_producto(client, 'Martillo', stock=5)
+        client.patch(f'/productos/{producto_id}/stock', json={'delta': -1, 'tipo': 'venta'})
+        
+        movimientos = json.loads(client.get(f'/productos/{producto_id}/movimientos').data)
+        assert [(m['tipo'], m['cantidad']) for m in movimientos] == [('inicial', 5), ('venta', -1)]
+        
+        ventas = json.loads(client.get(f'/productos/{producto_id}/movimientos?tipo=venta').data)
+        assert [m['cantidad'] for m in ventas] == [-1]
+        
+        assert json.loads(client.post('/inventario/compactar').data) == {'snapshots': 1}
+        assert json.loads(client.post('/inventario/compactar').data) == {'snapshots': 0}
+        assert json.loads(client.get(f'/productos/{producto_id}/stock?fecha=2999-01-01').data)['stock'] == 4
+
+class TestAutocompletarEndpoint:
+    """Pruebas para las sugerencias por prefijo"""
+    
+    def test_sugerencias(self, client):
+        """Probar sugerencias por inicio de nombre y de palabra, con límite"""
+        crear_producto(client, 'Taladro Eléctrico')
+        crear_producto(client, 'Electrodo')
+        crear_producto(client, 'Martillo')
+        
+        response = client.get('/productos/autocompletar?q=ELEC')
+        assert response.status_code == 200
+        assert [s['nombre'] for s in json.loads(response.data)] == ['Electrodo', 'Taladro Eléctrico']
+        
+        assert len(json.loads(client.get('/productos/autocompletar?q=elec&limite=1').data)) == 1
+        assert json.loads(client.get('/productos/autocompletar?q=').data) == []
+    
+    def test_limite_invalido(self, client):
+        """Probar límites no numéricos o no positivos"""
+        assert client.get('/productos/autocompletar?q=a&limite=muchos').status_code == 400
+        assert client.get('/productos/autocompletar?q=a&limite=0').status_code == 400
+
+class TestInventarioSucursalEndpoints:
+    """Pruebas para el inventario por sucursal y la disponibilidad"""
+    
+    def test_inventario_y_disponibilidad(self, client):
+        """Probar fijar el inventario de una sucursal y consultar disponibilidad"""
+        producto_id = crear_producto(client, 'Martillo')
+        sucursal = json.loads(client.post('/sucursales',
+                                        data=json.dumps({'nombre': 'Centro', 'direccion': 'Calle 1'}),
+                                        content_type='application/json').data)
+        
+        response = client.put(f"/sucursales/{sucursal['id']}/inventario", json={'items': [{'producto_id': producto_id, 'stock': 8}]})
+        assert response.status_code == 200
+        
+        inventario = json.loads(client.get(f"/sucursales/{sucursal['id']}/inventario").data)
+        assert [(item['producto_id'], item['stock']) for item in inventario] == [(producto_id, 8)]
+        
+        disponibilidad = json.loads(client.get(f'/inventario/disponibilidad?productos={producto_id}:5').data)
+        assert disponibilidad == [{
+            'producto_id': producto_id,
+            'cantidad': 5,
+            'sucursales': [{'sucursal_id': sucursal['id'], 'sucursal': 'Centro', 'stock': 8}]
+        }]
+        assert json.loads(client.get(f'/inventario/disponibilidad?productos={producto_id}&cantidad=9').data)[0]['sucursales'] == []
+    
+    def test_inventario_y_disponibilidad_errores(self, client):
+        """Probar productos inexistentes, stock negativo y parámetros inválidos"""
+        sucursal = json.loads(client.post('/sucursales',
+                                        data=json.dumps({'nombre': 'Centro', 'direccion': 'Calle 1'}),
+                                        content_type='application/json').data)
+        
+        response = client.put(f"/sucursales/{sucursal['id']}/inventario", json={'items': [{'producto_id': 9999, 'stock': 1}]})
+        assert response.status_code == 400
+        assert 'Productos no encontrados' in json.loads(response.data)['error']
+        response = client.put(f"/sucursales/{sucursal['id']}/inventario", json={'items': [{'producto_id': 1, 'stock': -1}]})
+        assert response.status_code == 400
+        
+        assert client.get('/inventario/disponibilidad?productos=uno').status_code == 400
+        assert client.get('/inventario/disponibilidad').status_code == 400
+        
+        for consulta in ('productos=1&cantidad=abc', 'productos=1&cantidad=0', 'productos=1&cantidad=-2', 'productos=1:0'):
+            response = client.get(f'/inventario/disponibilidad?{consulta}')
+            assert response.status_code == 400
+            assert json.loads(response.data)['error'] == 'cantidad debe ser un entero positivo'
+
+class TestListadosEndpoints:
+    """Pruebas para los listados en streaming y con campos seleccionados"""
+    
+    def test_productos_ndjson(self, client):
+        """Probar listar productos como NDJSON enviado por partes"""
+        for i in range(3):
+            crear_producto(client, f'Perno {i}')
+        
+        response = client.get('/productos?formato=ndjson')
+        
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        assert response.is_streamed
+        lineas = response.get_data(as_text=True).splitlines()
+        assert [json.loads(linea)['nombre'] for linea in lineas] == ['Perno 0', 'Perno 1', 'Perno 2']
+    
+    def test_listados_json_en_streaming(self, client):
+        """Probar ?stream=1: un arreglo JSON válido enviado por partes, también vacío"""
+        for i in range(3):
+            crear_producto(client, f'Perno {i}')
+        
+        response = client.get('/productos?stream=1')
+        
+        assert response.status_code == 200
+        assert response.mimetype == 'application/json'
+        assert response.is_streamed
+        assert [p['nombre'] for p in json.loads(response.get_data(as_text=True))] == ['Perno 0', 'Perno 1', 'Perno 2']
+        
+        vacio = client.get('/webpay/transacciones?stream=1')
+        assert vacio.is_streamed
+        assert json.loads(vacio.get_data(as_text=True)) == []
+    
+    def test_productos_con_campos(self, client):
+        """Probar listar productos pidiendo sólo algunos campos"""
+        crear_producto(client, 'Llave Inglesa', precio=40, stock=3)
+        
+        response = client.get('/productos?fields=nombre,precio,stock')
+        
+        assert response.status_code == 200
+        assert json.loads(response.data) == [
+            {'id': 1, 'nombre': 'Llave Inglesa', 'precio': 40.0, 'stock': 3}
+        ]
+    
+    def test_campo_invalido(self, client):
+        """Probar pedir un campo que no existe"""
+        response = client.get('/productos?fields=nombre,clave')
+        
+        assert response.status_code == 400
+        assert 'clave' in json.loads(response.data)['error']
+
+    def test_productos_con_facetas_sin_paginar(self, client):
+        """Probar que facetas=1 sin paginación responde productos y facetas"""
+        crear_producto(client, 'Taladro Mini', precio=20000)
+        crear_producto(client, 'Taladro Pro', precio=150000)
+        crear_producto(client, 'Martillo', precio=5000)
+        
+        response = client.get('/productos?buscar=taladro&facetas=1&fields=nombre')
+        
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert sorted(p['nombre'] for p in data['productos']) == ['Taladro Mini', 'Taladro Pro']
+        assert [r['total'] for r in data['facetas']['rangos_precio']] == [0, 1, 0, 1]
+        
+        assert client.get('/productos?facetas=1&stream=1').status_code == 400
+        assert client.get('/productos?facetas=1&fields=clave').status_code == 400
+
+class TestCatalogoEndpoint:
+    """Pruebas para el catálogo con precios en varias monedas y facetas"""
+    
+    def test_catalogo_en_varias_monedas(self, client):
+        """Probar el mapa de precios por moneda y las facetas del catálogo"""
+        crear_producto(client, 'Taladro', precio=90000)
+        
+        response = client.get('/catalogo?moneda=usd&monedas=USD,EUR')
+        
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        producto = data['productos'][0]
+        assert producto['precio'] == 100.0
+        assert producto['precios'] == {'USD': 100.0, 'EUR': 85.71}
+        assert data['monedas_consulta'] == ['USD', 'EUR']
+        assert [r['total'] for r in data['facetas']['rangos_precio']] == [0, 0, 1, 0]
+    
+    def test_catalogo_moneda_desconocida(self, client):
+        """Probar pedir precios en una moneda sin tasa"""
+        response = client.get('/catalogo?monedas=USD,XXX')
+        
+        assert response.status_code == 400
+        assert 'XXX' in json.loads(response.data)['error']
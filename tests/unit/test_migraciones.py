@@ -0,0 +1,93 @@
+"""
+Pruebas de migración de bases creadas con versiones anteriores del esquema
+"""
+import sqlite3
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from app_ferreteria import (
+    db, migrar_esquema, CatalogoService, Producto, TransaccionPago, VERSION_ESQUEMA
+)
+
+ESQUEMA_BASE = Path(__file__).resolve().parent.parent / 'fixtures' / 'ferreteria_base.sql'
+
+
+@pytest.fixture
+def base_original(tmp_path):
+    """Motor sobre un archivo SQLite con el esquema y datos de la versión original"""
+    ruta = tmp_path / 'ferreteria.db'
+    conexion = sqlite3.connect(ruta)
+    conexion.executescript(ESQUEMA_BASE.read_text(encoding='utf-8'))
+    conexion.close()
+
+    motor = create_engine(f'sqlite:///{ruta}')
+    yield motor
+    motor.dispose()
+
+
+def migrar(motor):
+    with motor.begin() as connection:
+        db.metadata.create_all(connection)
+        migrar_esquema(connection)
+
+
+class TestMigracionPuntoFijo:
+    """Pruebas de la migración de montos y tasas a enteros"""
+
+    @pytest.mark.parametrize('version_inicial', [0, 1])
+    def test_columnas_quedan_enteras(self, base_original, version_inicial):
+        """Probar que una base original (o ya escalada como REAL) queda con columnas INTEGER"""
+        if version_inicial == 1:
+            # Base migrada sólo con UPDATE: valores escalados pero con afinidad REAL
+            with base_original.begin() as connection:
+                connection.execute(text("UPDATE producto SET precio = CAST(ROUND(precio * 100) AS INTEGER)"))
+                connection.execute(text("UPDATE transaccion_pago SET monto = CAST(ROUND(monto * 100) AS INTEGER)"))
+                connection.execute(text(
+                    "UPDATE conversion_moneda SET tasa_cambio = CAST(ROUND(tasa_cambio * 1000000000) AS INTEGER)"
+                ))
+                connection.execute(text("PRAGMA user_version = 1"))
+
+        migrar(base_original)
+        migrar(base_original)  # idempotente
+
+        with base_original.begin() as connection:
+            assert connection.execute(text("PRAGMA user_version")).scalar() == VERSION_ESQUEMA
+            tipos = {fila[1]: fila[2] for fila in connection.execute(text("PRAGMA table_info(producto)"))}
+            assert 'INT' in tipos['precio'].upper()
+
+            assert connection.execute(text("SELECT precio, typeof(precio) FROM producto WHERE id = 1")).one() == (2550, 'integer')
+            assert connection.execute(text("SELECT SUM(monto), typeof(SUM(monto)) FROM transaccion_pago")).one() == (123466, 'integer')
+            assert connection.execute(text(
+                "SELECT tasa_cambio, typeof(tasa_cambio) FROM conversion_moneda WHERE moneda_origen = 'USD'"
+            )).one() == (890664313000, 'integer')
+
+            # Las escrituras nuevas siguen siendo enteras
+            connection.execute(text("UPDATE producto SET precio = precio * 3 / 2 WHERE id = 1"))
+            assert connection.execute(text("SELECT typeof(precio) FROM producto WHERE id = 1")).scalar() == 'integer'
+
+            # Índices y triggers de búsqueda recreados sobre la tabla nueva
+            assert connection.execute(text(
+                "SELECT rowid FROM producto_fts WHERE producto_fts MATCH 'destornillador'"
+            )).scalars().all() == [2]
+            indices = {fila[1] for fila in connection.execute(text("PRAGMA index_list(conversion_moneda)"))}
+            assert 'ux_conversion_moneda_par' in indices
+
+        with Session(base_original) as session:
+            assert session.get(Producto, 2).precio == 12.75
+            assert session.get(TransaccionPago, 1).monto == 1234.56
+
+    def test_precios_convertidos_enteros_con_afinidad_real(self, base_original):
+        """Probar que precio_moneda usa división entera aunque precio siga siendo REAL"""
+        with base_original.begin() as connection:
+            connection.execute(text("UPDATE producto SET precio = CAST(ROUND(precio * 100) AS INTEGER)"))
+            assert connection.execute(text("SELECT typeof(precio) FROM producto WHERE id = 1")).scalar() == 'real'
+
+            db.metadata.tables['precio_moneda'].create(connection)
+            CatalogoService.recalcular_precios(connection, {'USD': (1, 900)})
+
+            assert connection.execute(text(
+                "SELECT precio_convertido, typeof(precio_convertido) FROM precio_moneda WHERE producto_id = 1"
+            )).one() == (3, 'integer')
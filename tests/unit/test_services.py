@@ -4,7 +4,9 @@ Pruebas unitarias para los servicios de negocio
 import pytest
 from app_ferreteria import (
     ProductoService, PedidoSucursalService, WebPayService, CambioDivisasService,
-    Producto, Sucursal, Cliente, TransaccionPago, ConversionMoneda
+    CatalogoService, AutocompletarService, FacetasService, RefrescoTasasService,
+    CotizacionService, MovimientoStockService, InventarioService, ReservaStockService,
+    Dinero, Producto, Sucursal, Cliente, TransaccionPago, ConversionMoneda, Cotizacion, db
 )
 
 class TestProductoService:
@@ -49,6 +51,140 @@ class TestProductoService:
             
             with pytest.raises(ValueError, match="El precio debe ser mayor a 0"):
                 ProductoService.crear_producto(data)
+    
+    def test_ajustar_stock_un_solo_update(self, app, contar_sentencias):
+        """Probar que el ajuste por delta es un único UPDATE y no deja stock negativo"""
+        from app_ferreteria import db
+        with app.app_context():
+            producto_id = ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000, 'stock': 5}).id
+            CatalogoService.consultar()
+            
+            with contar_sentencias() as sentencias:
+                resultado = ProductoService.ajustar_stock(producto_id, -3)
+            
+            assert resultado['stock'] == 2
+            # versión del catálogo, UPDATE condicional y movimiento en el libro
+            assert [sentencia.lstrip().split()[0].upper() for sentencia in sentencias] == ['INSERT', 'UPDATE', 'INSERT']
+            assert 'version_cache' in sentencias[0]
+            assert CatalogoService.consultar()[0][0]['stock'] == 2
+            
+            with pytest.raises(ValueError, match="Stock insuficiente"):
+                ProductoService.ajustar_stock(producto_id, -3)
+            with pytest.raises(ValueError, match="Producto no encontrado"):
+                ProductoService.ajustar_stock(9999, 1)
+            assert db.session.get(Producto, producto_id).stock == 2
+
+    def test_sincronizar_stock_en_lotes(self, app, contar_sentencias):
+        """Probar la sincronización masiva: resultados por item y tres sentencias por lote"""
+        from app_ferreteria import db
+        with app.app_context():
+            ids = [ProductoService.crear_producto({'nombre': f'Producto {i}', 'precio': 100, 'stock': 5}).id for i in range(4)]
+            items = [{'producto_id': producto_id, 'cantidad': 20} for producto_id in ids]
+            items += [{'producto_id': ids[0], 'delta': -25}, {'producto_id': 9999, 'delta': 1}]
+            
+            with contar_sentencias() as sentencias:
+                resultados = ProductoService.sincronizar_stock(items, tamano_lote=3)
+            
+            assert [r.get('stock') for r in resultados[:4]] == [20, 20, 20, 20]
+            assert 'Stock insuficiente' in resultados[4]['error']
+            assert resultados[5]['error'] == 'Producto no encontrado'
+            assert sum(1 for sentencia in sentencias if sentencia.lstrip().upper().startswith('UPDATE')) == 2
+            # la versión del catálogo una vez y por lote: SELECT, UPDATE e INSERT al libro de stock
+            assert len(sentencias) == 7
+            assert db.session.get(Producto, ids[3]).stock == 20
+    
+    def test_sincronizar_stock_respeta_reservas(self, app):
+        """Probar que la sincronización no baja el stock de lo reservado por pagos en curso"""
+        with app.app_context():
+            producto_id = ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000, 'stock': 5}).id
+            WebPayService.iniciar_transaccion(monto=3000, items=[{'producto_id': producto_id, 'cantidad': 3}])
+            
+            resultados = ProductoService.sincronizar_stock([
+                {'producto_id': producto_id, 'delta': -3},
+                {'producto_id': producto_id, 'cantidad': 2},
+                {'producto_id': producto_id, 'cantidad': 4}
+            ])
+            
+            assert resultados[0]['error'] == 'Stock insuficiente (disponible: 2)'
+            assert resultados[1]['error'] == 'La cantidad no puede ser menor a lo reservado (3)'
+            assert resultados[2] == {'producto_id': producto_id, 'stock': 4}
+    
+    def test_sincronizar_stock_revierte_todo_ante_un_error(self, app, monkeypatch):
+        """Probar que un fallo en un lote no deja aplicados los lotes anteriores"""
+        with app.app_context():
+            ids = [ProductoService.crear_producto({'nombre': f'Producto {i}', 'precio': 100, 'stock': 5}).id for i in range(4)]
+            registrar = MovimientoStockService.registrar
+            llamadas = []
+            
+            def registrar_y_fallar(connection, movimientos):
+                llamadas.append(movimientos)
+                if len(llamadas) == 2:
+                    raise RuntimeError('fallo de la BD')
+                registrar(connection, movimientos)
+            
+            monkeypatch.setattr(MovimientoStockService, 'registrar', registrar_y_fallar)
+            with pytest.raises(RuntimeError):
+                ProductoService.sincronizar_stock([{'producto_id': producto_id, 'cantidad': 20} for producto_id in ids], tamano_lote=2)
+            
+            assert [p['stock'] for p in CatalogoService.consultar()[0]] == [5, 5, 5, 5]
+            assert [db.session.get(Producto, producto_id).stock for producto_id in ids] == [5, 5, 5, 5]
+
+class TestMovimientoStockService:
+    """Pruebas para el libro de movimientos de stock"""
+    
+    def test_stock_a_la_fecha_con_snapshot(self, app):
+        """Probar el stock histórico antes y después de compactar el libro"""
+        from datetime import datetime, timedelta
+        from app_ferreteria import db, MovimientoStock
+        with app.app_context():
+            producto_id = ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000, 'stock': 10}).id
+            ProductoService.ajustar_stock(producto_id, -4, tipo='venta')
+            
+            # Fechar los movimientos para tener un "antes" y un "después"
+            inicio = datetime(2026, 1, 1, 12, 0)
+            for indice, movimiento in enumerate(MovimientoStock.query.order_by(MovimientoStock.id)):
+                movimiento.fecha = inicio + timedelta(hours=indice)
+            db.session.commit()
+            
+            assert MovimientoStockService.compactar() == 1
+            ProductoService.actualizar_stock(producto_id, 20)
+            
+            antes = MovimientoStockService.stock_a_la_fecha(producto_id, inicio + timedelta(minutes=30))
+            compactado = MovimientoStockService.stock_a_la_fecha(producto_id, inicio + timedelta(hours=2))
+            actual = MovimientoStockService.stock_a_la_fecha(producto_id, datetime.utcnow() + timedelta(seconds=1))
+            
+            assert (antes['stock'], antes['fecha_snapshot']) == (10, None)
+            assert (compactado['stock'], compactado['movimientos_aplicados']) == (6, 0)
+            assert (actual['stock'], actual['movimientos_aplicados']) == (20, 1)
+            assert [m.cantidad for m in MovimientoStock.query.order_by(MovimientoStock.id)] == [10, -4, 14]
+            assert MovimientoStockService.stock_a_la_fecha(9999, datetime.utcnow()) is None
+
+class TestInventarioService:
+    """Pruebas para el inventario por sucursal"""
+    
+    def test_disponibilidad_de_varios_productos(self, app, contar_sentencias):
+        """Probar qué sucursales tienen stock suficiente de varios productos en una consulta"""
+        from app_ferreteria import db
+        with app.app_context():
+            centro = Sucursal(nombre='Centro', direccion='Dir 1')
+            norte = Sucursal(nombre='Norte', direccion='Dir 2')
+            db.session.add_all([centro, norte])
+            db.session.commit()
+            taladro = ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000}).id
+            sierra = ProductoService.crear_producto({'nombre': 'Sierra', 'precio': 2000}).id
+            
+            InventarioService.actualizar_inventario(centro.id, [{'producto_id': taladro, 'stock': 10}, {'producto_id': sierra, 'stock': 1}])
+            InventarioService.actualizar_inventario(norte.id, [{'producto_id': taladro, 'stock': 3}, {'producto_id': sierra, 'stock': 8}])
+            InventarioService.actualizar_inventario(norte.id, [{'producto_id': taladro, 'stock': 6}])
+            
+            with contar_sentencias() as sentencias:
+                resultado = InventarioService.disponibilidad({taladro: 5, sierra: 5})
+            
+            assert len(sentencias) == 1
+            assert [s['sucursal'] for s in resultado[0]['sucursales']] == ['Centro', 'Norte']
+            assert [s['sucursal'] for s in resultado[1]['sucursales']] == ['Norte']
+            with pytest.raises(ValueError, match="Productos no encontrados"):
+                InventarioService.actualizar_inventario(centro.id, [{'producto_id': 9999, 'stock': 1}])
 
 class TestPedidoSucursalService:
     """Pruebas para PedidoSucursalService"""
@@ -135,6 +271,58 @@ class TestWebPayService:
             
             assert transaccion.token_transaccion == token
             assert transaccion.estado == 'aprobada'
+    
+    def test_resumen_suma_exacta(self, app):
+        """Probar que el total se suma en centavos, sin error de coma flotante"""
+        from sqlalchemy import text
+        from app_ferreteria import db
+        with app.app_context():
+            for monto in [0.1, 0.2, 0.1, 0.2, 0.1]:
+                WebPayService.iniciar_transaccion(monto=monto)
+            
+            fila = db.session.execute(text("SELECT monto, typeof(monto) FROM transaccion_pago LIMIT 1")).one()
+            resumen = WebPayService.resumen_transacciones(estado='iniciada')
+            
+            assert tuple(fila) == (10, 'integer')
+            assert resumen == {'cantidad': 5, 'monto_total': 0.7}
+    
+    def test_reserva_stock_durante_el_pago(self, app):
+        """Probar que el pago reserva stock, lo descuenta al aprobarse y lo libera al vencer"""
+        from datetime import datetime, timedelta
+        with app.app_context():
+            producto_id = ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000, 'stock': 5}).id
+            
+            aprobado = WebPayService.iniciar_transaccion(monto=3000, items=[{'producto_id': producto_id, 'cantidad': 3}])
+            assert ReservaStockService.disponibles([producto_id])[producto_id] == {'stock': 5, 'reservado': 3, 'disponible': 2}
+            with pytest.raises(ValueError, match="Stock insuficiente"):
+                WebPayService.iniciar_transaccion(monto=3000, items=[{'producto_id': producto_id, 'cantidad': 3}])
+            with pytest.raises(ValueError, match="disponible: 2"):
+                ProductoService.ajustar_stock(producto_id, -3, tipo='venta')
+            
+            vencido = WebPayService.iniciar_transaccion(monto=2000, items=[{'producto_id': producto_id, 'cantidad': 2}])
+            WebPayService.confirmar_transaccion(aprobado['token'], 'aprobada')
+            assert ReservaStockService.disponibles([producto_id])[producto_id] == {'stock': 2, 'reservado': 2, 'disponible': 0}
+            
+            assert ReservaStockService.liberar_vencidas(datetime.utcnow() + timedelta(seconds=ReservaStockService.TTL_RESERVA_SEGUNDOS)) == 2
+            assert ReservaStockService.disponibles([producto_id])[producto_id]['disponible'] == 2
+            assert TransaccionPago.query.filter_by(token_transaccion=vencido['token']).one().estado == 'expirada'
+            with pytest.raises(ValueError, match="ya fue procesada"):
+                WebPayService.confirmar_transaccion(vencido['token'], 'aprobada')
+
+class TestDinero:
+    """Pruebas para la aritmética de punto fijo"""
+    
+    def test_redondeo_mitad_hacia_arriba(self):
+        """Probar el redondeo a centavos y de divisiones enteras"""
+        assert Dinero.a_centavos(2.675) == 268
+        assert Dinero.a_centavos(1005) == 100500
+        assert Dinero.dividir(5, 2) == 3
+        assert Dinero.dividir(-5, 2) == -3
+    
+    def test_convertir_y_sumar(self):
+        """Probar conversión con tasa fija y suma exacta"""
+        assert Dinero.convertir_montos([1000, 0.5], (1, 900)) == [1.11, 0.0]
+        assert Dinero.sumar([0.1] * 10) == 1.0
 
 class TestCambioDivisasService:
     """Pruebas para CambioDivisasService"""
@@ -169,10 +357,564 @@ class TestCambioDivisasService:
                     moneda_origen='CLP',
                     moneda_destino='USD'
                 )
+            with pytest.raises(ValueError, match="El monto debe ser un número finito"):
+                CambioDivisasService.convertir_monto(float('nan'), 'CLP', 'USD')
     
     def test_actualizar_tasas_cambio(self, app):
         """Probar actualizar tasas de cambio"""
         with app.app_context():
             resultado = CambioDivisasService.actualizar_tasas_cambio()
             assert "Se actualizaron" in resultado
-            assert "tasas de cambio" in resultado
\ No newline at end of file
+            assert "tasas de cambio" in resultado
+    
+    def test_tasas_en_memoria_sin_consultas(self, app, contar_sentencias):
+        """Probar que las conversiones no consultan la BD con el snapshot cargado"""
+        with app.app_context():
+            CambioDivisasService.obtener_snapshot_tasas()
+            
+            with contar_sentencias() as sentencias:
+                for _ in range(10):
+                    CambioDivisasService.convertir_monto(1000, 'CLP', 'USD')
+            
+            assert sentencias == []
+    
+    def test_actualizar_tasas_publica_nuevo_snapshot(self, app):
+        """Probar que actualizar las tasas reemplaza el snapshot en memoria"""
+        with app.app_context():
+            anterior = CambioDivisasService.obtener_snapshot_tasas()
+            CambioDivisasService.actualizar_tasas_cambio()
+            actual = CambioDivisasService.obtener_snapshot_tasas()
+            
+            assert actual['version'] > anterior['version']
+            tasa_bd = ConversionMoneda.query.filter_by(moneda_origen='CLP', moneda_destino='USD').first()
+            assert CambioDivisasService.obtener_tasa_cambio('CLP', 'USD') == tasa_bd.tasa_cambio
+    
+    def test_convertir_lote(self, app):
+        """Probar convertir un lote conservando el orden y los errores por item"""
+        with app.app_context():
+            resultados = CambioDivisasService.convertir_lote([
+                {'monto': 1000, 'moneda_origen': 'CLP', 'moneda_destino': 'USD'},
+                {'monto': -5, 'moneda_origen': 'CLP', 'moneda_destino': 'USD'},
+                {'monto': 10, 'moneda_origen': 'USD', 'moneda_destino': 'XXX'},
+                {'monto': 2000, 'moneda_origen': 'clp', 'moneda_destino': 'usd'},
+                {'monto': float('nan'), 'moneda_origen': 'CLP', 'moneda_destino': 'USD'},
+                {'monto': float('inf'), 'moneda_origen': 'CLP', 'moneda_destino': 'USD'},
+                {'monto': '10', 'moneda_origen': 'CLP', 'moneda_destino': 'USD'}
+            ])
+            
+            individual = CambioDivisasService.convertir_monto(2000, 'CLP', 'USD')
+            assert resultados[0]['monto_convertido'] == CambioDivisasService.convertir_monto(1000, 'CLP', 'USD')['monto_convertido']
+            assert resultados[1] == {'error': 'El monto debe ser mayor a 0'}
+            assert 'Conversión no disponible' in resultados[2]['error']
+            assert resultados[3]['monto_convertido'] == individual['monto_convertido']
+            assert resultados[4:] == [{'error': 'El monto debe ser un número finito'}] * 3
+    
+    def test_matriz_triangulada(self, app, monkeypatch):
+        """Probar que una moneda nueva obtiene todos sus pares por triangulación"""
+        monkeypatch.setitem(CambioDivisasService.COTIZACIONES_BASE, 'PEN', 250.0)
+        
+        with app.app_context():
+            CambioDivisasService.cargar_tasas()
+            
+            usd_pen = CambioDivisasService.obtener_tasa_cambio('USD', 'PEN')
+            pen_usd = CambioDivisasService.obtener_tasa_cambio('PEN', 'USD')
+            
+            assert usd_pen == pytest.approx(900.0 / 250.0)
+            assert usd_pen * pen_usd == pytest.approx(1.0)
+            assert CambioDivisasService.obtener_tasa_cambio('PEN', 'CLP') == 250.0
+        
+        CambioDivisasService.invalidar_tasas()
+    
+    def test_actualizar_tasas_en_una_sentencia(self, app, contar_sentencias):
+        """Probar que el refresco escribe todas las tasas con un solo upsert"""
+        with app.app_context():
+            CambioDivisasService.actualizar_tasas_cambio()
+            
+            with contar_sentencias() as sentencias:
+                CambioDivisasService.actualizar_tasas_cambio()
+            
+            assert len([sql for sql in sentencias if 'conversion_moneda' in sql]) == 1
+            assert ConversionMoneda.query.count() == 6
+    
+    def test_montos_grandes_sin_perder_precision(self, app):
+        """Probar que montos grandes se convierten con la razón exacta entre cotizaciones"""
+        from datetime import datetime
+        
+        with app.app_context():
+            assert CambioDivisasService.convertir_monto(10 ** 9, 'CLP', 'USD')['monto_convertido'] == 1111111.11
+            assert CambioDivisasService.convertir_monto(10 ** 8, 'CLP', 'USD')['monto_convertido'] == 111111.11
+            
+            CambioDivisasService.actualizar_tasas_cambio()
+            CambioDivisasService.invalidar_tasas()
+            vigente = CambioDivisasService.convertir_monto(10 ** 9, 'CLP', 'EUR')
+            historica = CambioDivisasService.convertir_monto(10 ** 9, 'CLP', 'EUR', fecha=datetime.utcnow())
+            
+            assert vigente['monto_convertido'] == historica['monto_convertido']
+            assert vigente['tasa_cambio'] == historica['tasa_cambio']
+    
+    def test_tasa_historica_a_la_fecha(self, app):
+        """Probar convertir con la tasa vigente en una fecha pasada"""
+        from datetime import datetime, timedelta
+        
+        with app.app_context():
+            CambioDivisasService.actualizar_tasas_cambio()
+            tasa_anterior = CambioDivisasService.obtener_tasa_cambio('USD', 'EUR')
+            momento = datetime.utcnow()
+            
+            CambioDivisasService.actualizar_tasas_cambio()
+            CambioDivisasService.invalidar_historial()
+            
+            resultado = CambioDivisasService.convertir_monto(100, 'USD', 'EUR', fecha=momento)
+            assert resultado['tasa_cambio'] == pytest.approx(tasa_anterior)
+            
+            with pytest.raises(ValueError, match="No hay tasa registrada"):
+                CambioDivisasService.obtener_tasa_historica('USD', 'EUR', momento - timedelta(days=1))
+    
+    def test_historial_agregado_por_otro_proceso(self, app, contar_sentencias):
+        """Probar que una consulta posterior a la carga ve cotizaciones de otro proceso"""
+        from datetime import datetime, timedelta
+        from app_ferreteria import db, HistorialCotizacion
+        
+        with app.app_context():
+            CambioDivisasService.actualizar_tasas_cambio()
+            momento = datetime.utcnow()
+            tasa_anterior = CambioDivisasService.obtener_tasa_historica('USD', 'CLP', momento)
+            db.session.remove()
+            
+            # Otro proceso guarda una cotización nueva con su propia conexión
+            with db.engine.begin() as conexion:
+                conexion.execute(HistorialCotizacion.__table__.insert().values(
+                    moneda='USD', valor=1000, fecha=momento + timedelta(seconds=1)
+                ))
+            
+            # Una fecha ya cubierta por la carga no consulta la BD
+            with contar_sentencias() as sentencias:
+                assert CambioDivisasService.obtener_tasa_historica('USD', 'CLP', momento) == tasa_anterior
+            assert sentencias == []
+            
+            assert CambioDivisasService.obtener_tasa_historica('USD', 'CLP', momento + timedelta(seconds=2)) == 1000
+
+class TestCotizacionService:
+    """Pruebas para cotizaciones con tasa bloqueada"""
+    
+    def test_webpay_cobra_la_tasa_cotizada(self, app):
+        """Probar que el pago usa la tasa de la cotización aunque las tasas cambien"""
+        with app.app_context():
+            cotizacion = CotizacionService.crear(100, 'USD', 'CLP')
+            CambioDivisasService.actualizar_tasas_cambio()
+            
+            resultado = WebPayService.iniciar_transaccion(cotizacion=cotizacion['token'])
+            
+            assert resultado['monto'] == cotizacion['monto_convertido']
+            assert resultado['cotizacion']['tasa_cambio'] == cotizacion['tasa_cambio']
+            with pytest.raises(ValueError, match="no encontrada o expirada"):
+                WebPayService.iniciar_transaccion(cotizacion=cotizacion['token'])
+    
+    def test_cotizacion_expirada(self, app, monkeypatch):
+        """Probar que una cotización vencida se barre y ya no se encuentra"""
+        with app.app_context():
+            monkeypatch.setattr(CotizacionService, 'TTL_COTIZACION_SEGUNDOS', 0)
+            cotizacion = CotizacionService.crear(1000, 'CLP', 'USD')
+            
+            with pytest.raises(ValueError, match="no encontrada o expirada"):
+                CotizacionService.obtener(cotizacion['token'])
+            
+            CotizacionService.crear(1000, 'CLP', 'USD')
+            assert db.session.get(Cotizacion, cotizacion['token']) is None
+    
+    def test_cotizacion_no_se_consume_si_falla_la_reserva(self, app):
+        """Probar que el token sigue vigente si el pago no llega a guardarse"""
+        with app.app_context():
+            producto = ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000, 'stock': 1})
+            cotizacion = CotizacionService.crear(100, 'USD', 'CLP')
+            
+            with pytest.raises(ValueError, match="Stock insuficiente"):
+                WebPayService.iniciar_transaccion(
+                    cotizacion=cotizacion['token'], items=[{'producto_id': producto.id, 'cantidad': 5}]
+                )
+            assert TransaccionPago.query.count() == 0
+            
+            resultado = WebPayService.iniciar_transaccion(
+                cotizacion=cotizacion['token'], items=[{'producto_id': producto.id, 'cantidad': 1}]
+            )
+            assert resultado['monto'] == cotizacion['monto_convertido']
+            with pytest.raises(ValueError, match="no encontrada o expirada"):
+                WebPayService.iniciar_transaccion(cotizacion=cotizacion['token'])
+    
+    def test_cotizacion_visible_desde_otro_proceso(self, app):
+        """Probar que la cotización vive en la BD y no en la memoria del proceso"""
+        from sqlalchemy import select
+        with app.app_context():
+            cotizacion = CotizacionService.crear(100, 'USD', 'CLP')
+            db.session.remove()
+            
+            with db.engine.connect() as conexion:
+                guardada = conexion.execute(
+                    select(Cotizacion.monto_convertido).where(Cotizacion.token == cotizacion['token'])
+                ).scalar()
+            assert guardada == cotizacion['monto_convertido']
+    
+    def test_cotizacion_en_otra_moneda_rechazada(self, app):
+        """Probar que WebPay sólo acepta cotizaciones a CLP"""
+        with app.app_context():
+            cotizacion = CotizacionService.crear(1000, 'CLP', 'USD')
+            
+            with pytest.raises(ValueError, match="debe ser a CLP"):
+                WebPayService.iniciar_transaccion(cotizacion=cotizacion['token'])
+
+class TestRefrescoTasasService:
+    """Pruebas para el refresco de tasas con arriendo entre procesos"""
+    
+    def test_un_solo_proceso_actualiza(self, app):
+        """Probar que sólo el titular del arriendo actualiza y el resto recarga"""
+        with app.app_context():
+            assert RefrescoTasasService.ejecutar_ciclo(60, titular='worker-1') == 'actualizado'
+            assert RefrescoTasasService.ejecutar_ciclo(60, titular='worker-2') == 'recargado'
+            assert ConversionMoneda.query.count() > 0
+    
+    def test_arriendo_vencido_se_puede_tomar(self, app):
+        """Probar que un arriendo vencido lo toma otro proceso"""
+        with app.app_context():
+            assert RefrescoTasasService.adquirir_bloqueo('worker-1', 0)
+            assert RefrescoTasasService.adquirir_bloqueo('worker-2', 60)
+            assert not RefrescoTasasService.adquirir_bloqueo('worker-1', 60)
+    
+    def test_hilo_se_inicia_en_cada_worker(self, app, monkeypatch):
+        """Probar que la primera petición de un worker inicia el refresco y uno heredado de otro pid se reemplaza"""
+        import os
+        monkeypatch.setitem(app.config, 'TESTING', False)
+        monkeypatch.setenv('FERRETERIA_MANTENIMIENTO', '0')
+        monkeypatch.setenv('FERRETERIA_REFRESCO_TASAS_SEGUNDOS', '3600')
+        
+        try:
+            app.test_client().get('/health')
+            heredado = RefrescoTasasService._hilo
+            assert heredado.is_alive() and RefrescoTasasService._pid == os.getpid()
+            
+            app.test_client().get('/health')
+            assert RefrescoTasasService._hilo is heredado
+            
+            # Simular un worker creado por fork desde el proceso que inició el hilo
+            monkeypatch.setattr(RefrescoTasasService, '_pid', -1)
+            app.test_client().get('/health')
+            assert RefrescoTasasService._hilo is not heredado
+            assert RefrescoTasasService._pid == os.getpid()
+        finally:
+            RefrescoTasasService.detener()
+
+class TestMantenimientoService:
+    """Pruebas para las tareas de mantenimiento periódicas"""
+    
+    def test_cada_tarea_con_su_intervalo_y_arriendo(self, app, monkeypatch):
+        """Probar que la compactación usa su propio arriendo y liberar reservas corre en cada proceso"""
+        from app_ferreteria import MantenimientoService
+        monkeypatch.setattr(MantenimientoService, '_proximas', {})
+        
+        with app.app_context():
+            ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000, 'stock': 5})
+            
+            assert MantenimientoService.ejecutar_pendientes(titular='worker-1') == {
+                'liberar_reservas': 0, 'compactar_libro_stock': 1
+            }
+            # Antes de su intervalo ninguna tarea se repite
+            assert MantenimientoService.ejecutar_pendientes(titular='worker-1') == {}
+            
+            # Otro proceso: libera sus reservas, pero el arriendo de la compactación sigue tomado
+            MantenimientoService._proximas.clear()
+            assert MantenimientoService.ejecutar_pendientes(titular='worker-2') == {
+                'liberar_reservas': 0, 'compactar_libro_stock': None
+            }
+            # El arriendo de las tasas es independiente
+            assert RefrescoTasasService.adquirir_bloqueo('worker-2', 60)
+
+class TestPaginacionProductos:
+    """Pruebas para la paginación por cursor de productos"""
+    
+    def test_paginas_consecutivas(self, app):
+        """Probar recorrer productos página a página con el cursor"""
+        with app.app_context():
+            for i in range(5):
+                ProductoService.crear_producto({'nombre': f'Clavo {i}', 'precio': 10, 'stock': 1})
+            
+            pagina1, cursor = ProductoService.obtener_pagina_productos(limit=2)
+            assert [p.nombre for p in pagina1] == ['Clavo 0', 'Clavo 1']
+            assert cursor is not None
+            
+            after_id = ProductoService.decodificar_cursor(cursor)
+            pagina2, cursor = ProductoService.obtener_pagina_productos(after_id=after_id, limit=2)
+            assert [p.nombre for p in pagina2] == ['Clavo 2', 'Clavo 3']
+            
+            after_id = ProductoService.decodificar_cursor(cursor)
+            pagina3, cursor = ProductoService.obtener_pagina_productos(after_id=after_id, limit=2)
+            assert [p.nombre for p in pagina3] == ['Clavo 4']
+            assert cursor is None
+    
+    def test_cursor_invalido(self, app):
+        """Probar decodificar un cursor inválido"""
+        with app.app_context():
+            with pytest.raises(ValueError, match="Cursor inválido"):
+                ProductoService.decodificar_cursor('no-es-un-cursor')
+
+class TestBusquedaProductos:
+    """Pruebas para la búsqueda de productos con el índice FTS5"""
+    
+    def test_busqueda_por_prefijo(self, app):
+        """Probar que la búsqueda encuentra términos por prefijo"""
+        with app.app_context():
+            ProductoService.crear_producto({'nombre': 'Taladro Eléctrico', 'precio': 100, 'descripcion': 'Taladro 600W'})
+            ProductoService.crear_producto({'nombre': 'Martillo', 'precio': 50, 'descripcion': 'Martillo de acero'})
+            
+            productos = ProductoService.obtener_productos('tala')
+            
+            assert [p.nombre for p in productos] == ['Taladro Eléctrico']
+    
+    def test_indice_sincronizado_al_actualizar(self, app):
+        """Probar que el índice refleja los cambios de nombre"""
+        with app.app_context():
+            from app_ferreteria import db
+            producto = ProductoService.crear_producto({'nombre': 'Serrucho', 'precio': 30})
+            producto.nombre = 'Sierra Manual'
+            db.session.commit()
+            
+            assert ProductoService.obtener_productos('serrucho') == []
+            assert [p.id for p in ProductoService.obtener_productos('sierra')] == [producto.id]
+    
+    def test_busqueda_sin_tildes_y_con_errores(self, app):
+        """Probar búsquedas sin tildes, con errores de tipeo y por subcadena"""
+        with app.app_context():
+            taladro = ProductoService.crear_producto({'nombre': 'Taladro Eléctrico', 'precio': 100})
+            ProductoService.crear_producto({'nombre': 'Martillo', 'precio': 50})
+            
+            assert [p.id for p in ProductoService.obtener_productos('taladro electrico')] == [taladro.id]
+            assert [p.id for p in ProductoService.obtener_productos('taldro')] == [taladro.id]
+            assert [p.id for p in ProductoService.obtener_productos('ladro')] == [taladro.id]
+            assert ProductoService.obtener_productos('destornillador') == []
+
+class TestCatalogoService:
+    """Pruebas para el catálogo materializado en memoria"""
+    
+    def test_actualizacion_incremental(self, app, contar_sentencias):
+        """Probar que el catálogo refleja escrituras sin recargarse"""
+        with app.app_context():
+            producto = ProductoService.crear_producto({'nombre': 'Alicate', 'precio': 15, 'stock': 4})
+            catalogo, _ = CatalogoService.consultar()
+            assert [p['stock'] for p in catalogo] == [4]
+            
+            ProductoService.actualizar_stock(producto.id, 9)
+            ProductoService.crear_producto({'nombre': 'Cincel', 'precio': 20})
+            
+            with contar_sentencias() as sentencias:
+                catalogo, _ = CatalogoService.consultar()
+            assert [(p['nombre'], p['stock']) for p in catalogo] == [('Alicate', 9), ('Cincel', 0)]
+            assert sentencias == []
+    
+    def test_escrituras_de_otro_proceso(self, app, monkeypatch):
+        """Probar que catálogo, autocompletado y facetas ven lo que escribe otro proceso"""
+        from sqlalchemy import text
+        from app_ferreteria import db, VersionCacheService
+        monkeypatch.setattr(CatalogoService, 'INTERVALO_VERIFICACION_SEGUNDOS', 0)
+        with app.app_context():
+            producto = ProductoService.crear_producto({'nombre': 'Alicate', 'precio': 15, 'stock': 4})
+            assert CatalogoService.consultar()[0][0]['stock'] == 4
+            assert AutocompletarService.sugerir('ali') == [producto.id]
+            assert FacetasService.obtener()['rangos_precio'][0]['total'] == 1
+            db.session.remove()
+            
+            # Otro proceso: su propia conexión, sin los eventos de esta sesión
+            with db.engine.begin() as conexion:
+                conexion.execute(text(
+                    "UPDATE producto SET nombre = 'Tenaza', stock = 7, precio = 1500000 WHERE id = :id"
+                ), {'id': producto.id})
+                VersionCacheService.incrementar(conexion, CatalogoService.NOMBRE_VERSION)
+            
+            assert [(p['nombre'], p['stock']) for p in CatalogoService.consultar()[0]] == [('Tenaza', 7)]
+            assert AutocompletarService.sugerir('ali') == []
+            assert AutocompletarService.sugerir('ten') == [producto.id]
+            assert FacetasService.obtener()['rangos_precio'][0]['total'] == 0
+    
+    def test_rollback_no_modifica_catalogo(self, app):
+        """Probar que los cambios revertidos no llegan al catálogo"""
+        with app.app_context():
+            from app_ferreteria import db
+            producto = ProductoService.crear_producto({'nombre': 'Lima', 'precio': 8, 'stock': 2})
+            CatalogoService.consultar()
+            
+            producto.stock = 50
+            db.session.flush()
+            db.session.rollback()
+            
+            catalogo, _ = CatalogoService.consultar()
+            assert catalogo[0]['stock'] == 2
+    
+    def test_sentencias_no_crecen_con_productos(self, app, contar_sentencias):
+        """Probar que armar el catálogo usa una cantidad fija de sentencias SQL"""
+        from app_ferreteria import db, Categoria
+        
+        def sentencias_catalogo(cantidad_productos):
+            with app.app_context():
+                categoria = Categoria(nombre=f'Categoría {cantidad_productos}')
+                db.session.add(categoria)
+                db.session.flush()
+                for i in range(cantidad_productos):
+                    db.session.add(Producto(nombre=f'Producto {i}', precio=100 + i, categoria_id=categoria.id))
+                db.session.add(ConversionMoneda(moneda_origen='CLP', moneda_destino='USD', tasa_cambio=0.0011))
+                db.session.commit()
+                
+                CatalogoService.invalidar_derivados()
+                with contar_sentencias() as sentencias:
+                    catalogo, _ = CatalogoService.consultar('USD')
+                
+                assert len(catalogo) == cantidad_productos
+                assert all('categoria' in item and item['moneda'] == 'USD' for item in catalogo)
+                
+                db.session.query(Producto).delete()
+                db.session.query(Categoria).delete()
+                db.session.query(ConversionMoneda).delete()
+                db.session.commit()
+                return len(sentencias)
+        
+        pocas = sentencias_catalogo(3)
+        muchas = sentencias_catalogo(30)
+        
+        assert pocas == muchas
+        assert muchas <= CatalogoService.PRESUPUESTO_SENTENCIAS
+    
+    def test_precios_en_varias_monedas(self, app):
+        """Probar el mapa de precios por moneda del catálogo"""
+        with app.app_context():
+            ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000})
+            
+            catalogo, _ = CatalogoService.consultar(monedas=['USD', 'EUR'])
+            
+            tasa_usd = CambioDivisasService.obtener_tasa_cambio('CLP', 'USD')
+            tasa_eur = CambioDivisasService.obtener_tasa_cambio('CLP', 'EUR')
+            assert catalogo[0]['precios'] == {
+                'USD': round(1000 * tasa_usd, 2),
+                'EUR': round(1000 * tasa_eur, 2)
+            }
+            assert catalogo[0]['precio'] == 1000
+
+    def test_precios_materializados_por_moneda(self, app):
+        """Probar que precio_moneda se recalcula al escribir precios o tasas y que el catálogo la lee"""
+        from sqlalchemy import text
+        from app_ferreteria import db
+        with app.app_context():
+            producto = ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 1000})
+            consulta = text("SELECT precio_convertido FROM precio_moneda WHERE producto_id = :id AND moneda = 'USD'")
+            
+            assert db.session.execute(consulta, {'id': producto.id}).scalar() == 111
+            
+            producto.precio = 9000
+            db.session.commit()
+            CambioDivisasService.actualizar_tasas_cambio()
+            esperado = CambioDivisasService.convertir_monto(9000, 'CLP', 'USD')['monto_convertido']
+            
+            assert db.session.execute(consulta, {'id': producto.id}).scalar() == Dinero.a_centavos(esperado)
+            catalogo, _ = CatalogoService.consultar('USD')
+            assert catalogo[0]['precio'] == esperado
+            
+            # El catálogo lee la tabla derivada, no convierte al vuelo
+            db.session.execute(text("UPDATE precio_moneda SET precio_convertido = 1 WHERE moneda = 'USD'"))
+            db.session.commit()
+            CatalogoService.invalidar()
+            catalogo, _ = CatalogoService.consultar('USD')
+            assert catalogo[0]['precio'] == 0.01
+    
+    def test_precios_materializados_grandes(self, app, contar_sentencias):
+        """Probar un precio CLP sobre 2^31 centavos: exacto y con aritmética BIGINT en el SQL"""
+        from sqlalchemy import text
+        from app_ferreteria import db
+        with app.app_context():
+            with contar_sentencias() as sentencias:
+                producto = ProductoService.crear_producto({'nombre': 'Generador', 'precio': 25000000})
+            
+            recalculo = [s for s in sentencias if 'INSERT INTO precio_moneda' in s]
+            assert recalculo and 'AS BIGINT' in recalculo[0] and 'AS INTEGER' not in recalculo[0]
+            
+            esperado = CambioDivisasService.convertir_monto(25000000, 'CLP', 'EUR')['monto_convertido']
+            assert db.session.execute(text(
+                "SELECT precio_convertido FROM precio_moneda WHERE producto_id = :id AND moneda = 'EUR'"
+            ), {'id': producto.id}).scalar() == Dinero.a_centavos(esperado)
+
+class TestAutocompletarService:
+    """Pruebas para el índice de prefijos de nombres de productos"""
+    
+    def test_sugerencias_en_caliente_sin_sql(self, app, contar_sentencias, monkeypatch):
+        """Probar que una sugerencia en caliente compara la versión a lo más una vez"""
+        with app.app_context():
+            ProductoService.crear_producto({'nombre': 'Taladro', 'precio': 100})
+            cliente = app.test_client()
+            cliente.get('/productos/autocompletar?q=ta')
+            
+            with contar_sentencias() as sentencias:
+                assert cliente.get('/productos/autocompletar?q=tal').status_code == 200
+            assert sentencias == []
+            
+            monkeypatch.setattr(CatalogoService, 'INTERVALO_VERIFICACION_SEGUNDOS', 0)
+            with contar_sentencias() as sentencias:
+                assert [s['nombre'] for s in cliente.get('/productos/autocompletar?q=tala').get_json()] == ['Taladro']
+            assert len(sentencias) == 1 and 'version_cache' in sentencias[0]
+    
+    def test_sugerencias_sin_tildes(self, app):
+        """Probar sugerencias por inicio de nombre y de palabra, sin tildes"""
+        with app.app_context():
+            taladro = ProductoService.crear_producto({'nombre': 'Taladro Eléctrico', 'precio': 100})
+            electrodo = ProductoService.crear_producto({'nombre': 'Electrodo', 'precio': 10})
+            ProductoService.crear_producto({'nombre': 'Martillo', 'precio': 20})
+            
+            assert AutocompletarService.sugerir('ELEC') == [electrodo.id, taladro.id]
+            assert AutocompletarService.sugerir('tal') == [taladro.id]
+    
+    def test_indice_se_actualiza_al_renombrar(self, app):
+        """Probar que el índice sigue los cambios de nombre"""
+        with app.app_context():
+            from app_ferreteria import db
+            producto = ProductoService.crear_producto({'nombre': 'Serrucho', 'precio': 30})
+            assert AutocompletarService.sugerir('serr') == [producto.id]
+            
+            producto.nombre = 'Sierra'
+            db.session.commit()
+            
+            assert AutocompletarService.sugerir('serr') == []
+            assert AutocompletarService.sugerir('sie') == [producto.id]
+
+class TestFacetasService:
+    """Pruebas para los conteos por categoría y rango de precio"""
+    
+    def test_facetas_de_busqueda(self, app):
+        """Probar facetas calculadas sobre los resultados de la búsqueda"""
+        with app.app_context():
+            from app_ferreteria import db, Categoria
+            categoria = Categoria(nombre='Eléctricas')
+            db.session.add(categoria)
+            db.session.commit()
+            
+            ProductoService.crear_producto({'nombre': 'Taladro Mini', 'precio': 20000, 'categoria_id': categoria.id})
+            ProductoService.crear_producto({'nombre': 'Taladro Pro', 'precio': 150000, 'categoria_id': categoria.id})
+            ProductoService.crear_producto({'nombre': 'Martillo', 'precio': 5000})
+            
+            facetas = FacetasService.obtener('taladro')
+            
+            assert facetas['categorias'] == [{'categoria_id': categoria.id, 'total': 2}]
+            assert [r['total'] for r in facetas['rangos_precio']] == [0, 1, 0, 1]
+    
+    def test_catalogo_en_caliente_compara_version_una_vez(self, app, contar_sentencias, monkeypatch):
+        """Probar que /catalogo en caliente compara la versión una sola vez para catálogo y facetas"""
+        with app.app_context():
+            ProductoService.crear_producto({'nombre': 'Clavo', 'precio': 100})
+            cliente = app.test_client()
+            cliente.get('/catalogo?monedas=USD')
+            
+            monkeypatch.setattr(CatalogoService, 'INTERVALO_VERIFICACION_SEGUNDOS', 0)
+            with contar_sentencias() as sentencias:
+                assert cliente.get('/catalogo?monedas=USD').status_code == 200
+            assert len(sentencias) == 1 and 'version_cache' in sentencias[0]
+    
+    def test_cache_se_invalida_al_escribir(self, app):
+        """Probar que crear un producto invalida las facetas guardadas"""
+        with app.app_context():
+            ProductoService.crear_producto({'nombre': 'Clavo', 'precio': 100})
+            assert FacetasService.obtener()['rangos_precio'][0]['total'] == 1
+            
+            ProductoService.crear_producto({'nombre': 'Tornillo', 'precio': 200})
+            assert FacetasService.obtener()['rangos_precio'][0]['total'] == 2